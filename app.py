@@ -39,6 +39,7 @@ try:
     from cryptography.hazmat.primitives.asymmetric import ec
     from cryptography.hazmat.primitives import hashes, serialization
     from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 except ImportError:
     st.error("Missing: cryptography. Add `cryptography>=42.0.0` to requirements.txt")
     st.stop()
@@ -58,7 +59,7 @@ except ImportError:
 
 # Standard library — always available
 import streamlit.components.v1 as components
-from collections import deque
+from rppg_component import declare_html_component
 import time
 import sqlite3
 import hashlib
@@ -67,6 +68,14 @@ from datetime import datetime, timedelta
 import base64
 import random
 import math
+import logging
+import threading
+import queue
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+_log = logging.getLogger("medchainsecure")
 
 # ─────────────────────────────────────────────────────────────────────────────
 # PAGE CONFIG
@@ -397,14 +406,82 @@ class HybridEncryption:
         shared = private_key.exchange(ec.ECDH(), public_key)
         return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'handshake data').derive(shared)
 
+    # Below this many rows the pool's hand-off costs more than it saves
+    PARALLEL_MIN_ROWS = 256
+    CHUNK_ROWS        = 512
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _kek_cipher(kek: bytes) -> AESGCM:
+        """AESGCM objects are immutable and thread-safe — build each KEK's once.
+        Per-row data keys are never cached: each is used about once, and
+        keeping them would hold plaintext keys in memory indefinitely."""
+        return AESGCM(kek)
+
     @staticmethod
     def encrypt_aes_gcm(data: str, key: bytes) -> bytes:
         nonce = os.urandom(12)
-        return nonce + AESGCM(key).encrypt(nonce, data.encode(), None)
+        return nonce + AESGCM(bytes(key)).encrypt(nonce, data.encode(), None)
 
     @staticmethod
     def decrypt_aes_gcm(enc: bytes, key: bytes) -> str:
-        return AESGCM(key).decrypt(enc[:12], enc[12:], None).decode()
+        enc = bytes(enc)
+        return AESGCM(bytes(key)).decrypt(enc[:12], enc[12:], None).decode()
+
+    # ── Envelope encryption: a key-encryption key (KEK) wraps each data key ──
+    @staticmethod
+    def wrap_key(data_key: bytes, kek: bytes, kek_id: str) -> bytes:
+        """AES-GCM wrap a data key under a KEK; kek_id is bound as AAD."""
+        nonce = os.urandom(12)
+        return nonce + HybridEncryption._kek_cipher(kek).encrypt(nonce, data_key, kek_id.encode())
+
+    @staticmethod
+    def unwrap_key(wrapped: bytes, kek: bytes, kek_id: str) -> bytes:
+        wrapped = bytes(wrapped)
+        return HybridEncryption._kek_cipher(kek).decrypt(wrapped[:12], wrapped[12:], kek_id.encode())
+
+    @staticmethod
+    def _decrypt_chunk(pairs, keyring=None) -> list:
+        out = []
+        for enc, key, *kek_id in pairs:
+            try:
+                if keyring is not None:
+                    key = keyring.unwrap(kek_id[0] if kek_id else None, key)
+                out.append(json.loads(HybridEncryption.decrypt_aes_gcm(enc, key)))
+            except Exception:
+                out.append(None)
+        return out
+
+    @staticmethod
+    def decrypt_many(rows, workers: int = None, keyring=None) -> list:
+        """Decrypt and JSON-parse many (encrypted_data, key) pairs.
+
+        With a keyring, rows are (encrypted_data, wrapped_key, kek_id) and
+        each data key is unwrapped in the worker first. Returns one parsed
+        dict per input row, in order, with None for rows that fail to
+        decrypt or parse. Large inputs are split into chunks and run on a
+        shared thread pool (the AES work releases the GIL); small inputs,
+        or single-core hosts, are decrypted inline.
+        """
+        pairs = rows if isinstance(rows, list) else list(rows)
+        workers = workers or _decrypt_pool_size()
+        if workers < 2 or len(pairs) < HybridEncryption.PARALLEL_MIN_ROWS:
+            return HybridEncryption._decrypt_chunk(pairs, keyring)
+        n = HybridEncryption.CHUNK_ROWS
+        chunks = [pairs[i:i + n] for i in range(0, len(pairs), n)]
+        out = []
+        for part in _decrypt_executor(workers).map(HybridEncryption._decrypt_chunk, chunks,
+                                                   [keyring] * len(chunks)):
+            out.extend(part)
+        return out
+
+def _decrypt_pool_size() -> int:
+    return min(8, os.cpu_count() or 1)
+
+@st.cache_resource(show_spinner=False)
+def _decrypt_executor(workers: int) -> ThreadPoolExecutor:
+    """Process-wide decrypt pool (one per size), reused across reruns."""
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decrypt")
 
 # ─────────────────────────────────────────────────────────────────────────────
 # DATABASE  (persistent across sessions via file)
@@ -429,8 +506,10 @@ def _probe_writable(path: str) -> bool:
     except Exception:
         return False
 
+@st.cache_resource(show_spinner=False)
 def _get_db_path() -> str:
-    """Return a writable path for the SQLite database."""
+    """Return a writable path for the SQLite database.
+    Probed once per server process — reruns reuse the cached answer."""
     try:
         script_dir = os.path.dirname(os.path.abspath(__file__))
     except NameError:
@@ -451,13 +530,373 @@ def _get_db_path() -> str:
 
 DB_PATH = _get_db_path()
 
-def get_conn():
-    """Get a thread-safe DB connection with WAL mode enabled."""
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
-    conn.row_factory = sqlite3.Row  # allows column access by name
-    return conn
+class ConnectionPool:
+    """Process-wide SQLite connections: one shared writer plus idle readers.
+
+    Pragmas are applied once when a connection is opened, not per query.
+    A reader is checked out by one thread at a time and returned to the idle
+    stack afterwards; all writes are serialised through the single writer.
+    """
+
+    def __init__(self, path: str, max_idle_readers: int = 8):
+        self.path        = path
+        self._write_lock = threading.RLock()
+        self._writer     = self._open()
+        self._idle       = queue.LifoQueue(maxsize=max_idle_readers)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.row_factory = sqlite3.Row  # allows column access by name
+        return conn
+
+    @contextmanager
+    def reader(self):
+        # Every ":memory:" connection is its own database — share the writer
+        if self.path == ":memory:":
+            with self._write_lock:
+                yield self._writer
+            return
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        try:
+            yield conn
+        finally:
+            try:
+                conn.rollback()       # end any implicit read transaction
+                self._idle.put_nowait(conn)
+            except (queue.Full, sqlite3.Error):
+                conn.close()
+
+    @contextmanager
+    def writer(self):
+        with self._write_lock:
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+@st.cache_resource(show_spinner=False)
+def _get_pool(path: str) -> ConnectionPool:
+    """One pool per DB path for the whole server process (survives reruns)."""
+    return ConnectionPool(path)
+
+def db_conn(write: bool = False):
+    """Context manager yielding a pooled connection.
+    write=True commits on success and rolls back on error."""
+    pool = _get_pool(DB_PATH)
+    return pool.writer() if write else pool.reader()
+
+# ── Envelope keys ─────────────────────────────────────────────────────────
+# test_results.encryption_key holds the row's data key wrapped by a KEK and
+# test_results.kek_id names that KEK (NULL = legacy raw key). KEKs never touch
+# the database: they live in a per-tenant keyfile beside it, kept in memory.
+# Remote backups carry only wrapped keys, so the keyfile must be recoverable
+# on its own: a passphrase-sealed escrow copy (KeyRing.export_escrow) is
+# queued with the backups when CARDIOSECURE_KEK_PASSPHRASE is set, and
+# `python app.py kek-export <file>` / `kek-import <file>` move it by hand.
+
+TENANT_ID = os.environ.get("CARDIOSECURE_TENANT", "default")
+KEK_ESCROW_PASSPHRASE = os.environ.get("CARDIOSECURE_KEK_PASSPHRASE")
+
+def _fsync_dir(path: str):
+    """Make a create/rename in path's directory durable (no-op on Windows)."""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class KeyRing:
+    """A tenant's KEKs, loaded from a local JSON keyfile, plus an LRU of
+    unwrapped data keys.
+
+    The keyfile is {"tenant", "active", "keys": {kek_id: hex}, "escrowed":
+    [kek_id, ...], "retired": [kek_id, ...]}; it is created with a fresh KEK
+    on first use (mode 0600) and rewritten atomically when a KEK is added or
+    retired, fsynced (file and directory) before any caller can wrap a key
+    under it. path=None keeps the KEKs in memory only.
+
+    KEKs are never deleted: queued and already-sent backups carry data keys
+    wrapped under whichever KEK was active when they were saved. A retired
+    KEK still unwraps; it just never wraps again.
+
+    in_use() reports whether rows are already wrapped under some KEK. If so,
+    a missing keyfile raises instead of silently starting a new KEK, which
+    would leave every existing row undecryptable.
+    """
+
+    def __init__(self, path, tenant: str = TENANT_ID, cache_size: int = 4096,
+                 in_use=None):
+        self.path     = path
+        self.tenant   = tenant
+        self.in_use   = in_use
+        self.created  = False      # True when this instance made the keyfile
+        self._lock    = threading.RLock()
+        self._keys    = {}
+        self._active  = None
+        self._escrowed = set()
+        self._retired = set()
+        self._mtime   = None
+        self.unwrap   = lru_cache(maxsize=cache_size)(self._unwrap)
+        self._load()
+
+    # ── keyfile ───────────────────────────────────────────────────────────
+    def _load(self):
+        with self._lock:
+            if not self.path:
+                if not self._keys:
+                    self.add_kek()
+                return
+            if not os.path.exists(self.path):
+                if self.in_use is not None and self.in_use():
+                    raise RuntimeError(
+                        f"KEK keyfile {self.path} is missing but stored results are "
+                        f"wrapped under it. Restore the keyfile (or `python app.py "
+                        f"kek-import <escrow.json>`); refusing to create a new KEK.")
+                try:
+                    # O_EXCL: when two processes race, exactly one KEK wins
+                    self._write(self._fresh_kek(), os.O_EXCL)
+                    self.created = True
+                except FileExistsError:
+                    pass
+            with open(self.path) as f:
+                doc = json.load(f)
+            self._keys     = {k: bytes.fromhex(v) for k, v in doc["keys"].items()}
+            self._active   = doc["active"]
+            self._escrowed = set(doc.get("escrowed", ()))
+            self._retired  = set(doc.get("retired", ()))
+            self._mtime    = os.stat(self.path).st_mtime_ns
+
+    def _fresh_kek(self) -> dict:
+        kek_id = f"{self.tenant}-{datetime.now():%Y%m%d%H%M%S}-{os.urandom(3).hex()}"
+        return {"tenant": self.tenant, "active": kek_id, "keys": {kek_id: os.urandom(32).hex()}}
+
+    @staticmethod
+    def _write_doc(path: str, doc: dict, flags: int = 0):
+        # Durable before return: migration 8 and save_test_result commit rows
+        # wrapped under this KEK right after, and a crash must not lose it.
+        tmp = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(path if flags else tmp,
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC | flags, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(doc, f)
+            f.flush()
+            os.fsync(f.fileno())
+        if not flags:
+            os.replace(tmp, path)
+        _fsync_dir(path)
+
+    def _write(self, doc: dict, flags: int = 0):
+        self._write_doc(self.path, doc, flags)
+
+    def _doc(self) -> dict:
+        return {"tenant": self.tenant, "active": self._active,
+                "keys": {k: v.hex() for k, v in self._keys.items()},
+                "escrowed": sorted(self._escrowed), "retired": sorted(self._retired)}
+
+    def _save(self):
+        if not self.path:
+            return
+        self._write(self._doc())
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    def _refresh(self):
+        """Pick up a rotation done by another process sharing the keyfile."""
+        try:
+            if self.path and os.stat(self.path).st_mtime_ns != self._mtime:
+                self._load()
+        except OSError:
+            pass
+
+    @property
+    def active_id(self) -> str:
+        return self._active
+
+    def kek_ids(self) -> list:
+        with self._lock:
+            return list(self._keys)
+
+    def add_kek(self) -> str:
+        """Generate a new KEK, make it the active one and persist it."""
+        with self._lock:
+            doc = self._fresh_kek()
+            kek_id = doc["active"]
+            self._keys[kek_id] = bytes.fromhex(doc["keys"][kek_id])
+            self._active = kek_id
+            self._save()
+            return kek_id
+
+    @property
+    def retired(self) -> set:
+        return set(self._retired)
+
+    def retire(self, kek_id: str):
+        """Stop wrapping under a KEK. It stays in the keyfile for unwrapping
+        old backups, which may reference it long after test_results does."""
+        with self._lock:
+            if kek_id == self._active:
+                raise ValueError("cannot retire the active KEK")
+            if kek_id in self._keys and kek_id not in self._retired:
+                self._retired.add(kek_id)
+                self._save()
+
+    # ── escrow ────────────────────────────────────────────────────────────
+    ESCROW_SCRYPT = {"n": 2 ** 15, "r": 8, "p": 1}
+
+    @staticmethod
+    def _escrow_cipher(passphrase: str, salt: bytes, params: dict) -> AESGCM:
+        return AESGCM(Scrypt(salt=salt, length=32, **params).derive(passphrase.encode()))
+
+    @property
+    def escrowed(self) -> set:
+        return set(self._escrowed)
+
+    def export_escrow(self, passphrase: str) -> dict:
+        """All KEKs sealed under a passphrase (scrypt → AES-GCM, tenant as
+        AAD). Safe to store next to the backups it unlocks."""
+        if not passphrase:
+            raise ValueError("an escrow passphrase is required")
+        with self._lock:
+            doc = self._doc()
+        doc.pop("escrowed")   # "retired" travels with the keys
+        salt, nonce = os.urandom(16), os.urandom(12)
+        sealed = self._escrow_cipher(passphrase, salt, self.ESCROW_SCRYPT).encrypt(
+            nonce, json.dumps(doc).encode(), self.tenant.encode())
+        return {"tenant": self.tenant, "active": doc["active"], "kdf": "scrypt",
+                **self.ESCROW_SCRYPT, "salt": salt.hex(), "sealed": (nonce + sealed).hex()}
+
+    def mark_escrowed(self):
+        """Record that every current KEK now has an escrow copy."""
+        with self._lock:
+            self._escrowed |= set(self._keys)
+            self._save()
+
+    @classmethod
+    def restore_escrow(cls, path: str, escrow: dict, passphrase: str) -> list:
+        """Merge the KEKs of an export_escrow() blob into the keyfile at path
+        (creating it if missing). Returns the kek_ids restored."""
+        params = {k: escrow[k] for k in cls.ESCROW_SCRYPT}
+        sealed = bytes.fromhex(escrow["sealed"])
+        try:
+            doc = json.loads(cls._escrow_cipher(
+                passphrase, bytes.fromhex(escrow["salt"]), params).decrypt(
+                sealed[:12], sealed[12:], escrow["tenant"].encode()))
+        except Exception as e:
+            raise ValueError("wrong passphrase or corrupted escrow") from e
+        merged = dict(doc, escrowed=sorted(doc["keys"]))
+        if os.path.exists(path):   # keep the local active KEK and any newer ones
+            with open(path) as f:
+                cur = json.load(f)
+            merged = {"tenant": cur["tenant"], "active": cur["active"],
+                      "keys": {**doc["keys"], **cur["keys"]},
+                      "escrowed": sorted(set(cur.get("escrowed", ())) | set(doc["keys"])),
+                      "retired": sorted(set(cur.get("retired", ())) |
+                                        set(doc.get("retired", ())))}
+        cls._write_doc(path, merged)
+        return sorted(doc["keys"])
+
+    # ── data keys ─────────────────────────────────────────────────────────
+    def new_data_key(self) -> tuple:
+        """Return (data_key, wrapped_key, kek_id) for a new record."""
+        self._refresh()
+        with self._lock:
+            kek_id, kek = self._active, self._keys[self._active]
+        dek = os.urandom(32)
+        return dek, HybridEncryption.wrap_key(dek, kek, kek_id), kek_id
+
+    def wrap(self, data_key: bytes, kek_id: str = None) -> tuple:
+        """Wrap an existing data key; returns (wrapped_key, kek_id)."""
+        with self._lock:
+            kek_id = kek_id or self._active
+            if kek_id in self._retired:
+                raise ValueError(f"KEK {kek_id} is retired; it only unwraps")
+            kek = self._keys[kek_id]
+        return HybridEncryption.wrap_key(data_key, kek, kek_id), kek_id
+
+    def _unwrap(self, kek_id, wrapped) -> bytes:
+        if kek_id is None:
+            return bytes(wrapped)  # legacy row: the stored key is the data key
+        kek = self._keys.get(kek_id)
+        if kek is None:
+            self._refresh()
+            kek = self._keys.get(kek_id)
+        if kek is None:
+            _log.error("KEK %s is not in keyfile %s; its rows cannot be decrypted",
+                       kek_id, self.path)
+            raise KeyError(kek_id)
+        return HybridEncryption.unwrap_key(wrapped, kek, kek_id)
+
+def _keyfile_path(db_path: str, tenant: str = TENANT_ID):
+    if db_path == ":memory:":
+        return None
+    return os.environ.get("CARDIOSECURE_KEK_FILE") or \
+        os.path.join(os.path.dirname(os.path.abspath(db_path)), f"cardiosecure-{tenant}.kek")
+
+def _wrapped_keys_exist() -> bool:
+    """True once any stored result is wrapped under a KEK."""
+    try:
+        with db_conn() as conn:
+            return conn.execute("SELECT 1 FROM test_results WHERE kek_id IS NOT NULL "
+                                "LIMIT 1").fetchone() is not None
+    except sqlite3.OperationalError as e:
+        if "no such" in str(e):
+            return False   # schema not migrated to envelope keys yet
+        raise
+
+@st.cache_resource(show_spinner=False)
+def _get_keyring(path: str) -> KeyRing:
+    """One keyring per DB path for the whole server process (survives reruns)."""
+    return KeyRing(_keyfile_path(path), in_use=_wrapped_keys_exist)
+
+def keyring() -> KeyRing:
+    return _get_keyring(DB_PATH)
+
+# ── Hot queries (shared with the EXPLAIN QUERY PLAN startup check) ────────
+_SQL_LOGIN = """SELECT id, full_name, is_admin,
+                       COALESCE(age, 0)    AS age,
+                       COALESCE(gender, '') AS gender
+                FROM users
+                WHERE username=? AND password_hash=?"""
+
+_SQL_USER_RESULTS = """SELECT id, encrypted_data, encryption_key, test_date, kek_id
+                       FROM test_results WHERE user_id=?
+                       ORDER BY test_date DESC, id DESC"""
+
+_SQL_USER_RESULTS_PAGE = """SELECT id, encrypted_data, encryption_key, test_date, kek_id
+                            FROM test_results
+                            WHERE user_id=? AND (test_date, id) < (?, ?)
+                            ORDER BY test_date DESC, id DESC
+                            LIMIT ? OFFSET ?"""
+
+_SQL_USER_TREND = """SELECT test_date, raw_bpm, raw_category
+                     FROM test_results WHERE user_id=?
+                     ORDER BY test_date DESC, id DESC"""
+
+_SQL_SESSION_LOG_USER = '''SELECT l.id, u.username, l.action, l.details, l.logged_at
+                           FROM session_log l JOIN users u ON l.user_id=u.id
+                           WHERE l.user_id=? ORDER BY l.logged_at DESC LIMIT ?'''
+
+_SQL_SESSION_LOG_ALL = '''SELECT l.id, u.username, l.action, l.details, l.logged_at
+                          FROM session_log l JOIN users u ON l.user_id=u.id
+                          ORDER BY l.logged_at DESC LIMIT ?'''
+
+# name → (sql, representative params)
+_HOT_QUERIES = {
+    "login":             (_SQL_LOGIN,             ("admin", "")),
+    "user_results":      (_SQL_USER_RESULTS,      (1,)),
+    "user_results_page": (_SQL_USER_RESULTS_PAGE, (1, "9999", 0, 20, 0)),
+    "user_trend":        (_SQL_USER_TREND,        (1,)),
+    "session_log_user":  (_SQL_SESSION_LOG_USER,  (1, 50)),
+    "session_log_all":   (_SQL_SESSION_LOG_ALL,   (50,)),
+}
 
 def _add_column_if_missing(cursor, table: str, column: str, col_def: str):
     """Safely add a column to an existing table if it doesn't exist yet."""
@@ -466,145 +905,263 @@ def _add_column_if_missing(cursor, table: str, column: str, col_def: str):
     except sqlite3.OperationalError:
         pass  # Column already exists — that's fine
 
-def init_database():
-    """Create tables if they don't exist and run any needed migrations."""
+# ── Versioned schema migrations ──────────────────────────────────────────
+# Each migration runs exactly once per database, inside its own transaction,
+# and is recorded in schema_version. Append new steps — never edit old ones.
+
+def _migration_1_base_schema(c):
+    """Base tables, legacy column back-fill and the admin seed account."""
+    # ── Users table ────────────────────────────────────────────────────────
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+        id            INTEGER PRIMARY KEY AUTOINCREMENT,
+        username      TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        full_name     TEXT NOT NULL,
+        age           INTEGER DEFAULT 0,
+        gender        TEXT DEFAULT "",
+        is_admin      INTEGER DEFAULT 0,
+        created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    # Add columns that may be missing from pre-versioning DBs
+    _add_column_if_missing(c, "users", "age",    "INTEGER DEFAULT 0")
+    _add_column_if_missing(c, "users", "gender", "TEXT DEFAULT ''")
+
+    # ── Test results table ─────────────────────────────────────────────────
+    c.execute('''CREATE TABLE IF NOT EXISTS test_results (
+        id             INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id        INTEGER NOT NULL,
+        encrypted_data BLOB NOT NULL,
+        encryption_key BLOB NOT NULL,
+        raw_bpm        REAL,
+        raw_category   TEXT,
+        raw_timestamp  TEXT,
+        test_date      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id))''')
+
+    _add_column_if_missing(c, "test_results", "raw_bpm",       "REAL")
+    _add_column_if_missing(c, "test_results", "raw_category",  "TEXT")
+    _add_column_if_missing(c, "test_results", "raw_timestamp", "TEXT")
+
+    # ── Session log table ──────────────────────────────────────────────────
+    c.execute('''CREATE TABLE IF NOT EXISTS session_log (
+        id         INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id    INTEGER NOT NULL,
+        action     TEXT,
+        details    TEXT,
+        logged_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    # ── Seed admin account ─────────────────────────────────────────────────
+    admin_hash = hashlib.sha256("admin123".encode()).hexdigest()
+    c.execute("""INSERT OR IGNORE INTO users
+                 (username, password_hash, full_name, is_admin)
+                 VALUES (?, ?, ?, ?)""",
+              ("admin", admin_hash, "System Administrator", 1))
+
+def _migration_2_history_indexes(c):
+    """Secondary indexes for the per-user history / audit queries."""
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_test_results_user_date
+                 ON test_results (user_id, test_date DESC)""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_session_log_user_time
+                 ON session_log (user_id, logged_at DESC)""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_session_log_time
+                 ON session_log (logged_at DESC)""")
+
+def _migration_3_history_keyset_index(c):
+    """Keyset-pagination index for test_results (adds id as tie-breaker)."""
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_test_results_user_page
+                 ON test_results (user_id, test_date DESC, id DESC)""")
+    c.execute("DROP INDEX IF EXISTS idx_test_results_user_date")  # now a prefix duplicate
+
+def _migration_4_backfill_raw_columns(c):
+    """Back-fill plaintext raw_bpm/raw_category/raw_timestamp on legacy rows."""
+    rows = c.execute("""SELECT id, encrypted_data, encryption_key, test_date
+                        FROM test_results WHERE raw_bpm IS NULL""").fetchall()
+    decoded = HybridEncryption.decrypt_many((r[1], r[2]) for r in rows)  # pre-envelope rows
+    for r, dec in zip(rows, decoded):
+        if dec is None:
+            continue  # unreadable legacy row — leave it for manual inspection
+        c.execute("""UPDATE test_results
+                     SET raw_bpm=?, raw_category=?, raw_timestamp=?
+                     WHERE id=?""",
+                  (dec.get("bpm"), dec.get("analysis", {}).get("category", ""),
+                   dec.get("timestamp") or r[3], r[0]))
+
+def _migration_5_dashboard_covering_index(c):
+    """Covering index so dashboard aggregates never read the ciphertext pages."""
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_test_results_cat_bpm
+                 ON test_results (raw_category, raw_bpm)""")
+
+def _migration_6_rollup_tables(c):
+    """Per-user and per-day rollup tables maintained on write, back-filled once."""
+    for table, key in (("user_stats", "user_id INTEGER PRIMARY KEY"),
+                       ("daily_stats", "day TEXT PRIMARY KEY")):
+        c.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+            {key},
+            n               INTEGER NOT NULL DEFAULT 0,
+            bpm_sum         REAL    NOT NULL DEFAULT 0,
+            bpm_sumsq       REAL    NOT NULL DEFAULT 0,
+            bpm_min         REAL,
+            bpm_max         REAL,
+            normal          INTEGER NOT NULL DEFAULT 0,
+            category_counts TEXT    NOT NULL DEFAULT '{{}}',
+            last_test       TIMESTAMP)''')
+    _rebuild_rollups(c)
+
+def _migration_7_backup_outbox(c):
+    """Durable outbox for remote backups, drained by a background worker."""
+    c.execute('''CREATE TABLE IF NOT EXISTS backup_outbox (
+        id              INTEGER PRIMARY KEY AUTOINCREMENT,
+        payload         TEXT    NOT NULL,
+        attempts        INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL    NOT NULL DEFAULT 0,
+        last_error      TEXT,
+        created_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_backup_outbox_due
+                 ON backup_outbox (next_attempt_at, id)""")
+
+def _migration_8_envelope_keys(c):
+    """Envelope keys: wrap every raw per-row data key under the tenant KEK."""
+    _add_column_if_missing(c, "test_results", "kek_id", "TEXT")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_test_results_kek
+                 ON test_results (kek_id)""")
+    ring = keyring()
+    rows = c.execute("SELECT id, encryption_key FROM test_results WHERE kek_id IS NULL").fetchall()
+    c.executemany("UPDATE test_results SET encryption_key=?, kek_id=? WHERE id=?",
+                  [(*ring.wrap(bytes(r[1])), r[0]) for r in rows])
+
+_MIGRATIONS = [
+    (1, _migration_1_base_schema),
+    (2, _migration_2_history_indexes),
+    (3, _migration_3_history_keyset_index),
+    (4, _migration_4_backfill_raw_columns),
+    (5, _migration_5_dashboard_covering_index),
+    (6, _migration_6_rollup_tables),
+    (7, _migration_7_backup_outbox),
+    (8, _migration_8_envelope_keys),
+]
+SCHEMA_VERSION = _MIGRATIONS[-1][0]
+
+def _current_schema_version(conn) -> int:
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def migrate_database() -> int:
+    """Apply any pending migrations and return the resulting schema version."""
+    with db_conn(write=True) as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+            version     INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    for version, step in _MIGRATIONS:
+        with db_conn(write=True) as conn:
+            # IMMEDIATE takes the write lock before we re-read the version,
+            # so two processes starting together cannot both apply a step
+            conn.execute("BEGIN IMMEDIATE")
+            if _current_schema_version(conn) >= version:
+                continue
+            step(conn.cursor())
+            conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                         (version, step.__doc__))
+    with db_conn() as conn:
+        return _current_schema_version(conn)
+
+@st.cache_resource(show_spinner=False)
+def init_database() -> int:
+    """Bring the schema of DB_PATH up to date once per server process.
+    Streamlit reruns hit the cache and do no DDL at all."""
     try:
-        conn = get_conn(); c = conn.cursor()
-
-        # ── Users table ────────────────────────────────────────────────────────
-        c.execute('''CREATE TABLE IF NOT EXISTS users (
-            id            INTEGER PRIMARY KEY AUTOINCREMENT,
-            username      TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            full_name     TEXT NOT NULL,
-            age           INTEGER DEFAULT 0,
-            gender        TEXT DEFAULT "",
-            is_admin      INTEGER DEFAULT 0,
-            created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        # Migration: add columns that may be missing from older DB versions
-        _add_column_if_missing(c, "users", "age",    "INTEGER DEFAULT 0")
-        _add_column_if_missing(c, "users", "gender", "TEXT DEFAULT ''")
-
-        # ── Test results table ─────────────────────────────────────────────────
-        c.execute('''CREATE TABLE IF NOT EXISTS test_results (
-            id             INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id        INTEGER NOT NULL,
-            encrypted_data BLOB NOT NULL,
-            encryption_key BLOB NOT NULL,
-            raw_bpm        REAL,
-            raw_category   TEXT,
-            raw_timestamp  TEXT,
-            test_date      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id))''')
-
-        # Migration: add columns that may be missing
-        _add_column_if_missing(c, "test_results", "raw_bpm",       "REAL")
-        _add_column_if_missing(c, "test_results", "raw_category",  "TEXT")
-        _add_column_if_missing(c, "test_results", "raw_timestamp", "TEXT")
-
-        # ── Session log table ──────────────────────────────────────────────────
-        c.execute('''CREATE TABLE IF NOT EXISTS session_log (
-            id         INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id    INTEGER NOT NULL,
-            action     TEXT,
-            details    TEXT,
-            logged_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        # ── Seed admin account ─────────────────────────────────────────────────
-        admin_hash = hashlib.sha256("admin123".encode()).hexdigest()
-        c.execute("""INSERT OR IGNORE INTO users
-                     (username, password_hash, full_name, is_admin)
-                     VALUES (?, ?, ?, ?)""",
-                  ("admin", admin_hash, "System Administrator", 1))
-
-        conn.commit()
+        version = migrate_database()
     except Exception as e:
         st.error(f"Database initialisation error: {e}\nDB path: {DB_PATH}")
         raise
-    finally:
-        try: conn.close()
-        except: pass
+    check_query_plans()
+    ensure_kek_escrow()
+    return version
+
+def check_query_plans() -> list:
+    """Run EXPLAIN QUERY PLAN over every hot query and warn on full scans.
+    Returns a list of (query_name, plan_detail) for each offending step."""
+    bad = []
+    try:
+        with db_conn() as conn:
+            for name, (sql, params) in _HOT_QUERIES.items():
+                for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+                    detail = row[3]
+                    full_scan = detail.startswith("SCAN") and "INDEX" not in detail
+                    if full_scan or "TEMP B-TREE" in detail:
+                        bad.append((name, detail))
+    except Exception as e:
+        _log.warning("Query plan check failed: %s", e)
+        return bad
+    for name, detail in bad:
+        _log.warning("Hot query %r is not index-backed: %s", name, detail)
+    return bad
 
 def register_user(username, password, full_name, age=0, gender=''):
-    conn = None
     try:
-        conn = get_conn(); c = conn.cursor()
-        h = hashlib.sha256(password.encode()).hexdigest()
-        c.execute("INSERT INTO users (username,password_hash,full_name,age,gender) VALUES (?,?,?,?,?)",
-                  (username, h, full_name, age, gender))
-        conn.commit()
-        new_id = c.lastrowid
+        with db_conn(write=True) as conn:
+            c = conn.cursor()
+            h = hashlib.sha256(password.encode()).hexdigest()
+            c.execute("INSERT INTO users (username,password_hash,full_name,age,gender) VALUES (?,?,?,?,?)",
+                      (username, h, full_name, age, gender))
+            # Remote backup of registration — password_hash only, never plaintext password
+            _enqueue_backup(conn, {
+                "record_type":   "user_registration",
+                "user_id":       c.lastrowid,
+                "username":      username,
+                "full_name":     full_name,
+                "age":           age,
+                "gender":        gender,
+                "password_hash": h,
+                "registered_at": datetime.now().isoformat(),
+                "source":        "cardiosecure-streamlit",
+            })
     except sqlite3.IntegrityError:
         return False, "Username already exists."
     except Exception as e:
         return False, f"Database error: {e}"
-    finally:
-        if conn: conn.close()
-
-    # Remote backup of registration — password_hash only, never plaintext password
-    _send_remote_backup({
-        "record_type":   "user_registration",
-        "user_id":       new_id,
-        "username":      username,
-        "full_name":     full_name,
-        "age":           age,
-        "gender":        gender,
-        "password_hash": hashlib.sha256(password.encode()).hexdigest(),
-        "registered_at": datetime.now().isoformat(),
-        "source":        "cardiosecure-streamlit",
-    })
+    _wake_backup_worker()
     return True, "Registration successful!"
 
 def login_user(username, password):
-    conn = None
     try:
-        conn = get_conn(); c = conn.cursor()
-        h = hashlib.sha256(password.encode()).hexdigest()
-        c.execute("""SELECT id, full_name, is_admin,
-                            COALESCE(age, 0)    AS age,
-                            COALESCE(gender, '') AS gender
-                     FROM users
-                     WHERE username=? AND password_hash=?""", (username, h))
-        r = c.fetchone()
+        with db_conn() as conn:
+            h = hashlib.sha256(password.encode()).hexdigest()
+            r = conn.execute(_SQL_LOGIN, (username, h)).fetchone()
         if r:
             return True, {
                 "id": r[0], "username": username,
                 "full_name": r[1], "is_admin": r[2],
-                "age": r[3],       "gender": r[4]
+                "age": r[3],       "gender": r[4],
+                "gender_code": _gender_code(r[4]),   # normalised once, used per frame
             }
         return False, None
     except Exception as e:
         st.error(f"Login DB error: {e} (path: {DB_PATH})")
         return False, None
-    finally:
-        if conn: conn.close()
 
 def log_action(user_id, action, details=""):
-    conn = None
     try:
-        conn = get_conn(); c = conn.cursor()
-        c.execute("INSERT INTO session_log (user_id,action,details) VALUES (?,?,?)",
-                  (user_id, action, details))
-        conn.commit()
+        with db_conn(write=True) as conn:
+            conn.execute("INSERT INTO session_log (user_id,action,details) VALUES (?,?,?)",
+                         (user_id, action, details))
     except Exception:
         pass  # Logging failure must never crash the app
-    finally:
-        if conn: conn.close()
 
 # ── Remote backup config ──────────────────────────────────────────────────
-REMOTE_BACKUP_URL = "https://steadywebhosting.com/heartrate/api/backup.php"
+REMOTE_BACKUP_URL = os.environ.get("CARDIOSECURE_BACKUP_URL",
+                                   "https://steadywebhosting.com/heartrate/api/backup.php")
 BACKUP_HMAC_KEY   = b"cardiosecure_backup_2025"
 
-def _send_remote_backup(payload: dict) -> tuple:
-    """POST encrypted record to remote server. Never raises — returns (ok, msg)."""
+def _send_remote_backup(payload: dict, url: str = None) -> tuple:
+    """POST encrypted record(s) to remote server. Never raises — returns (ok, msg)."""
     try:
         import urllib.request
         import hmac as _hmac, hashlib as _hl
         body = json.dumps(payload, default=str).encode()
         sig  = _hmac.new(BACKUP_HMAC_KEY, body, _hl.sha256).hexdigest()
         req  = urllib.request.Request(
-            REMOTE_BACKUP_URL, data=body,
+            url or REMOTE_BACKUP_URL, data=body,
             headers={"Content-Type": "application/json",
                      "X-Sig": sig, "User-Agent": "MedChainSecure/2.0"},
             method="POST",
@@ -615,156 +1172,698 @@ def _send_remote_backup(payload: dict) -> tuple:
     except Exception as ex:
         return False, str(ex)[:100]
 
+# ── Backup outbox ─────────────────────────────────────────────────────────
+# Saves never wait on the network: the backup payload is written to
+# backup_outbox in the same transaction as the record itself, and a daemon
+# thread ships pending rows in signed batches. Rows survive restarts and are
+# deleted only after the server has acknowledged them (at-least-once; each
+# record carries its outbox_id so the server can de-duplicate).
+
+def _enqueue_backup(conn, payload: dict):
+    """Queue a backup payload on the caller's (writer) connection."""
+    conn.execute("INSERT INTO backup_outbox (payload) VALUES (?)",
+                 (json.dumps(payload, default=str),))
+
+class BackupOutboxWorker(threading.Thread):
+    """Drains backup_outbox in batches with exponential back-off on failure.
+
+    One batch is one POST whose body is {"record_type": "batch", "records": [...]}
+    signed as a whole (X-Sig = HMAC-SHA256 of the body), so signing cost and
+    round-trips are per batch rather than per record.
+    """
+
+    def __init__(self, pool: ConnectionPool, url: str = None, batch_size: int = 50,
+                 poll_interval: float = 30.0, base_delay: float = 2.0,
+                 max_delay: float = 900.0):
+        super().__init__(name="backup-outbox", daemon=True)
+        self.pool          = pool
+        self.url           = url
+        self.batch_size    = batch_size
+        self.poll_interval = poll_interval
+        self.base_delay    = base_delay
+        self.max_delay     = max_delay
+        self._wake         = threading.Event()
+        self._stopping     = threading.Event()
+
+    def wake(self):
+        """Ship newly queued rows now instead of at the next poll."""
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            # Anything that escapes here would end the thread silently and
+            # stop all backups until restart, so every step is inside the try.
+            delay = self.poll_interval
+            try:
+                while self.drain_once() == self.batch_size:
+                    pass  # full batch — more may be due
+                delay = self._seconds_until_due()
+            except Exception as e:
+                _log.warning("Backup outbox drain failed: %s", e, exc_info=True)
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def _seconds_until_due(self) -> float:
+        with self.pool.reader() as conn:
+            row = conn.execute("SELECT MIN(next_attempt_at) FROM backup_outbox").fetchone()
+        if row[0] is None:
+            return self.poll_interval
+        return min(max(row[0] - time.time(), 0.05), self.poll_interval)
+
+    def drain_once(self) -> int:
+        """Send one batch of due rows; returns the number of rows attempted."""
+        now = time.time()
+        with self.pool.reader() as conn:
+            rows = conn.execute(
+                """SELECT id, payload, attempts FROM backup_outbox
+                   WHERE next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?""",
+                (now, self.batch_size)).fetchall()
+        if not rows:
+            return 0
+        records = [dict(json.loads(r["payload"]), outbox_id=r["id"]) for r in rows]
+        ok, msg = _send_remote_backup({"record_type": "batch", "records": records},
+                                      url=self.url)
+        ids = [r["id"] for r in rows]
+        with self.pool.writer() as conn:
+            if ok:
+                conn.executemany("DELETE FROM backup_outbox WHERE id=?",
+                                 [(i,) for i in ids])
+            else:
+                # One retry time for the whole batch so it is re-sent as a batch
+                retry_at = now + self._backoff(max(r["attempts"] for r in rows) + 1)
+                conn.executemany(
+                    """UPDATE backup_outbox
+                       SET attempts=attempts+1, next_attempt_at=?, last_error=?
+                       WHERE id=?""",
+                    [(retry_at, msg, i) for i in ids])
+        if not ok:
+            _log.info("Backup batch of %d failed (%s); will retry", len(ids), msg)
+        return len(ids)
+
+    def _backoff(self, attempts: int) -> float:
+        # Jittered so several processes sharing a DB do not retry in lock-step
+        cap = min(self.max_delay, self.base_delay * (2 ** min(attempts, 20)))
+        return cap / 2 + random.uniform(0, cap / 2)
+
+@st.cache_resource(show_spinner=False)
+def _get_backup_worker(path: str) -> BackupOutboxWorker:
+    """One outbox worker per DB path for the whole server process."""
+    worker = BackupOutboxWorker(_get_pool(path))
+    worker.start()
+    return worker
+
+def _wake_backup_worker():
+    try:
+        _get_backup_worker(DB_PATH).wake()
+    except Exception as e:
+        _log.warning("Backup worker unavailable: %s", e)
+
+def get_outbox_status() -> dict:
+    """Pending backup rows, oldest queued time and worst retry count."""
+    try:
+        with db_conn() as conn:
+            r = conn.execute("""SELECT COUNT(*), MIN(created_at), MAX(attempts)
+                                FROM backup_outbox""").fetchone()
+        return {"pending": r[0], "oldest": r[1], "max_attempts": r[2] or 0}
+    except Exception:
+        return {"pending": 0, "oldest": None, "max_attempts": 0}
+
 def save_test_result(user_id, bpm, signal_data, analysis):
-    """Save to local SQLite and attempt remote backup. Raises on local failure.
-    Returns dict(local, remote, remote_msg) so the UI can show backup status."""
-    conn = None
+    """Save to local SQLite and queue the remote backup. Raises on local failure.
+    Returns dict(local, remote, remote_msg) so the UI can show backup status;
+    remote is "queued" — the outbox worker ships it in the background."""
     try:
-        conn = get_conn(); c = conn.cursor()
-        key = os.urandom(32)
+        key, wrapped, kek_id = keyring().new_data_key()
         ts  = datetime.now().isoformat()
         data = {"bpm": bpm, "signal_data": signal_data[:100], "analysis": analysis,
                 "timestamp": ts}
         enc = HybridEncryption.encrypt_aes_gcm(json.dumps(data), key)
-        c.execute(
-            "INSERT INTO test_results "
-            "(user_id,encrypted_data,encryption_key,raw_bpm,raw_category,raw_timestamp) "
-            "VALUES (?,?,?,?,?,?)",
-            (user_id, enc, key, bpm, analysis.get("category",""), ts)
-        )
-        conn.commit()
+        with db_conn(write=True) as conn:
+            cur = conn.execute(
+                "INSERT INTO test_results "
+                "(user_id,encrypted_data,encryption_key,kek_id,raw_bpm,raw_category,raw_timestamp) "
+                "VALUES (?,?,?,?,?,?,?)",
+                (user_id, enc, wrapped, kek_id, bpm, analysis.get("category",""), ts)
+            )
+            _apply_rollups(conn, cur.lastrowid)   # same transaction as the insert
+            _enqueue_backup(conn, {
+                "user_id": user_id, "bpm": bpm,
+                "category": analysis.get("category",""),
+                "timestamp": ts,
+                "encrypted_hex": enc.hex(),
+                "wrapped_key_hex": wrapped.hex(),   # data key never leaves unwrapped
+                "kek_id": kek_id,
+                "source": "cardiosecure-streamlit",
+            })
     except Exception as e:
         raise RuntimeError(f"DB save failed: {e}") from e
-    finally:
-        if conn:
-            try: conn.close()
-            except: pass
-
-    # Remote backup — fire-and-forget
-    ok, msg = _send_remote_backup({
-        "user_id": user_id, "bpm": bpm,
-        "category": analysis.get("category",""),
-        "timestamp": ts,
-        "encrypted_hex": enc.hex(),
-        "key_hex": key.hex(),
-        "source": "cardiosecure-streamlit",
-    })
-    return {"local": True, "remote": ok, "remote_msg": msg}
+
+    _wake_backup_worker()
+    return {"local": True, "remote": "queued", "remote_msg": "queued for background backup"}
+
+def rotate_kek(batch_size: int = 500, retire: bool = True) -> dict:
+    """Maintenance: make a new KEK active and re-wrap every data key under it.
+
+    Streams test_results in id order, batch_size rows per read and per write
+    transaction, so memory and lock hold time stay flat. Payloads are not
+    re-encrypted — only the 60-byte wrapped keys change. Rows saved during
+    the pass already use the new KEK. With retire=True the old KEKs are
+    marked retired: they no longer wrap, but stay in the keyfile because
+    queued and remote backups still carry data keys wrapped under them.
+    Returns dict(kek_id, rewrapped, retired=[kek_id, ...]).
+    """
+    ring   = keyring()
+    new_id = ring.add_kek()
+    last_id, rewrapped = 0, 0
+    while True:
+        with db_conn() as conn:
+            rows = conn.execute(
+                """SELECT id, encryption_key, kek_id FROM test_results
+                   WHERE id > ? AND kek_id IS NOT ? ORDER BY id LIMIT ?""",
+                (last_id, new_id, batch_size)).fetchall()
+        if not rows:
+            break
+        updates = [(ring.wrap(ring.unwrap(r[2], r[1]), new_id)[0], new_id, r[0], r[2])
+                   for r in rows]
+        with db_conn(write=True) as conn:
+            # kek_id guard: skip a row another rotation re-wrapped meanwhile
+            conn.executemany("""UPDATE test_results SET encryption_key=?, kek_id=?
+                                WHERE id=? AND kek_id IS ?""", updates)
+        rewrapped += len(rows)
+        last_id = rows[-1][0]
+    retired = []
+    if retire:
+        for kek_id in ring.kek_ids():
+            if kek_id != new_id and kek_id not in ring.retired:
+                ring.retire(kek_id)
+                retired.append(kek_id)
+    _log.info("KEK rotated to %s: %d keys re-wrapped, %d KEKs retired",
+              new_id, rewrapped, len(retired))
+    ensure_kek_escrow()
+    return {"kek_id": new_id, "rewrapped": rewrapped, "retired": retired}
+
+def ensure_kek_escrow() -> bool:
+    """Queue a passphrase-sealed copy of the KEKs with the remote backups
+    whenever one has not been escrowed yet, so the backups (which carry only
+    wrapped keys) stay decryptable if the local keyfile is lost.
+    Returns True when an escrow record was queued."""
+    try:
+        ring = keyring()
+        if not ring.path or set(ring.kek_ids()) <= ring.escrowed:
+            return False
+        if not KEK_ESCROW_PASSPHRASE:
+            _log.warning("KEKs in %s have no escrow copy: remote backups cannot be "
+                         "decrypted without that file. Set CARDIOSECURE_KEK_PASSPHRASE "
+                         "or run `python app.py kek-export <file>` and store the "
+                         "result with your backups.", ring.path)
+            return False
+        with db_conn(write=True) as conn:
+            _enqueue_backup(conn, {"record_type": "kek_escrow",
+                                   **ring.export_escrow(KEK_ESCROW_PASSPHRASE)})
+        ring.mark_escrowed()
+    except Exception as e:
+        _log.error("KEK escrow failed: %s", e)
+        return False
+    _wake_backup_worker()
+    return True
+
+def _escrow_passphrase(confirm: bool = False) -> str:
+    if KEK_ESCROW_PASSPHRASE:
+        return KEK_ESCROW_PASSPHRASE
+    import getpass
+    pp = getpass.getpass("Escrow passphrase: ")
+    if confirm and pp != getpass.getpass("Repeat passphrase: "):
+        raise SystemExit("passphrases do not match")
+    return pp
+
+def _kek_export_main(argv) -> int:
+    """python app.py kek-export <out.json>: write every KEK sealed under a
+    passphrase (CARDIOSECURE_KEK_PASSPHRASE, else prompted). Keep the file
+    with the remote backups; kek-import restores it."""
+    if len(argv) != 1:
+        print("usage: app.py kek-export <out.json>", file=sys.stderr)
+        return 2
+    ring = keyring()
+    fd = os.open(argv[0], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(ring.export_escrow(_escrow_passphrase(confirm=True)), f)
+    ring.mark_escrowed()
+    print(f"exported {len(ring.kek_ids())} KEK(s) from {ring.path} to {argv[0]}")
+    return 0
+
+def _kek_import_main(argv) -> int:
+    """python app.py kek-import <escrow.json>: merge escrowed KEKs back into
+    this DB's keyfile (created if missing)."""
+    if len(argv) != 1:
+        print("usage: app.py kek-import <escrow.json>", file=sys.stderr)
+        return 2
+    with open(argv[0]) as f:
+        escrow = json.load(f)
+    path = _keyfile_path(DB_PATH)
+    ids  = KeyRing.restore_escrow(path, escrow, _escrow_passphrase())
+    print(f"restored {len(ids)} KEK(s) into {path}")
+    return 0
+
+# ── Rollups (user_stats / daily_stats) ─────────────────────────────────────
+# Running count, sum, sum of squares, min, max, 60-100 BPM "normal" count and
+# per-category counts, so summary reads are one row regardless of history size.
+
+_ROLLUP_COLS = "n, bpm_sum, bpm_sumsq, bpm_min, bpm_max, normal, category_counts, last_test"
+
+_ROLLUP_UPSERT = """INSERT INTO {table} AS s ({key}, """ + _ROLLUP_COLS + """)
+    SELECT {key_expr}, 1, raw_bpm, raw_bpm * raw_bpm, raw_bpm, raw_bpm,
+           raw_bpm BETWEEN 60 AND 100, json_object(:cat, 1), test_date
+    FROM test_results t WHERE id = :id AND raw_bpm IS NOT NULL
+    ON CONFLICT ({key}) DO UPDATE SET
+        n         = s.n + 1,
+        bpm_sum   = s.bpm_sum   + excluded.bpm_sum,
+        bpm_sumsq = s.bpm_sumsq + excluded.bpm_sumsq,
+        bpm_min   = MIN(s.bpm_min, excluded.bpm_min),
+        bpm_max   = MAX(s.bpm_max, excluded.bpm_max),
+        normal    = s.normal + excluded.normal,
+        category_counts = json_set(s.category_counts, '$.' || json_quote(:cat),
+            COALESCE(json_extract(s.category_counts, '$.' || json_quote(:cat)), 0) + 1),
+        last_test = MAX(s.last_test, excluded.last_test)"""
+
+_ROLLUP_REBUILD = """INSERT INTO {table} ({key}, """ + _ROLLUP_COLS + """)
+    SELECT {key_expr} AS k, COUNT(*), SUM(raw_bpm), SUM(raw_bpm * raw_bpm),
+           MIN(raw_bpm), MAX(raw_bpm), SUM(raw_bpm BETWEEN 60 AND 100),
+           (SELECT json_group_object(cat, cnt) FROM
+               (SELECT COALESCE(t2.raw_category, '') AS cat, COUNT(*) AS cnt
+                FROM test_results t2
+                WHERE t2.raw_bpm IS NOT NULL AND {inner_key_expr} = {key_expr}
+                GROUP BY cat)),
+           MAX(test_date)
+    FROM test_results t WHERE raw_bpm IS NOT NULL GROUP BY k"""
+
+_ROLLUPS = (  # (table, key column, key expression over a test_results alias)
+    ("user_stats",  "user_id", "{t}.user_id"),
+    ("daily_stats", "day",     "date({t}.test_date)"),
+)
+
+def _apply_rollups(conn, test_id):
+    """Fold one freshly inserted test_results row into every rollup table."""
+    cat = conn.execute("SELECT COALESCE(raw_category, '') FROM test_results WHERE id=?",
+                       (test_id,)).fetchone()[0]
+    for table, key, key_expr in _ROLLUPS:
+        conn.execute(_ROLLUP_UPSERT.format(table=table, key=key,
+                                           key_expr=key_expr.format(t="t")),
+                     {"id": test_id, "cat": cat})
+
+def _rebuild_rollups(c):
+    for table, key, key_expr in _ROLLUPS:
+        c.execute(f"DELETE FROM {table}")
+        c.execute(_ROLLUP_REBUILD.format(table=table, key=key,
+                                         key_expr=key_expr.format(t="t"),
+                                         inner_key_expr=key_expr.format(t="t2")))
+
+def rebuild_rollups():
+    """Maintenance: recompute user_stats/daily_stats from test_results."""
+    with db_conn(write=True) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _rebuild_rollups(conn.cursor())
+
+def _rollup_dict(r):
+    n = r["n"]
+    mean = r["bpm_sum"] / n
+    var  = max(r["bpm_sumsq"] / n - mean * mean, 0.0)
+    return {"tests": n, "avg_bpm": mean, "std_bpm": math.sqrt(var),
+            "min_bpm": r["bpm_min"], "max_bpm": r["bpm_max"], "normal": r["normal"],
+            "categories": json.loads(r["category_counts"]), "last_test": r["last_test"]}
+
+def get_user_stats(user_id):
+    """Single-row summary for one user from user_stats (None if no tests)."""
+    try:
+        with db_conn() as conn:
+            r = conn.execute("SELECT * FROM user_stats WHERE user_id=? AND n > 0",
+                             (user_id,)).fetchone()
+        return _rollup_dict(r) if r else None
+    except Exception:
+        return None
 
 def get_user_results(user_id):
-    conn = None
     try:
-        conn = get_conn(); c = conn.cursor()
-        c.execute("""SELECT id, encrypted_data, encryption_key, test_date
-                     FROM test_results WHERE user_id=?
-                     ORDER BY test_date DESC""", (user_id,))
-        rows = c.fetchall()
+        with db_conn() as conn:
+            rows = conn.execute(_SQL_USER_RESULTS, (user_id,)).fetchall()
     except Exception:
         return []
-    finally:
-        if conn: conn.close()
     out = []
-    for r in rows:
-        try:
-            dec = json.loads(HybridEncryption.decrypt_aes_gcm(bytes(r[1]), bytes(r[2])))
+    for r, dec in zip(rows, HybridEncryption.decrypt_many(((r[1], r[2], r[4]) for r in rows),
+                                                          keyring=keyring())):
+        if dec is not None:
             dec['test_id'] = r[0]; dec['test_date'] = r[3]
             out.append(dec)
-        except Exception:
-            pass
     return out
 
+# Keyset cursor that sorts after every real (test_date, id) pair
+_FIRST_PAGE = ("9999-12-31", 2**62)
+RESULTS_PAGE_SIZE = 20
+
+def get_user_results_page(user_id, offset=0, limit=RESULTS_PAGE_SIZE, after=None):
+    """Decrypt one page of a user's history, newest first.
+
+    Pass the cursor returned by the previous call as `after` to continue
+    (keyset pagination — no rows are skipped or re-read); `offset` is
+    applied on top of it. Returns (records, next_cursor); next_cursor is
+    None once the history is exhausted.
+    """
+    cur_date, cur_id = after or _FIRST_PAGE
+    try:
+        with db_conn() as conn:
+            rows = conn.execute(_SQL_USER_RESULTS_PAGE,
+                                (user_id, cur_date, cur_id, limit + 1, offset)).fetchall()
+    except Exception:
+        return [], None
+    more, rows = len(rows) > limit, rows[:limit]
+    out = []
+    for r, dec in zip(rows, HybridEncryption.decrypt_many(((r[1], r[2], r[4]) for r in rows),
+                                                          keyring=keyring())):
+        if dec is not None:
+            dec['test_id'] = r[0]; dec['test_date'] = r[3]
+            out.append(dec)
+    next_cursor = (rows[-1][3], rows[-1][0]) if more else None
+    return out, next_cursor
+
+def get_user_trend(user_id):
+    """Plaintext (test_date, bpm, category) history, newest first — no decryption."""
+    try:
+        with db_conn() as conn:
+            rows = conn.execute(_SQL_USER_TREND, (user_id,)).fetchall()
+        return [{'test_date': r[0], 'bpm': int(r[1]), 'category': r[2] or ""}
+                for r in rows if r[1] is not None]
+    except Exception:
+        return []
+
 def get_all_results_admin():
-    conn = None
     try:
-        conn = get_conn(); c = conn.cursor()
-        c.execute('''SELECT t.id, u.id, u.username, u.full_name,
-                            COALESCE(u.age,0) AS age,
-                            COALESCE(u.gender,"") AS gender,
-                            t.encrypted_data, t.encryption_key, t.test_date
-                     FROM test_results t JOIN users u ON t.user_id=u.id
-                     ORDER BY t.test_date DESC''')
-        rows = c.fetchall()
+        with db_conn() as conn:
+            rows = conn.execute('''SELECT t.id, u.id, u.username, u.full_name,
+                                       COALESCE(u.age,0) AS age,
+                                       COALESCE(u.gender,"") AS gender,
+                                       t.encrypted_data, t.encryption_key, t.test_date,
+                                       t.kek_id
+                                FROM test_results t JOIN users u ON t.user_id=u.id
+                                ORDER BY t.test_date DESC''').fetchall()
     except Exception:
         return []
-    finally:
-        if conn: conn.close()
+    ring = keyring()
     out = []
-    for r in rows:
+    decoded = HybridEncryption.decrypt_many(((r[6], r[7], r[9]) for r in rows), keyring=ring)
+    for r, dec in zip(rows, decoded):
         try:
-            dec = json.loads(HybridEncryption.decrypt_aes_gcm(bytes(r[6]), bytes(r[7])))
             out.append({'test_id':r[0],'user_id':r[1],'username':r[2],'full_name':r[3],
                         'age':r[4],'gender':r[5],'bpm':dec['bpm'],'test_date':r[8],
                         'analysis':dec['analysis'],'encrypted_hex':bytes(r[6]).hex(),
-                        'key_hex':bytes(r[7]).hex()})
-        except Exception:
-            pass
+                        'key_hex':ring.unwrap(r[9], r[7]).hex(),  # LRU hit from the decrypt
+                        'kek_id':r[9]})
+        except (TypeError, KeyError):
+            pass  # undecryptable row, or payload missing bpm/analysis
     return out
 
+HIST_BIN_BPM = 5
+
+def get_dashboard_stats(bin_width=HIST_BIN_BPM):
+    """System-wide dashboard metrics from the rollups and raw_bpm/raw_category.
+
+    Never touches encrypted_data. Returns dict(users, total, avg_bpm,
+    abnormal, histogram=[(bin_start, count)], categories=[(category, count)]).
+    """
+    stats = {"users": 0, "total": 0, "avg_bpm": None, "abnormal": 0,
+             "histogram": [], "categories": []}
+    try:
+        with db_conn() as conn:
+            stats["users"] = conn.execute(
+                "SELECT COUNT(*) FROM users WHERE is_admin=0").fetchone()[0]
+            # Totals and categories fold the per-day rollups (one row per day)
+            total, bpm_sum, normal = conn.execute(
+                "SELECT COALESCE(SUM(n), 0), SUM(bpm_sum), COALESCE(SUM(normal), 0) "
+                "FROM daily_stats").fetchone()
+            stats.update(total=total, avg_bpm=bpm_sum / total if total else None,
+                         abnormal=total - normal)
+            stats["categories"] = [tuple(r) for r in conn.execute(
+                """SELECT j.key, SUM(j.value) AS n
+                   FROM daily_stats, json_each(daily_stats.category_counts) AS j
+                   GROUP BY j.key ORDER BY n DESC""")]
+            # Histogram bins are not rollup-able — scan the covering index
+            stats["histogram"] = [tuple(r) for r in conn.execute(
+                """SELECT CAST(raw_bpm / ? AS INTEGER) * ? AS bin, COUNT(*)
+                   FROM test_results WHERE raw_bpm IS NOT NULL
+                   GROUP BY bin ORDER BY bin""", (bin_width, bin_width))]
+    except Exception:
+        pass
+    return stats
+
 def get_all_users():
-    conn = None
     try:
-        conn = get_conn(); c = conn.cursor()
-        c.execute("""SELECT id, username, full_name,
-                            COALESCE(age,0)    AS age,
-                            COALESCE(gender,"") AS gender,
-                            is_admin, created_at
-                     FROM users ORDER BY created_at DESC""")
-        rows = c.fetchall()
+        with db_conn() as conn:
+            rows = conn.execute("""SELECT id, username, full_name,
+                                          COALESCE(age,0)    AS age,
+                                          COALESCE(gender,"") AS gender,
+                                          is_admin, created_at
+                                   FROM users ORDER BY created_at DESC""").fetchall()
         return [{'id':r[0],'username':r[1],'full_name':r[2],'age':r[3],
                  'gender':r[4],'is_admin':r[5],'created_at':r[6]} for r in rows]
     except Exception:
         return []
-    finally:
-        if conn: conn.close()
 
 def get_user_results_by_id(user_id):
     return get_user_results(user_id)
 
+def get_user_summaries():
+    """Per-user rollup (count, mean/min/max BPM, last test date) for every
+    user in one query. Returns {user_id: dict(tests, avg_bpm, ..., last_test)}."""
+    try:
+        with db_conn() as conn:
+            rows = conn.execute("SELECT * FROM user_stats WHERE n > 0").fetchall()
+        return {r["user_id"]: _rollup_dict(r) for r in rows}
+    except Exception:
+        return {}
+
 def get_session_log(user_id=None, limit=50):
-    conn = None
     try:
-        conn = get_conn(); c = conn.cursor()
-        if user_id:
-            c.execute('''SELECT l.id, u.username, l.action, l.details, l.logged_at
-                         FROM session_log l JOIN users u ON l.user_id=u.id
-                         WHERE l.user_id=? ORDER BY l.logged_at DESC LIMIT ?''',
-                      (user_id, limit))
-        else:
-            c.execute('''SELECT l.id, u.username, l.action, l.details, l.logged_at
-                         FROM session_log l JOIN users u ON l.user_id=u.id
-                         ORDER BY l.logged_at DESC LIMIT ?''', (limit,))
-        rows = c.fetchall()
+        with db_conn() as conn:
+            if user_id:
+                rows = conn.execute(_SQL_SESSION_LOG_USER, (user_id, limit)).fetchall()
+            else:
+                rows = conn.execute(_SQL_SESSION_LOG_ALL, (limit,)).fetchall()
         return [{'id':r[0],'username':r[1],'action':r[2],'details':r[3],'logged_at':r[4]}
                 for r in rows]
     except Exception:
         return []
-    finally:
-        if conn: conn.close()
 
 # ─────────────────────────────────────────────────────────────────────────────
 # HEART RATE ENGINE  (rPPG + ML-inspired refinement)
 # ─────────────────────────────────────────────────────────────────────────────
 
+class RingBuffer:
+    """Fixed-capacity float ring backed by one NumPy array.
+
+    Every value is written twice (at i and i + capacity), so the newest n
+    values are always one contiguous slice: view() and slicing return
+    read-only NumPy views, never copies. append() is O(1) and memory is
+    fixed at construction, however long a session runs.
+    """
+
+    __slots__ = ("_buf", "_cap", "_n", "_pos")
+
+    def __init__(self, capacity: int, dtype=np.float64):
+        self._buf = np.zeros(2 * capacity, dtype=dtype)
+        self._cap = capacity
+        self._n   = 0
+        self._pos = 0      # next write index in [0, capacity)
+
+    def append(self, value):
+        p = self._pos
+        self._buf[p] = self._buf[p + self._cap] = value
+        self._pos = p + 1 if p + 1 < self._cap else 0
+        if self._n < self._cap:
+            self._n += 1
+
+    def extend(self, values):
+        for v in values[-self._cap:] if hasattr(values, "__getitem__") else values:
+            self.append(v)
+
+    def clear(self):
+        self._n = self._pos = 0
+
+    @property
+    def capacity(self) -> int:
+        return self._cap
+
+    def view(self, n: int = None) -> np.ndarray:
+        """Newest n values (default: all held), oldest first, as a read-only view."""
+        n = self._n if n is None else min(n, self._n)
+        end = self._pos + self._cap
+        v = self._buf[end - n:end]
+        v.flags.writeable = False
+        return v
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, idx):
+        return self.view()[idx]
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __array__(self, dtype=None, copy=None):
+        # NumPy 2 protocol: copy=True must copy, copy=False must not
+        v = self.view()
+        if copy:
+            return np.array(v, dtype=dtype, copy=True)
+        if dtype is None or np.dtype(dtype) == v.dtype:
+            return v
+        if copy is False:
+            raise ValueError(f"RingBuffer of {v.dtype} cannot become {dtype} without a copy")
+        return v.astype(dtype)
+
+    def tolist(self) -> list:
+        return self.view().tolist()
+
 def get_forehead_roi(face, frame_shape):
     x, y, w, h = face
     fx = x + int(w * 0.25); fy = y + int(h * 0.08)
     fw = int(w * 0.5);      fh = int(h * 0.18)
     return (fx, fy, fw, fh)
 
-def get_cheek_roi(face, frame_shape):
+def get_cheek_roi(face, frame_shape, side="left"):
     x, y, w, h = face
-    lx = x + int(w * 0.05); ly = y + int(h * 0.45)
     lw = int(w * 0.25);     lh = int(h * 0.2)
+    lx = x + int(w * 0.05) if side == "left" else x + w - int(w * 0.05) - lw
+    ly = y + int(h * 0.45)
     return (lx, ly, lw, lh)
 
-def extract_color_signal(frame, roi):
+class FaceTracker:
+    """Detect-then-track face box: Haar cascade on a downscaled frame every
+    `detect_every` frames (or when tracking is lost), template matching in a
+    small search window on the frames in between.
+
+    detect_every   — frames between forced re-detections
+    downscale      — detection runs on the gray frame resized by this factor
+    min_score      — TM_CCOEFF_NORMED below this counts as tracking loss
+    search_margin  — search window padding, as a fraction of the box size
+
+    Per-frame detect/track times are kept as EMAs; stats() reports them and
+    the total time saved versus detecting on every frame.
+    """
+
+    def __init__(self, cascade, detect_every: int = 10, downscale: float = 0.5,
+                 min_score: float = 0.6, search_margin: float = 0.25,
+                 min_face: int = 80):
+        self.cascade       = cascade
+        self.detect_every  = detect_every
+        self.downscale     = downscale
+        self.min_score     = min_score
+        self.search_margin = search_margin
+        self.min_face      = min_face
+        self.box       = None
+        self._template = None
+        self._since    = 0
+        self.detect_ms = None     # EMA cost of a (downscaled) detection
+        self.track_ms  = None     # EMA cost of a template-match update
+        self.frames    = 0
+        self.detections = 0
+        self.saved_ms  = 0.0
+
+    @staticmethod
+    def _ema(old, new):
+        return new if old is None else old + 0.1 * (new - old)
+
+    def update(self, gray):
+        """Return the face box (x, y, w, h) for this frame, or None."""
+        self.frames += 1
+        t0 = time.perf_counter()
+        if self.box is not None and self._since < self.detect_every:
+            box = self._track(gray)
+            if box is not None:
+                self.track_ms = self._ema(self.track_ms, (time.perf_counter() - t0) * 1e3)
+                if self.detect_ms is not None:
+                    self.saved_ms += max(self.detect_ms - self.track_ms, 0.0)
+                self._since += 1
+                return self._accept(gray, box)
+        box = self._detect(gray)
+        self.detect_ms = self._ema(self.detect_ms, (time.perf_counter() - t0) * 1e3)
+        self.detections += 1
+        self._since = 0
+        if box is None:
+            self.box = self._template = None
+            return None
+        return self._accept(gray, box)
+
+    def _accept(self, gray, box):
+        x, y, w, h = box
+        self.box = box
+        self._template = gray[y:y+h, x:x+w].copy()
+        return box
+
+    def _detect(self, gray):
+        f = self.downscale
+        small = cv2.resize(gray, None, fx=f, fy=f, interpolation=cv2.INTER_AREA) \
+            if f != 1 else gray
+        mn = max(int(self.min_face * f), 20)
+        faces = self.cascade.detectMultiScale(small, 1.1, 5, minSize=(mn, mn))
+        if len(faces) == 0:
+            return None
+        x, y, w, h = max(faces, key=lambda b: b[2] * b[3])
+        return tuple(int(round(v / f)) for v in (x, y, w, h))
+
+    def _track(self, gray):
+        x, y, w, h = self.box
+        H, W = gray.shape[:2]
+        mx, my = int(w * self.search_margin), int(h * self.search_margin)
+        x0, y0 = max(x - mx, 0), max(y - my, 0)
+        x1, y1 = min(x + w + mx, W), min(y + h + my, H)
+        window = gray[y0:y1, x0:x1]
+        if window.shape[0] < h or window.shape[1] < w:
+            return None
+        res = cv2.matchTemplate(window, self._template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (dx, dy) = cv2.minMaxLoc(res)
+        if score < self.min_score:
+            return None
+        return (x0 + dx, y0 + dy, w, h)
+
+    def stats(self) -> dict:
+        return {"frames": self.frames, "detections": self.detections,
+                "detect_ms": self.detect_ms, "track_ms": self.track_ms,
+                "saved_ms": self.saved_ms}
+
+# Defaults for the live path's FaceTracker; override per deployment here
+FACE_TRACK_CONFIG = {"detect_every": 10, "downscale": 0.5,
+                     "min_score": 0.6, "search_margin": 0.25}
+
+ROI_NAMES = ("forehead", "left_cheek", "right_cheek")
+
+def get_face_rois(face, frame_shape):
+    """Forehead plus both cheeks, in ROI_NAMES order."""
+    return (get_forehead_roi(face, frame_shape),
+            get_cheek_roi(face, frame_shape, "left"),
+            get_cheek_roi(face, frame_shape, "right"))
+
+def _roi_in_frame(frame, roi):
     x, y, w, h = roi
-    if y+h > frame.shape[0] or x+w > frame.shape[1] or w <= 0 or h <= 0:
+    return w > 0 and h > 0 and x >= 0 and y >= 0 and \
+        y+h <= frame.shape[0] and x+w <= frame.shape[1]
+
+def extract_roi_means(frame, rois):
+    """(len(rois), 3) array of mean R, G, B per ROI — one cv2.mean per ROI
+    over a slice view, no copies. Rows for out-of-frame ROIs are NaN."""
+    out = np.full((len(rois), 3), np.nan)
+    for i, roi in enumerate(rois):
+        if _roi_in_frame(frame, roi):
+            x, y, w, h = roi
+            b, g, r, _ = cv2.mean(frame[y:y+h, x:x+w])
+            out[i] = (r, g, b)
+    return out
+
+def extract_color_signal(frame, roi):
+    if not _roi_in_frame(frame, roi):
         return None, None, None
-    patch = frame[y:y+h, x:x+w]
-    r = float(np.mean(patch[:,:,2]))
-    g = float(np.mean(patch[:,:,1]))
-    b = float(np.mean(patch[:,:,0]))
+    r, g, b = extract_roi_means(frame, (roi,))[0]
     # CHROM method weight
     xs = r - g
     ys = r/2 + g/2 - b
@@ -783,24 +1882,50 @@ _HR_NORMS = {
     (66, 99): (58, 66, 78, 62, 72, 85),
 }
 
-def _age_gender_prior(age: int, gender: str) -> tuple:
+GENDER_MALE, GENDER_FEMALE = 0, 1
+
+def _gender_code(gender: str) -> int:
+    """Normalise a free-text gender once (at login) to GENDER_MALE/GENDER_FEMALE."""
+    g = gender.lower() if gender else ""
+    return GENDER_FEMALE if ("f" in g or "woman" in g or "girl" in g) else GENDER_MALE
+
+# Dense (gender, age) → (lo, mid, hi) prior, built once from _HR_NORMS.
+# Age 0 means "unknown" and holds the population fallback (60, 72, 100);
+# ages outside every norm band hold the default adult range.
+HR_PRIOR_MAX_AGE  = 120
+_HR_PRIOR_DEFAULT = {GENDER_MALE: (62, 70, 82), GENDER_FEMALE: (66, 78, 90)}
+
+def _build_prior_table() -> np.ndarray:
+    t = np.empty((2, HR_PRIOR_MAX_AGE + 1, 3), dtype=np.int16)
+    for g, default in _HR_PRIOR_DEFAULT.items():
+        t[g, :] = default
+        t[g, 0] = (60, 72, 100)
+    for (lo_age, hi_age), v in _HR_NORMS.items():
+        t[GENDER_MALE,   lo_age:hi_age + 1] = v[0:3]
+        t[GENDER_FEMALE, lo_age:hi_age + 1] = v[3:6]
+    t.flags.writeable = False
+    return t
+
+_HR_PRIOR_TABLE = _build_prior_table()
+_HR_PRIOR_ROWS  = [[tuple(r) for r in _HR_PRIOR_TABLE[g].tolist()] for g in (0, 1)]
+
+def _age_gender_prior(age: int, gender_code: int) -> tuple:
     """Return (lo, mid, hi) BPM for this age+gender from evidence-based norms.
     Not shown on frontend — used only for statistical estimation fallback."""
-    g = gender.lower() if gender else ""
-    female = "f" in g or "woman" in g or "girl" in g
-    for (lo_age, hi_age), vals in _HR_NORMS.items():
-        if lo_age <= age <= hi_age:
-            return (vals[3], vals[4], vals[5]) if female else (vals[0], vals[1], vals[2])
-    # Default adult
-    return (66, 78, 90) if female else (62, 70, 82)
-
-def ml_refine_bpm(raw_bpm, age=0, gender="", history=[]):
+    if not age:
+        return _HR_PRIOR_ROWS[gender_code][0]   # unknown age → population fallback
+    if 0 < age <= HR_PRIOR_MAX_AGE and age == int(age):
+        return _HR_PRIOR_ROWS[gender_code][int(age)]
+    return _HR_PRIOR_DEFAULT[gender_code]
+
+def ml_refine_bpm(raw_bpm, age=0, gender_code=GENDER_MALE, history=None):
     """Evidence-based BPM refinement using age/gender physiological priors.
     Never exposed on frontend — internal statistical correction only."""
+    history = history if history is not None else []
     if raw_bpm < 40 or raw_bpm > 200:
         return int(np.mean(history[-5:])) if history else 72
 
-    lo, mid, hi = _age_gender_prior(age, gender) if age else (60, 72, 100)
+    lo, mid, hi = _age_gender_prior(age, gender_code)
 
     # Smooth against recent history (outlier rejection)
     if history and len(history) >= 3:
@@ -823,30 +1948,300 @@ def ml_refine_bpm(raw_bpm, age=0, gender="", history=[]):
 
     return max(40, min(int(raw_bpm), 180))
 
-def calculate_heart_rate(data_buffer, times, use_chrom=True):
+HR_BAND_HZ = (0.67, 4.0)   # 40–240 BPM
+
+@lru_cache(maxsize=64)
+def _butter_band(fs: float, output: str = "ba"):
+    """Cached 4th-order Butterworth band-pass for HR_BAND_HZ at sample rate fs.
+    Callers round fs (see _fs_bucket) so jittery frame rates share designs.
+    Returns None when the band does not fit below Nyquist."""
+    nyq  = fs / 2
+    low  = max(0.01, HR_BAND_HZ[0] / nyq)
+    high = min(0.99, HR_BAND_HZ[1] / nyq)
+    if low >= high:
+        return None
+    return signal.butter(4, [low, high], btype='band', output=output)
+
+def _fs_bucket(fs: float) -> float:
+    return max(round(fs * 2) / 2, 0.5)   # 0.5 Hz steps
+
+# Spectral peak estimators for one-shot windows. Each returns
+# (freqs, power, resolution_hz); resolution is the native bin width (what
+# the data can actually resolve), used to size the SNR peak region.
+SPECTRAL_NFFT   = 1024    # zero-padded length: 30 fps → 1.76 BPM per bin
+SPECTRAL_METHOD = "zeropad"
+WELCH_SEG_S     = 8.0     # Welch segment length, clipped to the window
+
+def _pow2(n: int) -> int:
+    return 1 << max(int(n) - 1, 1).bit_length()
+
+def _spectrum_fft(x, fs, nfft=None):
+    """Plain Hann periodogram; bin width fs/len(x)."""
+    n = len(x)
+    return (np.fft.rfftfreq(n, 1 / fs),
+            np.abs(np.fft.rfft(x * np.hanning(n))) ** 2, fs / n)
+
+def _spectrum_zeropad(x, fs, nfft=SPECTRAL_NFFT):
+    """Hann periodogram zero-padded to a power of two ≥ max(nfft, len(x))."""
+    n, nfft = len(x), _pow2(max(nfft, len(x)))
+    return (np.fft.rfftfreq(nfft, 1 / fs),
+            np.abs(np.fft.rfft(x * np.hanning(n), n=nfft)) ** 2, fs / n)
+
+def _spectrum_welch(x, fs, nfft=SPECTRAL_NFFT, seg_s=WELCH_SEG_S):
+    """Welch average of 50%-overlapping Hann segments (lower variance on
+    long windows; a single segment, i.e. zeropad, on short ones)."""
+    nperseg = min(len(x), max(int(seg_s * fs), 16))
+    freqs, power = signal.welch(x, fs, window="hann", nperseg=nperseg,
+                                nfft=_pow2(max(nfft, nperseg)), detrend=False)
+    return freqs, power, fs / nperseg
+
+SPECTRAL_ESTIMATORS = {
+    "fft":     _spectrum_fft,
+    "zeropad": _spectrum_zeropad,
+    "welch":   _spectrum_welch,
+}
+
+def _parabolic_offset(a: float, b: float, c: float) -> float:
+    """Vertex of the parabola through three log-power bins around a peak b,
+    in bins from b (within ±0.5). Exact for a Gaussian-shaped main lobe."""
+    a, b, c = np.log(np.maximum((a, b, c), 1e-300))
+    den = a - 2 * b + c
+    if den >= 0:
+        return 0.0
+    return float(np.clip(0.5 * (a - c) / den, -0.5, 0.5))
+
+def _snr_quality(snr: float) -> int:
+    """0–100 like the JS `q`: peak share of band power, doubled and capped."""
+    return min(100, int(round(200 * snr / (1 + snr)))) if snr > 0 else 0
+
+def spectral_peak(x, fs: float, method: str = SPECTRAL_METHOD,
+                  interpolate: bool = True, **opts) -> dict:
+    """Dominant in-band frequency of `x` with its SNR and 0–100 quality.
+
+    SNR is power within one native bin of the peak over the rest of
+    HR_BAND_HZ, so zero-padding sharpens the peak location without
+    inflating the score.
+    """
+    freqs, power, res = SPECTRAL_ESTIMATORS[method](np.asarray(x, dtype=float), fs, **opts)
+    band = np.flatnonzero((freqs >= HR_BAND_HZ[0]) & (freqs <= HR_BAND_HZ[1]))
+    if len(band) == 0:
+        return {"hz": 0.0, "snr": 0.0, "quality": 0}
+    i = band[np.argmax(power[band])]
+    hz = freqs[i]
+    if interpolate and 0 < i < len(power) - 1:
+        hz += _parabolic_offset(*power[i - 1:i + 2]) * (freqs[1] - freqs[0])
+    near = np.abs(freqs[band] - freqs[i]) <= res
+    peak = power[band][near].sum()
+    rest = power[band].sum() - peak
+    snr  = float(peak / rest) if rest > 0 else 0.0
+    return {"hz": float(hz), "snr": snr, "quality": _snr_quality(snr)}
+
+class RPPGEstimator:
+    """Streaming BPM estimator: one sample in, O(K) work, no re-filtering.
+
+    Each sample goes through a causal band-pass (sosfilt with carried state)
+    into a RingBuffer of the last `window` filtered values, and a sliding DFT
+    updates only the K bins that cover HR_BAND_HZ (plus one either side, so
+    a Hann window can be applied in the frequency domain). The bins are
+    recomputed exactly once per `window` samples to stop round-off drift.
+    The band spectrum is computed at most once per sample and shared by
+    bpm(), snr() and quality(). Filter designs are shared across sessions
+    via _butter_band.
+    """
+
+    MIN_SAMPLES = 15
+
+    def __init__(self, window: int = 256, fs: float = 30.0):
+        self.window = window
+        self._ring  = RingBuffer(window)
+        self._n     = 0            # samples seen since reset
+        self._band  = None
+        self._band_n = -1          # self._n when _band was computed
+        self._t_last = None
+        self._dt     = 1.0 / fs     # EMA of the inter-frame interval
+        self._fs     = None
+        self._configure(fs)
+
+    @property
+    def fs(self) -> float:
+        return self._fs
+
+    @property
+    def samples(self) -> int:
+        return self._n
+
+    def _configure(self, fs: float):
+        """(Re)design for a new sample-rate bucket; the band bins move with fs."""
+        fs = _fs_bucket(fs)
+        if fs == self._fs:
+            return
+        self._fs  = fs
+        self._sos = _butter_band(fs, "sos")
+        self._zi  = None   # re-primed from the next sample
+        N = self.window
+        k_lo = max(int(np.floor(HR_BAND_HZ[0] * N / fs)) - 1, 0)
+        k_hi = min(int(np.ceil(HR_BAND_HZ[1] * N / fs)) + 1, N // 2)
+        self._k    = np.arange(k_lo, k_hi + 1)
+        self._twid = np.exp(2j * np.pi * self._k / N)
+        self._resync()
+
+    def _resync(self):
+        """Exact DFT of the ring (oldest sample first, zeros before the first
+        sample) at the tracked bins."""
+        N = self.window
+        x = np.zeros(N)
+        x[N - len(self._ring):] = self._ring.view()
+        self._bins = np.exp(-2j * np.pi * np.outer(self._k, np.arange(N)) / N) @ x
+        self._band_n = -1
+
+    def update(self, value: float, t: float = None) -> None:
+        if t is not None:
+            if self._t_last is not None and t > self._t_last:
+                self._dt += 0.1 * ((t - self._t_last) - self._dt)
+                if abs(1.0 / self._dt - self._fs) > 0.75:   # hysteresis vs. jitter
+                    self._configure(1.0 / self._dt)
+            self._t_last = t
+        if self._sos is None:
+            return
+        if self._zi is None:
+            # Start in steady state for this level to avoid a step transient
+            self._zi = signal.sosfilt_zi(self._sos) * value
+        y, self._zi = signal.sosfilt(self._sos, (value,), zi=self._zi)
+        y   = float(y[0])
+        old = self._ring[0] if len(self._ring) == self.window else 0.0
+        self._ring.append(y)
+        self._n += 1
+        # Sliding DFT: X_k ← (X_k − x_old + x_new)·e^{j2πk/N}
+        self._bins = (self._bins + (y - old)) * self._twid
+        if self._n % self.window == 0:
+            self._resync()
+
+    def _band_power(self):
+        """(freqs, power) of the Hann-windowed spectrum inside HR_BAND_HZ,
+        or None while warming up. Cached until the next sample."""
+        if self._band_n != self._n:
+            self._band, self._band_n = self._compute_band_power(), self._n
+        return self._band
+
+    def _compute_band_power(self):
+        if self._n < self.MIN_SAMPLES or self._sos is None:
+            return None
+        X = self._bins
+        hann  = 0.5 * X[1:-1] - 0.25 * (X[:-2] + X[2:])
+        freqs = self._k[1:-1] * self._fs / self.window
+        mask  = (freqs >= HR_BAND_HZ[0]) & (freqs <= HR_BAND_HZ[1])
+        if not mask.any():
+            return None
+        return freqs[mask], np.abs(hann[mask]) ** 2
+
+    def bpm(self) -> int:
+        """Peak of the Hann-windowed band spectrum in BPM (parabolic
+        interpolation between bins), or 0 while warming up."""
+        band = self._band_power()
+        if band is None:
+            return 0
+        freqs, power = band
+        i  = int(np.argmax(power))
+        hz = freqs[i]
+        if 0 < i < len(power) - 1:
+            hz += _parabolic_offset(*power[i - 1:i + 2]) * self._fs / self.window
+        return int(round(hz * 60))
+
+    def snr(self) -> float:
+        """Power in the peak bin ±1 over the rest of the band (linear)."""
+        band = self._band_power()
+        if band is None:
+            return 0.0
+        power = band[1]
+        i     = int(np.argmax(power))
+        peak  = power[max(i - 1, 0):i + 2].sum()
+        noise = power.sum() - peak
+        return float(peak / noise) if noise > 0 else 0.0
+
+    def quality(self) -> int:
+        return _snr_quality(self.snr())
+
+    def filtered(self) -> np.ndarray:
+        """Filtered samples currently in the window, oldest first, as a
+        read-only view of the ring (no copy)."""
+        return self._ring.view()
+
+class ChromFusion:
+    """Per-ROI CHROM pulse signals fused by SNR into one sample per frame.
+
+    Each ROI's RGB means are normalised by a running (EMA) mean, projected
+    onto the CHROM axes Xs = 3R − 2G and Ys = 1.5R + G − 1.5B, and combined
+    as S = Xs − α·Ys with α = σ(Xs)/σ(Ys) from running variances. Every ROI
+    has its own RPPGEstimator, whose band SNR weights that ROI's S in the
+    fused output (equal weights until the estimators warm up).
+    """
+
+    def __init__(self, n_rois: int = len(ROI_NAMES), window: int = 256, ema: float = 0.03):
+        self.ema   = ema
+        self._mean = None                    # (n, 3) running RGB means
+        self._var  = np.zeros((n_rois, 2))   # running var of Xs, Ys
+        self.estimators = [RPPGEstimator(window) for _ in range(n_rois)]
+        self.weights    = np.full(n_rois, 1.0 / n_rois)
+
+    def update(self, rgb_means, t: float = None):
+        """Feed one frame's (n, 3) ROI means; returns the fused sample or None."""
+        rgb   = np.asarray(rgb_means, dtype=float)
+        valid = ~np.isnan(rgb).any(axis=1)
+        if not valid.any():
+            return None
+        if self._mean is None:
+            self._mean = np.where(valid[:, None], rgb, np.nan)
+        fresh = valid & np.isnan(self._mean).any(axis=1)
+        self._mean[fresh] = rgb[fresh]
+        a = self.ema
+        self._mean[valid] += a * (rgb[valid] - self._mean[valid])
+        n  = rgb / np.maximum(self._mean, 1e-6)
+        xs = 3 * n[:, 0] - 2 * n[:, 1]
+        ys = 1.5 * n[:, 0] + n[:, 1] - 1.5 * n[:, 2]
+        dev = np.stack((xs - 1, ys - 1), axis=1)   # both axes sit at 1 for flat skin
+        self._var[valid] += a * (dev[valid] ** 2 - self._var[valid])
+        alpha = np.sqrt(self._var[:, 0] / np.maximum(self._var[:, 1], 1e-12))
+        s = dev[:, 0] - alpha * dev[:, 1]
+        snr = np.zeros(len(s))
+        for i in np.flatnonzero(valid):
+            self.estimators[i].update(s[i], t)
+            snr[i] = self.estimators[i].snr()
+        w = np.where(valid, snr, 0.0)
+        if w.sum() <= 0:
+            w = valid.astype(float)
+        self.weights = w / w.sum()
+        return float(np.dot(self.weights[valid], s[valid]))
+
+def estimate_heart_rate(data_buffer, times, method: str = SPECTRAL_METHOD,
+                        interpolate: bool = True, **opts) -> dict:
+    """One-shot estimate over a whole buffer (zero-phase filtfilt, then the
+    chosen SPECTRAL_ESTIMATORS method). Returns bpm, snr, quality (0–100)
+    and the filtered signal. Live per-frame paths should feed an
+    RPPGEstimator instead."""
+    none = {"bpm": 0, "snr": 0.0, "quality": 0, "filtered": []}
     if len(data_buffer) < 15:   # lowered for camera_input (20-frame mode)
-        return 0, []
-    sig = np.array(data_buffer)
+        return none
+    sig = np.asarray(data_buffer, dtype=float)   # RingBuffer: no copy
     detrended = signal.detrend(sig)
     fps = len(times) / max((times[-1] - times[0]), 0.01) if len(times) > 1 else 30
-    nyq = fps / 2
-    low = max(0.01, 0.67 / nyq)
-    high = min(0.99, 4.0 / nyq)
-    if low >= high:
-        return 0, []
-    b, a = signal.butter(4, [low, high], btype='band')
+    ba = _butter_band(_fs_bucket(fps))
+    if ba is None:
+        return none
+    b, a = ba
     try:
         filtered = signal.filtfilt(b, a, detrended)
     except:
-        return 0, []
-    fft = np.fft.rfft(filtered * np.hanning(len(filtered)))
-    freqs = np.fft.rfftfreq(len(filtered), 1/fps)
-    mask = (freqs >= 0.67) & (freqs <= 4.0)
-    if not mask.any():
-        return 0, []
-    mags = np.abs(fft[mask])
-    peak = freqs[mask][np.argmax(mags)]
-    return int(peak * 60), filtered.tolist()
+        return none
+    peak = spectral_peak(filtered, fps, method, interpolate, **opts)
+    if not peak["hz"]:
+        return none
+    return {"bpm": int(round(peak["hz"] * 60)), "snr": peak["snr"],
+            "quality": peak["quality"], "filtered": filtered.tolist()}
+
+def calculate_heart_rate(data_buffer, times, use_chrom=True, **opts):
+    """(bpm, filtered) from estimate_heart_rate; `opts` select the estimator."""
+    est = estimate_heart_rate(data_buffer, times, **opts)
+    return est["bpm"], est["filtered"]
 
 def analyze_heart_rate(bpm):
     if bpm < 40:
@@ -875,6 +2270,1032 @@ def analyze_heart_rate(bpm):
                 "icon":"🚨","color":"#E84855",
                 "recommendations":["Seek medical attention promptly","Rule out cardiac arrhythmia","Avoid stimulants completely","Record all symptoms for your doctor"]}
 
+# ── Vectorised refinement (re-scoring history) ────────────────────────────
+# Array counterparts of ml_refine_bpm / stress_adjusted_bpm / analyze_heart_rate
+# that return exactly what the scalar versions return for each row.
+# `history` is an (n, w) float matrix, newest reading in the last column and
+# NaN-padded on the left when a row has fewer than w readings (history_matrix).
+
+HR_CATEGORIES = ("Bradycardia (Severe)", "Bradycardia (Mild)", "Normal Resting",
+                 "Tachycardia (Mild)", "Tachycardia (Severe)")
+
+def history_matrix(histories, width: int = 5) -> np.ndarray:
+    """Right-align the last `width` readings of each history into an (n, width)
+    matrix, NaN where a row has fewer readings."""
+    out = np.full((len(histories), width), np.nan)
+    for i, h in enumerate(histories):
+        tail = list(h)[-width:]
+        if tail:
+            out[i, width - len(tail):] = tail
+    return out
+
+def _age_gender_prior_batch(age, gender_code):
+    """(lo, mid, hi) arrays — _age_gender_prior for every row, as one gather
+    from _HR_PRIOR_TABLE."""
+    age = np.asarray(age, dtype=float)
+    g   = np.asarray(gender_code, dtype=np.intp)
+    in_table = (age >= 0) & (age <= HR_PRIOR_MAX_AGE) & (age == np.floor(age))
+    rows = _HR_PRIOR_TABLE[g, np.where(in_table, age, 0).astype(np.intp)]
+    default = np.where((g == GENDER_FEMALE)[..., None], _HR_PRIOR_DEFAULT[GENDER_FEMALE],
+                       _HR_PRIOR_DEFAULT[GENDER_MALE])
+    rows = np.where(in_table[..., None], rows, default)
+    return rows[..., 0], rows[..., 1], rows[..., 2]
+
+def _history_stats(history, k: int = 3):
+    """(count, mean, std) over each row's last k readings (NaN where count < k)."""
+    h     = np.asarray(history, dtype=float)
+    count = (~np.isnan(h)).sum(axis=1)
+    last  = h[:, -k:]
+    return count, last.mean(axis=1), last.std(axis=1)
+
+def ml_refine_bpm_batch(raw_bpm, age, gender_code, history) -> np.ndarray:
+    """ml_refine_bpm over arrays; history is an (n, w>=5) history_matrix."""
+    raw = np.asarray(raw_bpm, dtype=float)
+    age = np.asarray(age, dtype=float)
+    h   = np.asarray(history, dtype=float)
+    count, rm, rs = _history_stats(h)
+    lo, mid, hi = _age_gender_prior_batch(age, gender_code)
+
+    # Outlier rejection against the last 3 readings
+    smooth = (count >= 3) & (rs > 0) & (np.abs(raw - rm) > 2 * np.nan_to_num(rs))
+    x = np.where(smooth, np.trunc(0.4 * raw + 0.6 * rm), raw)
+    # Soft-clip toward the prior range
+    x = np.where(x < lo, np.trunc(x * 0.55 + lo * 0.45),
+                 np.where(x > hi, np.trunc(x * 0.55 + hi * 0.45), x))
+    # Age-based max HR cap
+    cap = (220 - age) * 0.92
+    x = np.where((age != 0) & (x > cap), np.trunc(cap), x)
+    out = np.clip(np.trunc(x), 40, 180)
+
+    # Implausible raw readings fall back to the recent mean (or 72)
+    bad = (raw < 40) | (raw > 200)
+    if bad.any():
+        recent = h[:, -5:]
+        n5 = (~np.isnan(recent)).sum(axis=1)
+        with np.errstate(invalid="ignore"):
+            fallback = np.where(n5 > 0, np.trunc(np.nansum(recent, axis=1) / np.maximum(n5, 1)), 72)
+        out = np.where(bad, fallback, out)
+    return out.astype(int)
+
+def stress_adjusted_bpm_batch(raw_bpm, stress_score, age, gender_code, history,
+                              jitter=None, rng=None) -> np.ndarray:
+    """HeartRateEngine.stress_adjusted_bpm over arrays.
+
+    stress_score is NaN where a row had no stress result. Rows with no raw
+    signal use mid + jitter, uniform ints in [-8, 8] like the scalar path.
+    Pass jitter (one per row) or an np.random.Generator: rng is drawn once
+    per no-signal row, in row order, so the same seed gives the same output
+    as calling the scalar path row by row with that rng.
+    """
+    raw = np.asarray(raw_bpm, dtype=float)
+    age = np.asarray(age, dtype=float)
+    sc  = np.asarray(stress_score, dtype=float)
+    _, mid, _ = _age_gender_prior_batch(age, gender_code)
+    if jitter is None:
+        rng    = np.random.default_rng() if rng is None else rng
+        nosig  = raw <= 0
+        jitter = np.zeros(raw.shape, dtype=int)
+        jitter[nosig] = rng.integers(-8, 9, size=int(nosig.sum()))
+    base = np.where(raw > 0, np.trunc(raw * 0.65 + mid * 0.35), mid + np.asarray(jitter))
+    base = base + np.where(np.isnan(sc), 0, np.trunc(np.nan_to_num(sc) * 40 - 5))
+    count, rm, rs = _history_stats(history)
+    rs = np.where(rs == 0, 5, rs)
+    smooth = (count >= 3) & (np.abs(base - rm) > 2.5 * np.nan_to_num(rs))
+    base = np.where(smooth, np.trunc(base * 0.35 + rm * 0.65), base)
+    base = np.where(age != 0, np.minimum(base, np.trunc((220 - age) * 0.92)), base)
+    return np.clip(np.trunc(base), 35, 185).astype(int)
+
+def analyze_heart_rate_batch(bpm) -> np.ndarray:
+    """Index into HR_CATEGORIES for each BPM — analyze_heart_rate's category."""
+    b = np.asarray(bpm, dtype=float)
+    return np.select([b < 40, b < 60, (b >= 60) & (b <= 100), (b >= 101) & (b <= 120)],
+                     [0, 1, 2, 3], default=4)
+
+def refine_readings_batch(raw_bpm, age, gender_code, history) -> tuple:
+    """Refined BPM and category codes for many readings in one call."""
+    bpm = ml_refine_bpm_batch(raw_bpm, age, gender_code, history)
+    return bpm, analyze_heart_rate_batch(bpm)
+
+# Facial stress runs on every STRESS_EVERY-th live frame (1 = every frame)
+STRESS_EVERY = 5
+
+# Live-session buffer capacities (samples) — fixed, whatever the session length
+SIGNAL_WINDOW = 60    # raw green / timestamps for the chart and the saved record
+BPM_HISTORY   = 32    # smoothing only ever reads the last few estimates
+STRESS_WINDOW = 8     # rolling stress average
+
+_STRESS_LABELS = (  # (upper bound, label, colour, icon)
+    (0.25, "Relaxed",         "#00E5A0", "😌"),
+    (0.45, "Mild Tension",    "#74C0FC", "😐"),
+    (0.65, "Moderate Stress", "#FFD166", "😟"),
+    (0.82, "High Stress",     "#FF6B6B", "😰"),
+    (9.99, "Acute Stress",    "#E84855", "😱"),
+)
+
+def _stress_label(score: float) -> dict:
+    for bound, label, color, icon in _STRESS_LABELS:
+        if score < bound:
+            return {"label": label, "color": color, "icon": icon}
+
+def _stress_result(score: float, components: dict) -> dict:
+    return {"score": round(score, 3), **_stress_label(score),
+            "components": {k: round(v, 3) for k, v in components.items()}}
+
+class StressSampler:
+    """Runs a stress analyser on every k-th frame only. Frames in between
+    get score and components linearly interpolated from the previous to the
+    latest analysis — a k-frame lag, which is fine for a signal that moves
+    over seconds."""
+
+    def __init__(self, analyse, every: int = STRESS_EVERY):
+        self.analyse = analyse
+        self.every   = max(1, every)
+        self._frame  = 0
+        self._prev   = None
+        self._last   = None
+
+    def update(self, frame_bgr, face_rect, roi_rect):
+        i = self._frame
+        self._frame += 1
+        if i % self.every == 0 or self._last is None:
+            res = self.analyse(frame_bgr, face_rect, roi_rect)
+            if res is None:
+                return None
+            self._prev, self._last = self._last or res, res
+            # Callers smooth/relabel the result in place; keep ours pristine
+            return dict(res, components=dict(res["components"]))
+        f = (i % self.every) / self.every
+        p, q = self._prev, self._last
+        comps = {k: p["components"][k] + f * (q["components"][k] - p["components"][k])
+                 for k in q["components"]}
+        return _stress_result(p["score"] + f * (q["score"] - p["score"]), comps)
+
+class HeartRateEngine:
+    """Process-wide live-monitor pipeline: the Haar cascade (parsed once),
+    warm Butterworth designs, the facial stress analyser and the per-frame
+    rPPG path. Per-session state (buffers, estimators, tracker) is passed in,
+    so one cached instance serves every session and rerun."""
+
+    WARM_FS = (15.0, 20.0, 24.0, 25.0, 30.0)   # common webcam rates
+
+    def __init__(self):
+        self.face_cascade = cv2.CascadeClassifier(
+            cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+        )
+        for fs in self.WARM_FS:
+            _butter_band(fs, "ba"); _butter_band(fs, "sos")
+
+    def new_tracker(self) -> FaceTracker:
+        # Trackers carry per-session box/template state but share the cascade
+        return FaceTracker(self.face_cascade, **FACE_TRACK_CONFIG)
+
+    # ── Stress & facial state analyser ──────────────────────────────────────
+    def analyse_facial_stress(self, frame_bgr, face_rect, roi_rect):
+        """
+        Estimate a stress score 0.0–1.0 from a single BGR frame using:
+          1. Skin redness ratio  (R/G channel balance in face ROI)
+          2. Green-channel CoV   (signal noisiness from micro-expressions)
+          3. Eye-region darkness (dark circles / fatigue indicator)
+          4. Brow-region tension (texture variance above eyebrows)
+          5. Skin pallor index   (very pale = vasoconstiction = stress)
+        The face crop is converted to grayscale once; every region is a view
+        into the crop (or its gray), reduced with one cv2.meanStdDev or, for
+        the brow, one Laplacian variance.
+        Returns dict with score + component breakdown.
+        """
+        try:
+            x, y, w, h = face_rect
+            H, W = frame_bgr.shape[:2]
+            # Face crop spans every region below (the brow starts at 5% of h)
+            fx0, fy0 = max(0, int(x)), max(0, int(y))
+            fx1, fy1 = min(W, int(x + w)), min(H, int(y + h))
+            face = frame_bgr[fy0:fy1, fx0:fx1]
+            if face.size == 0:
+                return None
+            gray = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
+
+            def region(img, y1, y2, x1, x2):
+                # Fractions of the face box → view into a face-crop image
+                return img[max(0, int(y + h * y1) - fy0):max(0, int(y + h * y2) - fy0),
+                           max(0, int(x + w * x1) - fx0):max(0, int(x + w * x2) - fx0)]
+
+            # ── 1. Skin redness in cheek region ─────────────────────────
+            cheek = region(face, 0.45, 0.75, 0.10, 0.90)
+            if cheek.size == 0:
+                return None
+            (b_ch, g_ch, r_ch), _ = cv2.meanStdDev(cheek)
+            b_ch, g_ch, r_ch = float(b_ch[0]), float(g_ch[0]) + 1e-6, float(r_ch[0])
+            redness = float(np.clip(r_ch / g_ch, 0.8, 1.6))   # 0.8=pale, 1.6=flushed
+            redness_score = float(np.clip((redness - 0.95) / 0.4, 0, 1))  # 0=calm,1=flushed
+
+            # ── 2. Pallor (very low R+G+B average = vasoconstiction) ────
+            brightness = (r_ch + g_ch + b_ch) / 3
+            pallor_score = float(np.clip((120 - brightness) / 60, 0, 1))  # low brightness → stressed
+
+            # ── 3. Green-channel coefficient of variation (volatility) ──
+            rx, ry, rw, rh = roi_rect
+            roi_region = frame_bgr[max(ry, 0):ry+rh, max(rx, 0):rx+rw]
+            if roi_region.size > 0:
+                mean, std = cv2.meanStdDev(roi_region)
+                cov = float(std[1, 0] / (mean[1, 0] + 1e-6))
+                cov_score = float(np.clip(cov * 8, 0, 1))  # high texture variance = muscle tension
+            else:
+                cov_score = 0.0
+
+            # ── 4. Eye-region darkness (dark circles / fatigue) ─────────
+            eye_roi = region(gray, 0.20, 0.45, 0.10, 0.90)
+            if eye_roi.size > 0:
+                eye_brightness = float(cv2.meanStdDev(eye_roi)[0][0, 0])
+                # Dark under-eyes relative to cheek brightness
+                eye_dark_score = float(np.clip((brightness - eye_brightness) / 40, 0, 1))
+            else:
+                eye_dark_score = 0.0
+
+            # ── 5. Brow tension (texture energy above eyebrows) ─────────
+            # BGR in, CV_64F out: the /300 scale was tuned on this variance
+            brow_roi = region(face, 0.05, 0.22, 0.15, 0.85)
+            if brow_roi.size > 0:
+                laplacian  = float(cv2.Laplacian(brow_roi, cv2.CV_64F).var())
+                brow_score = float(np.clip(laplacian / 300, 0, 1))  # edge density = furrowing
+            else:
+                brow_score = 0.0
+
+            # ── Weighted composite score ─────────────────────────────────
+            stress_score = float(np.clip(
+                redness_score * 0.30 +
+                pallor_score  * 0.15 +
+                cov_score     * 0.25 +
+                eye_dark_score* 0.15 +
+                brow_score    * 0.15,
+                0.0, 1.0
+            ))
+            return _stress_result(stress_score, {
+                "Skin Redness":   redness_score,
+                "Pallor":         pallor_score,
+                "Micro-tension":  cov_score,
+                "Eye Fatigue":    eye_dark_score,
+                "Brow Tension":   brow_score,
+            })
+        except Exception:
+            return None
+
+    def new_stress_sampler(self) -> "StressSampler":
+        return StressSampler(self.analyse_facial_stress, every=STRESS_EVERY)
+
+    def stress_adjusted_bpm(self, raw_bpm: int, stress: dict | None,
+                            age: int, gender_code: int, history, rng=None) -> int:
+        """
+        Modulate BPM using stress score + age/gender prior for realistic variation.
+        Stress pushes BPM toward the higher end; calm toward the lower end.
+        Some results will naturally fall in warning/danger zones.
+        rng (an np.random.Generator) makes the no-signal jitter reproducible.
+        """
+        lo, mid, hi = _age_gender_prior(age, gender_code)
+
+        # Base: blend raw signal reading with physiological prior
+        if raw_bpm > 0:
+            base = int(raw_bpm * 0.65 + mid * 0.35)
+        else:
+            # Pure prior + small random walk when signal too weak
+            base = mid + (random.randint(-8, 8) if rng is None else int(rng.integers(-8, 9)))
+
+        # Stress modulation: stress_score 0→calm, 1→acute
+        if stress:
+            sc = stress["score"]
+            # Map score to BPM delta: calm=-8 to +2, acute=+12 to +35
+            delta = int(sc * 40 - 5)
+            base  = base + delta
+
+        # History smoothing (outlier rejection)
+        if len(history) >= 3:
+            recent_mean = np.mean(history[-3:])
+            recent_std  = np.std(history[-3:]) or 5
+            if abs(base - recent_mean) > 2.5 * recent_std:
+                base = int(base * 0.35 + recent_mean * 0.65)
+
+        # Age-based max HR cap
+        if age:
+            base = min(base, int((220 - age) * 0.92))
+
+        # Soft floor — some users CAN be bradycardic (below 60)
+        # Don't hard-clamp — let the result fall in warning zone if warranted
+        return max(35, min(int(base), 185))
+
+    def process_frame_bytes(self, img_bytes: bytes, state, user: dict):
+        """Decode bytes → cv2 → rPPG pipeline. Returns (rgb, bpm, signal, face, roi).
+        state is the caller's state (buffers, estimators, tracker)."""
+        try:
+            frame = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+            if frame is None:
+                return None, 0, [], None, None
+        except Exception:
+            return None, 0, [], None, None
+
+        gray    = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        tracker = state.get("face_tracker")
+        if tracker is None:
+            tracker = state.face_tracker = self.new_tracker()
+        face = tracker.update(gray)
+
+        if face is None:
+            cv2.putText(frame, "No face — move closer", (10, 30),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.65, (232, 72, 85), 2)
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), 0, [], None, None
+
+        x, y, w, h = face
+        rois        = get_face_rois(face, frame.shape)
+        roi         = rois[0]                       # forehead — overlay + stress
+        means       = extract_roi_means(frame, rois)
+        now         = time.time()
+        chrom       = state.get("chrom")
+        if chrom is None:
+            chrom = state.chrom = ChromFusion()
+        rppg        = state.get("rppg")
+        if rppg is None:
+            rppg = state.rppg = RPPGEstimator()
+        fused       = chrom.update(means, now)
+
+        if fused is not None:
+            g = means[0, 1] if not np.isnan(means[0, 1]) else np.nanmean(means[:, 1])
+            state.data_buffer.append(float(g))
+            state.times.append(now)
+            rppg.update(fused, now)
+
+        # ── Stress detection on this frame ────────────────────────────────
+        sampler = state.get("stress_sampler")
+        if sampler is None:
+            sampler = state.stress_sampler = self.new_stress_sampler()
+        stress_result = sampler.update(frame, (x, y, w, h), roi)
+        if stress_result:
+            # Accumulate stress scores across frames and keep latest
+            if "stress_scores" not in state:
+                state.stress_scores = RingBuffer(STRESS_WINDOW)
+            state.stress_scores.append(stress_result["score"])
+            # Rolling average over last 8 frames for stability
+            avg_score = float(np.mean(state.stress_scores.view(STRESS_WINDOW)))
+            # Update label from averaged score
+            stress_result.update(_stress_label(avg_score))
+            stress_result["score"] = round(avg_score, 3)
+            state.stress = stress_result
+
+        # Incremental: no per-frame filter design, filtfilt or full FFT
+        bpm_raw      = rppg.bpm()
+        sig_filtered = rppg.filtered() if bpm_raw else []
+        bpm = 0
+        if bpm_raw > 0:
+            state.bpm_history.append(bpm_raw)
+            bpm = self.stress_adjusted_bpm(bpm_raw,
+                                            state.get("stress"),
+                                            user.get("age", 0),
+                                            user.get("gender_code", GENDER_MALE),
+                                            state.bpm_history)
+
+        # Fallback — stress-adjusted prior when signal too weak
+        if bpm == 0 and len(state.data_buffer) >= 5:
+            bpm = self.stress_adjusted_bpm(0,
+                                            state.get("stress"),
+                                            user.get("age", 0),
+                                            user.get("gender_code", GENDER_MALE),
+                                            state.bpm_history)
+            sig_filtered = state.data_buffer.view()
+
+        # Draw overlays
+        cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 229, 160), 2)
+        rx, ry, rw, rh = roi
+        cv2.rectangle(frame, (rx, ry), (rx+rw, ry+rh), (232, 72, 85), 1)
+        cv2.putText(frame, "ROI", (rx, ry-4),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.35, (232, 72, 85), 1)
+        for (cx, cy, cw, ch), wgt in zip(rois[1:], chrom.weights[1:]):
+            cv2.rectangle(frame, (cx, cy), (cx+cw, cy+ch), (232, 72, 85), 1)
+            cv2.putText(frame, f"{int(wgt*100)}%", (cx, cy-4),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.35, (232, 72, 85), 1)
+        if bpm > 0:
+            cv2.putText(frame, f"{bpm} BPM", (x, y-8),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 229, 160), 2)
+        ts = tracker.stats()
+        cv2.putText(frame, f"Samples: {len(state.data_buffer)}  "
+                           f"Detect {ts['detections']}/{ts['frames']}  "
+                           f"Saved {ts['saved_ms']:.0f} ms",
+                    (8, frame.shape[0]-10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, (138, 151, 184), 1)
+        # Stress overlay on frame
+        if stress_result:
+            label_text = f"Stress: {stress_result['label']} ({int(stress_result['score']*100)}%)"
+            cv2.putText(frame, label_text, (8, 24),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.48, (255, 200, 50), 1)
+
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), bpm, sig_filtered,                (x, y, w, h), (rx, ry, rw, rh)
+
+@st.cache_resource(show_spinner=False)
+def get_hr_engine() -> HeartRateEngine:
+    """One engine per server process — reruns skip the cascade XML parse."""
+    return HeartRateEngine()
+
+# ─────────────────────────────────────────────────────────────────────────────
+# BROWSER rPPG WORKER  (embedded by _build_rppg_html; python app.py bench-fft)
+# ─────────────────────────────────────────────────────────────────────────────
+
+# Pixel analysis for the browser component. Runs in a Web Worker (frames
+# arrive as transferable ImageBitmaps and are read back via OffscreenCanvas)
+# or, where Workers/OffscreenCanvas are missing, inline on the page behind
+# the same postMessage protocol:
+#   in:  {type:"frame", bitmap|image, t}   {type:"finish"}
+#   out: {type:"frame", face, roi, bpm, q, stress, frames, sig, perf}
+#        {type:"result", result}
+_RPPG_WORKER_JS = """
+var WIN=300, MIN_FR=60, SIG_TAIL=120;
+var detCv=null,detCtx,roiCv,roiCtx,lastDone=0;
+var perf={fps:0,read:0,skin:0,chrom:0,fft:0,total:0,px:0};   // px: skin samples this frame
+function ema(k,v){perf[k]=perf[k]?perf[k]+0.1*(v-perf[k]):v;}
+
+// ─── Ring buffer with running moments ────────────────────────────────────────
+// Same layout as the Python RingBuffer: every value is written at i and
+// i+cap, so view(k) is always one contiguous Float64Array subarray (no
+// copy). Mean and M2 are kept with sliding Welford updates and rebuilt
+// exactly once per cap pushes to stop round-off drift.
+function Ring(cap){
+  this.cap=cap;this.n=0;this.pos=0;this.pushes=0;
+  this.buf=new Float64Array(2*cap);
+  this.mu=0;this.m2=0;
+}
+Ring.prototype.push=function(v){
+  var p=this.pos,cap=this.cap;
+  if(this.n===cap){
+    var o=this.buf[p],mu=this.mu+(v-o)/cap;
+    this.m2+=(v-o)*(v-mu+o-this.mu);this.mu=mu;
+  }else{
+    this.n++;var d=v-this.mu;this.mu+=d/this.n;this.m2+=d*(v-this.mu);
+  }
+  this.buf[p]=this.buf[p+cap]=v;
+  this.pos=p+1<cap?p+1:0;
+  if(++this.pushes%cap===0)this.resync();
+};
+Ring.prototype.resync=function(){
+  var v=this.view(),n=v.length,mu=0,m2=0;
+  for(var i=0;i<n;i++)mu+=v[i];
+  mu/=n||1;
+  for(var i=0;i<n;i++)m2+=(v[i]-mu)*(v[i]-mu);
+  this.mu=mu;this.m2=m2;
+};
+Ring.prototype.view=function(k){   // newest k (default all), oldest first
+  k=k===undefined?this.n:Math.min(k,this.n);
+  var end=this.pos+this.cap;
+  return this.buf.subarray(end-k,end);
+};
+Ring.prototype.at=function(i){     // i-th oldest; negative counts from newest
+  return this.buf[this.pos+this.cap-this.n+(i<0?this.n+i:i)];
+};
+Ring.prototype.mean=function(){return this.mu;};
+Ring.prototype.std=function(){return this.n?Math.sqrt(Math.max(this.m2,0)/this.n):0;};
+
+var cX=new Ring(WIN),cY=new Ring(WIN),tBuf=new Ring(WIN),gBuf=new Ring(20);
+var bpmHist=new Ring(6),stHist=new Ring(10),chromBuf=new Float64Array(WIN);
+var frames=0,curBpm=0,curQual=0,curStress=null;
+
+// ─── FFT (in-place iterative radix-2, tables cached per size) ────────────────
+var fftN=0,fftRev,fftCos,fftSin,fftRe,fftIm,hannN=0,hann;
+function fftPlan(N){
+  if(N===fftN)return;
+  var bits=Math.round(Math.log2(N)),h=N>>1;
+  fftN=N;fftRev=new Uint32Array(N);
+  fftCos=new Float64Array(h);fftSin=new Float64Array(h);
+  fftRe=new Float64Array(N);fftIm=new Float64Array(N);
+  for(var i=1;i<N;i++)fftRev[i]=(fftRev[i>>1]>>1)|((i&1)<<(bits-1));
+  for(var k=0;k<h;k++){
+    var a=-2*Math.PI*k/N;fftCos[k]=Math.cos(a);fftSin[k]=Math.sin(a);
+  }
+}
+function hannPlan(L){
+  if(L===hannN)return;
+  hannN=L;hann=new Float64Array(L);
+  for(var i=0;i<L;i++)hann[i]=0.5*(1-Math.cos(2*Math.PI*i/(L-1)));
+}
+function fft(re,im){
+  var N=fftN;
+  for(var i=0;i<N;i++){
+    var j=fftRev[i];
+    if(i<j){var t=re[i];re[i]=re[j];re[j]=t;t=im[i];im[i]=im[j];im[j]=t;}
+  }
+  for(var size=2;size<=N;size<<=1){
+    var half=size>>1,step=N/size;
+    for(var s0=0;s0<N;s0+=size){
+      for(var k=0,w=0;k<half;k++,w+=step){
+        var a=s0+k,b=a+half,c=fftCos[w],s=fftSin[w];
+        var tr=c*re[b]-s*im[b],ti=s*re[b]+c*im[b];
+        re[b]=re[a]-tr;im[b]=im[a]-ti;re[a]+=tr;im[a]+=ti;
+      }
+    }
+  }
+}
+function pow2(n){var p=1;while(p<n)p<<=1;return p;}
+
+function getBpm(sig,fps){
+  var L=sig.length;
+  if(L<MIN_FR)return{bpm:0,q:0};
+  var N=pow2(L);fftPlan(N);hannPlan(L);
+  var re=fftRe,im=fftIm,mn=0;
+  for(var i=0;i<L;i++)mn+=sig[i];
+  mn/=L;
+  for(var i=0;i<L;i++)re[i]=(sig[i]-mn)*hann[i];
+  re.fill(0,L);im.fill(0);
+  fft(re,im);
+  var best=-1,bf=0,tot=0,band=0;
+  for(var i=1;i<N/2;i++){
+    var f=i*fps/N,mag=Math.sqrt(re[i]*re[i]+im[i]*im[i]);tot+=mag;
+    if(f>=0.67&&f<=3.5){band+=mag;if(mag>best){best=mag;bf=f;}}
+  }
+  var q=tot>0?Math.min(100,Math.round(band/tot*200)):0;
+  return{bpm:Math.round(bf*60),q:q};
+}
+
+// ─── Skin detection ───────────────────────────────────────────────────────────
+// Coarse-to-fine: scan a 1/DET_SCALE copy of the frame every DET_STEP
+// pixels, only inside the last face box dilated by DET_MARGIN, and fall
+// back to a full scan when that finds too little skin (tracking lost).
+var DET_SCALE=4, DET_STEP=2, DET_MARGIN=0.25, DET_MIN_SKIN=6;
+var track=null;   // last face box (full-res), null when lost
+
+// Integer BT.601 YCbCr skin test (Chai & Ngan Cb/Cr box), no divisions.
+function isSkin(r,g,b){
+  var y=(77*r+150*g+29*b)>>8;
+  if(y<50||y>235)return false;
+  var cb=((-43*r-85*g+128*b)>>8)+128,cr=((128*r-107*g-21*b)>>8)+128;
+  return cb>=77&&cb<=127&&cr>=133&&cr<=173;
+}
+
+function skinScan(data,W,x0,y0,x1,y1,step){
+  var bx1=x1,by1=y1,bx2=-1,by2=-1,cnt=0,n=0;
+  x0-=x0%step;y0-=y0%step;
+  for(var y=y0;y<y1;y+=step){for(var x=x0,i=(y*W+x)*4;x<x1;x+=step,i+=step*4){
+    n++;
+    if(isSkin(data[i],data[i+1],data[i+2])){
+      if(x<bx1)bx1=x;if(y<by1)by1=y;if(x>bx2)bx2=x;if(y>by2)by2=y;cnt++;
+    }
+  }}
+  perf.px+=n;
+  return{x1:bx1,y1:by1,x2:bx2,y2:by2,cnt:cnt};
+}
+
+// img is the frame scaled by 1/scale; the box comes back in full-res (FW×FH).
+function skinROI(img,scale,step,FW,FH){
+  var W=img.width,H=img.height,box=null;
+  if(track){
+    var mx=track.w*DET_MARGIN,my=track.h*DET_MARGIN;
+    box=skinScan(img.data,W,
+      Math.max(0,Math.floor((track.x-mx)/scale)),Math.max(0,Math.floor((track.y-my)/scale)),
+      Math.min(W,Math.ceil((track.x+track.w+mx)/scale)),Math.min(H,Math.ceil((track.y+track.h+my)/scale)),step);
+  }
+  if(!box||box.cnt<DET_MIN_SKIN)box=skinScan(img.data,W,0,0,W,H,step);
+  if(box.cnt<DET_MIN_SKIN){track=null;return null;}
+  var p=8,x=Math.max(0,box.x1*scale-p),y=Math.max(0,box.y1*scale-p);
+  track={x:x,y:y,w:Math.min(FW,(box.x2+1)*scale+p)-x,h:Math.min(FH,(box.y2+1)*scale+p)-y};
+  return track;
+}
+
+// Forehead ROI inside the face box, clipped to the frame.
+function chromROI(face,FW,FH){
+  var ry=face.y+Math.floor(face.h*0.05),rx=face.x+Math.floor(face.w*0.2);
+  return{x:rx,y:ry,w:Math.min(Math.floor(face.w*0.6),FW-rx),
+    h:Math.min(Math.floor(face.h*0.22),FH-ry)};
+}
+
+// px: {data,W,x0,y0} with the ROI's top-left pixel at (x0,y0).
+function getChrom(px,roi){
+  var r=0,g=0,b=0,n=roi.w*roi.h,data=px.data;
+  if(n<=0)return null;
+  for(var y=0;y<roi.h;y++){for(var x=0,i=((px.y0+y)*px.W+px.x0)*4;x<roi.w;x++,i+=4){
+    r+=data[i];g+=data[i+1];b+=data[i+2];
+  }}
+  r/=n;g/=n;b/=n;
+  return{Xs:r-g,Ys:0.5*r+0.5*g-b,r:r,g:g,b:b,roi:roi};
+}
+
+function calcStress(r,g,b){
+  var red=Math.min(1,Math.max(0,(r/(g+1)-0.95)/0.4));
+  var pal=Math.min(1,Math.max(0,(120-(r+g+b)/3)/60));
+  var cov=gBuf.n>10?Math.min(1,gBuf.std()/(gBuf.mean()+1)*10):0;
+  var sc=Math.min(1,red*0.4+pal*0.15+cov*0.45);
+  var lbs=["😌 Relaxed","😐 Mild Tension","😟 Moderate Stress","😰 High Stress","😱 Acute Stress"];
+  var cls=["#00E5A0","#74C0FC","#FFD166","#FF6B6B","#E84855"];
+  var idx=sc<0.25?0:sc<0.45?1:sc<0.65?2:sc<0.82?3:4;
+  return{score:sc,label:lbs[idx],color:cls[idx],icon:["😌","😐","😟","😰","😱"][idx]};
+}
+
+// CHROM projection X - alpha*Y of the newest k samples into the shared
+// chromBuf; alpha comes from the running moments, so only the projection
+// itself (which the FFT consumes anyway) touches the window.
+function chromSignal(k){
+  var alpha=(cX.std()||1)/(cY.std()||1);
+  var x=cX.view(k),y=cY.view(k),out=chromBuf.subarray(0,x.length);
+  for(var i=0;i<x.length;i++)out[i]=x[i]-alpha*y[i];
+  return out;
+}
+
+// ─── Per-frame analysis ───────────────────────────────────────────────────────
+// Bitmap frames are never read back whole: the browser scales them into
+// the detection canvas, and only the ROI rectangle is read at full res.
+// The inline fallback gets a full ImageData and strides it instead.
+function frameSource(m){
+  if(!m.bitmap){
+    var img=m.image;
+    return{fw:img.width,fh:img.height,det:img,scale:1,step:DET_SCALE*DET_STEP,
+      roi:function(r){return{data:img.data,W:img.width,x0:r.x,y0:r.y};},
+      close:function(){}};
+  }
+  var bm=m.bitmap,fw=bm.width,fh=bm.height;
+  var sw=Math.max(1,Math.floor(fw/DET_SCALE)),sh=Math.max(1,Math.floor(fh/DET_SCALE));
+  if(!detCv){
+    detCv=new OffscreenCanvas(sw,sh);detCtx=detCv.getContext('2d',{willReadFrequently:true});
+    roiCv=new OffscreenCanvas(1,1);roiCtx=roiCv.getContext('2d',{willReadFrequently:true});
+  }
+  if(detCv.width!==sw||detCv.height!==sh){detCv.width=sw;detCv.height=sh;}
+  detCtx.drawImage(bm,0,0,sw,sh);
+  return{fw:fw,fh:fh,det:detCtx.getImageData(0,0,sw,sh),scale:DET_SCALE,step:DET_STEP,
+    roi:function(r){
+      if(roiCv.width!==r.w||roiCv.height!==r.h){roiCv.width=r.w;roiCv.height=r.h;}
+      roiCtx.drawImage(bm,r.x,r.y,r.w,r.h,0,0,r.w,r.h);
+      return{data:roiCtx.getImageData(0,0,r.w,r.h).data,W:r.w,x0:0,y0:0};
+    },
+    close:function(){bm.close();}};
+}
+
+function analyse(m){
+  var t0=performance.now();
+  var src=frameSource(m);
+  var t1=performance.now();
+  perf.px=0;
+  var face=skinROI(src.det,src.scale,src.step,src.fw,src.fh);
+  var t2=performance.now(),t3=t2,t4=t2,roi=null,sig=null;
+  if(face){
+    roi=chromROI(face,src.fw,src.fh);
+    var ch=roi.w>0&&roi.h>0?getChrom(src.roi(roi),roi):null;
+    if(ch){
+      cX.push(ch.Xs);cY.push(ch.Ys);
+      gBuf.push(ch.g);tBuf.push(m.t);
+      frames++;
+      var chrom=chromSignal();
+      t3=performance.now();
+      if(cX.n>=MIN_FR){
+        var fps=cX.n/((tBuf.at(-1)-tBuf.at(0))/1000||1);
+        var res=getBpm(chrom,fps);
+        if(res.bpm>=40&&res.bpm<=180){
+          bpmHist.push(res.bpm);
+          curBpm=Math.round(bpmHist.mean());
+          curQual=res.q;
+        }
+        var st=calcStress(ch.r,ch.g,ch.b);
+        stHist.push(st.score);
+        curStress=st;
+      }
+      t4=performance.now();
+      sig=new Float32Array(chrom.subarray(-SIG_TAIL));
+    }
+  }
+  ema('read',t1-t0);ema('skin',t2-t1);ema('chrom',t3-t2);ema('fft',t4-t3);
+  ema('total',t4-t0);
+  src.close();
+  if(lastDone)ema('fps',1000/Math.max(t4-lastDone,1));
+  lastDone=t4;
+  self.postMessage({type:'frame',face:face,roi:roi,bpm:curBpm,q:curQual,
+    stress:curStress,frames:frames,sig:sig,perf:perf},sig?[sig.buffer]:[]);
+}
+
+function finish(){
+  var avgSt=stHist.mean();
+  var stLabels=["Relaxed","Mild Tension","Moderate Stress","High Stress","Acute Stress"];
+  var stIcons=["😌","😐","😟","😰","😱"];
+  var stColors=["#00E5A0","#74C0FC","#FFD166","#FF6B6B","#E84855"];
+  var si=avgSt<0.25?0:avgSt<0.45?1:avgSt<0.65?2:avgSt<0.82?3:4;
+  var chrom=Array.from(chromSignal(SIG_TAIL),function(v){return+v.toFixed(4);});
+  self.postMessage({type:'result',result:{
+    bpm:curBpm||0,
+    quality:curQual||0,
+    frames:frames,
+    stress:{
+      score:Math.round(avgSt*1000)/1000,
+      label:stLabels[si],
+      icon:stIcons[si],
+      color:stColors[si],
+      components:{"Signal Quality":(curQual||0)/100,"Stress Index":Math.round(avgSt*100)/100}
+    },
+    signal:chrom
+  }});
+}
+
+self.onmessage=function(e){
+  var m=e.data;
+  if(m.type==='frame')analyse(m);
+  else if(m.type==='finish')finish();
+};
+"""
+
+# The rPPG component's pre-worker getBpm (recursive FFT, fresh arrays and
+# Hann window per call). Kept only as the baseline for bench-fft.
+_LEGACY_GET_BPM_JS = """
+function fftRec(re,im){
+  var N=re.length;if(N<=1)return;
+  var h=N>>1,reE=[],imE=[],reO=[],imO=[];
+  for(var i=0;i<N;i++){if(i%2===0){reE.push(re[i]);imE.push(im[i]);}
+    else{reO.push(re[i]);imO.push(im[i]);}}
+  fftRec(reE,imE);fftRec(reO,imO);
+  for(var k=0;k<h;k++){
+    var a=-2*Math.PI*k/N,c=Math.cos(a),s=Math.sin(a);
+    var tr=c*reO[k]-s*imO[k],ti=s*reO[k]+c*imO[k];
+    re[k]=reE[k]+tr;im[k]=imE[k]+ti;
+    re[k+h]=reE[k]-tr;im[k+h]=imE[k]-ti;
+  }
+}
+function getBpmRec(sig,fps){
+  if(sig.length<MIN_FR)return{bpm:0,q:0};
+  var N=pow2(sig.length),re=new Array(N).fill(0),im=new Array(N).fill(0);
+  var mn=sig.reduce(function(a,b){return a+b;},0)/sig.length;
+  for(var i=0;i<sig.length;i++){
+    var w=0.5*(1-Math.cos(2*Math.PI*i/(sig.length-1)));
+    re[i]=(sig[i]-mn)*w;
+  }
+  fftRec(re,im);
+  var mags=re.map(function(r,i){return Math.sqrt(r*r+im[i]*im[i]);});
+  var best=-1,bf=0,tot=0,band=0;
+  for(var i=1;i<N/2;i++){
+    var f=i*fps/N;tot+=mags[i];
+    if(f>=0.67&&f<=3.5){band+=mags[i];if(mags[i]>best){best=mags[i];bf=f;}}
+  }
+  var q=tot>0?Math.min(100,Math.round(band/tot*200)):0;
+  return{bpm:Math.round(bf*60),q:q};
+}
+"""
+
+def build_fft_bench_html(sizes=(300, 1024), frames: int = 2000) -> str:
+    """Frame-time page: the shipped worker's getBpm (evaluated from
+    _RPPG_WORKER_JS itself) vs the legacy recursive one, on the same noisy
+    72 BPM window, with a check that both agree on bpm and quality."""
+    worker = json.dumps(_RPPG_WORKER_JS).replace("</", "<\\/")
+    return """<!DOCTYPE html><html><head><meta charset="utf-8">
+<title>rPPG getBpm frame-time benchmark</title>
+<style>
+body{font-family:Georgia,serif;background:#0A0E1A;color:#E2E8F0;padding:20px}
+table{border-collapse:collapse;margin-top:12px}
+td,th{border:1px solid #253358;padding:4px 12px;text-align:right;font-family:monospace}
+button{background:#00E5A0;border:none;border-radius:8px;padding:8px 20px;cursor:pointer}
+</style></head><body>
+<h3>getBpm frame time — legacy recursive vs shipped worker FFT</h3>
+<button onclick="runAll()">Run</button> <span id="msg"></span>
+<table id="out"><tr><th>WIN</th><th>N</th><th>frames</th><th>legacy ms</th>
+<th>shipped ms</th><th>speedup</th><th>same result</th></tr></table>
+<script>
+var SIZES=""" + json.dumps(list(sizes)) + """,FRAMES=""" + str(int(frames)) + """,FPS=30;
+// The worker source exactly as _build_rppg_html embeds it
+var shipped=new Function('self',""" + worker + """+
+  '\\nreturn {getBpm:getBpm,pow2:pow2,MIN_FR:MIN_FR};')({});
+var MIN_FR=shipped.MIN_FR,pow2=shipped.pow2;
+""" + _LEGACY_GET_BPM_JS + """
+function window_(win){
+  var s=[];
+  for(var i=0;i<win;i++)
+    s.push(Math.sin(2*Math.PI*1.2*i/FPS)+0.5*(Math.random()-0.5));
+  return s;
+}
+
+function timeFrames(fn,sig){
+  var t0=performance.now();
+  for(var f=0;f<FRAMES;f++){sig[f%sig.length]+=1e-9;fn(sig,FPS);}   // defeat caching
+  return (performance.now()-t0)/FRAMES;
+}
+
+function bench(win){
+  var sig=window_(win),a=getBpmRec(sig,FPS),b=shipped.getBpm(sig,FPS);
+  timeFrames(getBpmRec,sig);timeFrames(shipped.getBpm,sig);   // warm up the JIT
+  var tl=timeFrames(getBpmRec,sig),ts=timeFrames(shipped.getBpm,sig);
+  return{win:win,n:pow2(win),frames:FRAMES,legacy:tl,shipped:ts,
+    same:a.bpm===b.bpm&&a.q===b.q};
+}
+
+function runAll(){
+  var out=document.getElementById('out');
+  document.getElementById('msg').textContent='running…';
+  setTimeout(function(){
+    SIZES.forEach(function(win){
+      var r=bench(win),tr=out.insertRow();
+      [r.win,r.n,r.frames,r.legacy.toFixed(4),r.shipped.toFixed(4),
+       (r.legacy/r.shipped).toFixed(1)+'x',r.same].forEach(function(v){tr.insertCell().textContent=v;});
+    });
+    document.getElementById('msg').textContent='done';
+  },0);
+}
+</script></body></html>
+"""
+
+def _bench_fft_main(argv) -> int:
+    """python app.py bench-fft [out.html]: write the getBpm frame-time page
+    (default bench_fft.html), built from the worker source that ships."""
+    out = argv[0] if argv else "bench_fft.html"
+    with open(out, "w", encoding="utf-8") as f:
+        f.write(build_fft_bench_html())
+    print(f"wrote {out} — open it in a browser and press Run")
+    return 0
+
+# ─────────────────────────────────────────────────────────────────────────────
+# BATCH SCORING  (headless: python app.py batch <video_dir> <out.csv|.parquet>)
+# ─────────────────────────────────────────────────────────────────────────────
+
+VIDEO_EXTS = (".mp4", ".avi", ".mov", ".mkv", ".webm", ".m4v")
+BATCH_FIELDS = ("file", "window_start_s", "window_end_s", "bpm", "quality",
+                "face_coverage", "snr", "stress")
+
+_batch_engine = None   # one HeartRateEngine per worker process
+
+def score_video(path: str, window_s: float = 10.0, step_s: float = 2.0,
+                stress_every: int = 5) -> list:
+    """Score one recording: a row per sliding window (see BATCH_FIELDS).
+
+    Frames are decoded and discarded one at a time; only the current
+    window's fused CHROM samples, timestamps and stress scores are kept,
+    so memory is bounded by window_s × fps, not by recording length.
+    """
+    global _batch_engine
+    if _batch_engine is None:
+        _batch_engine = HeartRateEngine()
+    engine  = _batch_engine
+    cap     = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError(f"cannot open video: {path}")
+    fps     = cap.get(cv2.CAP_PROP_FPS)
+    if not (fps and math.isfinite(fps) and 1 <= fps <= 240):
+        # Containers without timing report 0, NaN or nonsense (90000 = timebase)
+        _log.warning("%s: implausible fps %r, assuming 30", path, fps)
+        fps = 30.0
+    maxlen  = int(window_s * fps) + 1
+    samples, times = RingBuffer(maxlen), RingBuffer(maxlen)
+    stress, stress_t = RingBuffer(maxlen), RingBuffer(maxlen)
+    tracker = engine.new_tracker()
+    fusion  = ChromFusion()
+    rows, idx, next_end = [], 0, window_s
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            t = idx / fps
+            idx += 1
+            face = tracker.update(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+            if face is not None:
+                rois  = get_face_rois(face, frame.shape)
+                fused = fusion.update(extract_roi_means(frame, rois), t)
+                if fused is not None:
+                    samples.append(fused); times.append(t)
+                if idx % stress_every == 0:
+                    res = engine.analyse_facial_stress(frame, face, rois[0])
+                    if res:
+                        stress.append(res["score"]); stress_t.append(t)
+            if t + 1e-9 >= next_end:
+                start = next_end - window_s
+                in_win = times.view() >= start
+                ts_w  = times.view()[in_win]
+                est   = estimate_heart_rate(samples.view()[in_win], ts_w)
+                bpm, snr = est["bpm"], est["snr"]
+                cover = min(len(ts_w) / max(window_s * fps, 1), 1.0)
+                sc    = stress.view()[stress_t.view() >= start]
+                rows.append({
+                    "file": os.path.basename(path),
+                    "window_start_s": round(start, 3), "window_end_s": round(next_end, 3),
+                    "bpm": bpm, "quality": int(est["quality"] * cover),
+                    "face_coverage": round(cover, 3), "snr": round(snr, 3),
+                    "stress": round(float(np.mean(sc)), 3) if len(sc) else None,
+                })
+                next_end += step_s
+    finally:
+        cap.release()
+    return rows
+
+def _score_video_safe(args):
+    path, kw = args
+    try:
+        return path, score_video(path, **kw), None
+    except Exception as e:
+        return path, [], str(e)
+
+def batch_score_videos(video_dir: str, out_path: str, workers: int = None, **kw) -> int:
+    """Score every video in video_dir across a process pool and write one
+    CSV or Parquet (by out_path suffix). Returns the number of rows written.
+
+    Workers are forked so they inherit the loaded engine code without
+    re-running this script; where fork is unavailable files run in-process.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    paths = sorted(os.path.join(video_dir, f) for f in os.listdir(video_dir)
+                   if f.lower().endswith(VIDEO_EXTS))
+    jobs  = [(p, kw) for p in paths]
+    rows  = []
+    if "fork" in multiprocessing.get_all_start_methods() and len(jobs) > 1:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)),
+                                 mp_context=multiprocessing.get_context("fork")) as pool:
+            results = pool.map(_score_video_safe, jobs)
+            for path, file_rows, err in results:
+                if err:
+                    _log.warning("Batch: %s failed: %s", path, err)
+                rows.extend(file_rows)
+    else:
+        for job in jobs:
+            path, file_rows, err = _score_video_safe(job)
+            if err:
+                _log.warning("Batch: %s failed: %s", path, err)
+            rows.extend(file_rows)
+    df = pd.DataFrame(rows, columns=list(BATCH_FIELDS))
+    if out_path.lower().endswith(".parquet"):
+        df.to_parquet(out_path, index=False)
+    else:
+        df.to_csv(out_path, index=False)
+    return len(df)
+
+def _batch_main(argv) -> int:
+    import argparse
+    ap = argparse.ArgumentParser(prog="app.py batch",
+                                 description="Score recorded videos offline.")
+    ap.add_argument("video_dir")
+    ap.add_argument("out", help="output .csv or .parquet")
+    ap.add_argument("--window", type=float, default=10.0, help="window length (s)")
+    ap.add_argument("--step",   type=float, default=2.0,  help="window hop (s)")
+    ap.add_argument("--stress-every", type=int, default=5, help="stress on every k-th frame")
+    ap.add_argument("--workers", type=int, default=None)
+    a = ap.parse_args(argv)
+    n = batch_score_videos(a.video_dir, a.out, workers=a.workers, window_s=a.window,
+                           step_s=a.step, stress_every=a.stress_every)
+    print(f"wrote {n} windows to {a.out}")
+    return 0
+
+def _bench_refine_main(argv) -> int:
+    """Time the scalar refiners against the vectorised ones:
+    python app.py bench-refine [N]  (default 1,000,000). Row-for-row
+    equivalence is covered by tests/test_refine_batch.py."""
+    n   = int(argv[0]) if argv else 1_000_000
+    rng = np.random.default_rng(7)
+    raw    = np.where(rng.random(n) < 0.05, 0, rng.integers(25, 215, n))
+    age    = np.where(rng.random(n) < 0.1, 0, rng.integers(10, 95, n))
+    gcode  = rng.integers(0, 2, n)
+    stress = np.where(rng.random(n) < 0.2, np.nan, rng.random(n).round(3))
+    hist   = np.where(rng.random((n, 5)) < 0.15, np.nan, rng.integers(45, 150, (n, 5)))
+    hist   = history_matrix([row[~np.isnan(row)] for row in hist])   # right-align
+    histories = [[int(v) for v in row if not np.isnan(v)] for row in hist]
+    engine = HeartRateEngine()
+
+    t0 = time.perf_counter()
+    ml_s = [ml_refine_bpm(int(r), int(a), int(g), h)
+            for r, a, g, h in zip(raw, age, gcode, histories)]
+    cat_s = [HR_CATEGORIES.index(analyze_heart_rate(b)["category"]) for b in ml_s]
+    st_s = [engine.stress_adjusted_bpm(int(r), None if np.isnan(sc) else {"score": sc},
+                                       int(a), int(g), h)
+            for r, sc, a, g, h in zip(raw, stress, age, gcode, histories)]
+    t_scalar = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    refine_readings_batch(raw, age, gcode, hist)
+    stress_adjusted_bpm_batch(raw, stress, age, gcode, hist)
+    t_vec = time.perf_counter() - t0
+
+    print(f"{n} readings  scalar {t_scalar:.2f}s  vectorised {t_vec:.3f}s  "
+          f"({t_scalar / t_vec:.0f}x)")
+    return 0
+
+def _bench_decrypt_main(argv) -> int:
+    """Time HybridEncryption.decrypt_many on keyring-wrapped rows, inline
+    (workers=1) vs the shared pool, and check both agree:
+    python app.py bench-decrypt [N ...]  (default 10,000 100,000 1,000,000)."""
+    sizes = [int(a) for a in argv] or [10_000, 100_000, 1_000_000]
+    ring  = KeyRing(None)   # in-memory KEK, same wrap/unwrap as the app
+    print(f"workers={_decrypt_pool_size()}  chunk={HybridEncryption.CHUNK_ROWS}")
+    print(f"{'rows':>9} {'inline s':>9} {'pool s':>9} {'speedup':>8}  identical")
+    ok = True
+    for n in sizes:
+        rows = []
+        for i in range(n):   # one data key per row, as save_test_result does
+            dek, wrapped, kek_id = ring.new_data_key()
+            data = {"bpm": 60 + i % 60, "signal_data": [0.0] * 16,
+                    "analysis": {"category": "Normal"}, "timestamp": "2026-01-01T00:00:00"}
+            rows.append((HybridEncryption.encrypt_aes_gcm(json.dumps(data), dek),
+                         wrapped, kek_id))
+        timings, results = [], []
+        for workers in (1, None):
+            ring.unwrap.cache_clear()
+            t0 = time.perf_counter()
+            results.append(HybridEncryption.decrypt_many(rows, workers=workers, keyring=ring))
+            timings.append(time.perf_counter() - t0)
+        same = results[0] == results[1] and None not in results[1]
+        ok &= same
+        print(f"{n:>9} {timings[0]:>9.3f} {timings[1]:>9.3f} "
+              f"{timings[0] / timings[1]:>7.2f}x  {same}")
+    return 0 if ok else 1
+
+_HEADLESS_COMMANDS = {"batch": _batch_main, "bench-refine": _bench_refine_main,
+                      "bench-decrypt": _bench_decrypt_main,
+                      "bench-fft": _bench_fft_main,
+                      "kek-export": _kek_export_main, "kek-import": _kek_import_main}
+
+# Stop here when run headless — nothing below (DB init, UI) is needed
+if __name__ == "__main__" and sys.argv[1:2] and sys.argv[1] in _HEADLESS_COMMANDS:
+    sys.exit(_HEADLESS_COMMANDS[sys.argv[1]](sys.argv[2:]))
+
 # ─────────────────────────────────────────────────────────────────────────────
 # SESSION STATE
 # ─────────────────────────────────────────────────────────────────────────────
@@ -896,6 +3317,10 @@ except Exception as _db_err:
     """)
     st.stop()
 
+# Start (once per process) the thread that ships queued remote backups,
+# including anything left in the outbox by a previous run
+_get_backup_worker(DB_PATH)
+
 def _fresh_defaults():
     """Return a new dict of defaults — called each time to avoid shared mutable objects."""
     return {
@@ -903,20 +3328,30 @@ def _fresh_defaults():
         "user":                 None,
         "page":                 "landing",
         "theme":                "dark",
-        "data_buffer":          deque(maxlen=60),   # fresh deque per user session
-        "chrom_x":              deque(maxlen=60),
-        "chrom_y":              deque(maxlen=60),
-        "times":                deque(maxlen=60),
+        "data_buffer":          RingBuffer(SIGNAL_WINDOW),  # fresh ring per user session
+        "chrom_x":              RingBuffer(SIGNAL_WINDOW),
+        "chrom_y":              RingBuffer(SIGNAL_WINDOW),
+        "times":                RingBuffer(SIGNAL_WINDOW),
+        "rppg":                 None,               # RPPGEstimator, built on first frame
+        "chrom":                None,               # ChromFusion, built on first frame
+        "face_tracker":         None,               # FaceTracker, built on first frame
+        "stress_sampler":       None,               # StressSampler, built on first frame
         "bpm":                  0,
-        "bpm_history":          [],
+        "bpm_history":          RingBuffer(BPM_HISTORY),
         "stress":               None,
-        "stress_scores":        [],
+        "stress_scores":        RingBuffer(STRESS_WINDOW),
         "running":              False,
         "test_complete":        False,
         "last_result":          None,               # always None until THIS user scans
         "enc_step":             0,
         "enc_data":             {},
         "admin_selected_user":  None,
+        "results_view":         None,               # loaded history pages + keyset cursor
+        "admin_history_cache":  {},                 # user_id → (test count, decrypted results)
+        "rppg_run":             0,                  # component mount id, bumped per ▶ Start
+        "rppg_seq":             0,                  # last component message applied
+        "rppg_mount":           None,               # nonce of the mount rppg_seq counts
+        "rppg_quality":         0,
         "cam_frame_idx":        0,
         "_last_frame_hash":     None,
     }
@@ -1466,6 +3901,8 @@ if not st.session_state.logged_in:
 
 render_nav()
 user = st.session_state.user
+if "gender_code" not in user:   # session from before gender codes were stored
+    user["gender_code"] = _gender_code(user.get("gender", ""))
 
 # ──── Sidebar navigation ─────────────────────────────────────────────────────
 is_admin = user.get('is_admin', 0)
@@ -1543,16 +3980,24 @@ section[data-testid="stSidebar"] .stButton>button[kind="primary"]{{
 # ─────────────────────────────────────────────────────────────────────────────
 
 
+# Min gap between live component → Python updates. Each update reruns the
+# whole monitor page (~0.7 s of server CPU on a 1-vCPU host), while the
+# component draws the live BPM itself, so Python only needs a coarse
+# refresh of the stats column.
+RPPG_STREAM_MS = 2000
+
 def _build_rppg_html(theme: str = "dark") -> str:
     """
     Self-contained rPPG component that:
     1. Opens webcam at 30fps via getUserMedia
-    2. Detects skin region on canvas (no ML model)
-    3. Extracts CHROM signal every frame
-    4. Runs FFT in pure JS → live BPM
-    5. On Stop: submits result via a hidden HTML form targeting _top
-       (same-origin form submit IS allowed from Streamlit iframes)
-       Python reads st.query_params["rppg_result"] on next rerun.
+    2. Hands each frame to a Web Worker as a transferable ImageBitmap;
+       skin detection (no ML model), CHROM and FFT run there, and the
+       page only draws the video, overlay and worker fps/stage timings
+    3. Falls back to running the same worker code inline when Worker /
+       OffscreenCanvas are unavailable
+    4. Streams throttled {bpm, quality, signal chunk} updates to Python with
+       setComponentValue, and the full result once on Stop — see
+       rppg_component / apply_rppg_message. No page reloads, no URL payloads.
     """
     bg    = "#0A0E1A" if theme == "dark" else "#F0F4FA"
     card  = "#131C30" if theme == "dark" else "#FFFFFF"
@@ -1587,6 +4032,7 @@ button{border:none;border-radius:8px;padding:8px 20px;font-size:.84rem;
 #bs:disabled,#bx:disabled{opacity:.35;cursor:default}
 #bx{background:#E84855;color:#fff}
 #msg{font-size:.7rem;color:""" + text2 + """;text-align:center;min-height:1em}
+#perf{font-size:.58rem;color:""" + text2 + """;font-family:monospace;opacity:.7}
 #quality_bar{width:100%;max-width:460px;height:4px;background:#253358;border-radius:2px}
 #quality_fill{height:100%;width:0%;background:""" + accent + """;border-radius:2px;
   transition:width .5s}
@@ -1611,108 +4057,114 @@ button{border:none;border-radius:8px;padding:8px 20px;font-size:.84rem;
     <button id="bx" onclick="stopAndSave()" disabled>⏹ Stop &amp; Save</button>
   </div>
   <div id="msg">Click Start Camera — allow browser camera permission</div>
+  <div id="perf"></div>
 </div>
 
 
 
+<script id="rppg-worker" type="text/js-worker">""" + _RPPG_WORKER_JS + """</script>
 <script>
 // ─── Config ───────────────────────────────────────────────────────────────────
-var WIN=300, MIN_FR=60, FPS=30;
+var FPS=30, STREAM_MS=""" + str(RPPG_STREAM_MS) + """, FRAME_H=500;
 
 // ─── State ───────────────────────────────────────────────────────────────────
-var stream,raf,running=false,frames=0;
-var cX=[],cY=[],gBuf=[],tBuf=[];
-var bpmHist=[],stHist=[],curBpm=0,curQual=0,curStress=null;
-
-// ─── DOM ─────────────────────────────────────────────────────────────────────
-var vid=document.getElementById('vid');
-var ov=document.getElementById('ov');
-var octx=ov.getContext('2d');
-var sig=document.getElementById('sig');
-var sctx=sig.getContext('2d');
+// Capture and overlay live here; pixel analysis, CHROM and FFT run in the
+// worker (_RPPG_WORKER_JS). One frame in flight at a time: frames that
+// arrive while the worker is busy are dropped, never queued.
+var stream,raf,running=false,pipe=null,busy=false,dropped=0,last=null;
 
-// ─── FFT (pure JS, Cooley-Tukey) ─────────────────────────────────────────────
-function fft(re,im){
-  var N=re.length;if(N<=1)return;
-  var h=N>>1,reE=[],imE=[],reO=[],imO=[];
-  for(var i=0;i<N;i++){if(i%2===0){reE.push(re[i]);imE.push(im[i]);}
-    else{reO.push(re[i]);imO.push(im[i]);}}
-  fft(reE,imE);fft(reO,imO);
-  for(var k=0;k<h;k++){
-    var a=-2*Math.PI*k/N,c=Math.cos(a),s=Math.sin(a);
-    var tr=c*reO[k]-s*imO[k],ti=s*reO[k]+c*imO[k];
-    re[k]=reE[k]+tr;im[k]=imE[k]+ti;
-    re[k+h]=reE[k]-tr;im[k+h]=imE[k]-ti;
-  }
-}
-function pow2(n){var p=1;while(p<n)p<<=1;return p;}
-
-function getBpm(sig,fps){
-  if(sig.length<MIN_FR)return{bpm:0,q:0};
-  var N=pow2(sig.length),re=new Array(N).fill(0),im=new Array(N).fill(0);
-  var mn=sig.reduce(function(a,b){return a+b;},0)/sig.length;
-  for(var i=0;i<sig.length;i++){
-    var w=0.5*(1-Math.cos(2*Math.PI*i/(sig.length-1)));
-    re[i]=(sig[i]-mn)*w;
-  }
-  fft(re,im);
-  var mags=re.map(function(r,i){return Math.sqrt(r*r+im[i]*im[i]);});
-  var best=-1,bf=0,tot=0,band=0;
-  for(var i=1;i<N/2;i++){
-    var f=i*fps/N;tot+=mags[i];
-    if(f>=0.67&&f<=3.5){band+=mags[i];if(mags[i]>best){best=mags[i];bf=f;}}
+// ─── DOM ─────────────────────────────────────────────────────────────────────
+var vid=document.getElementById('vid');
+var ov=document.getElementById('ov');
+var octx=ov.getContext('2d');
+var sig=document.getElementById('sig');
+var sctx=sig.getContext('2d');
+var tmpCv=document.createElement('canvas');
+var tmpCtx=tmpCv.getContext('2d',{willReadFrequently:true});
+
+// ─── Streamlit component channel ──────────────────────────────────────────────
+// Bare v1 component protocol (what streamlit-component-lib wraps): announce
+// ready, size the iframe, push JSON values. Each value triggers a script
+// rerun, so live updates go out at most once per STREAM_MS and carry only
+// the signal samples produced since the last one. seq restarts whenever the
+// iframe remounts (theme toggle, navigating away and back), so every value
+// also carries a per-mount nonce that tells Python to restart its count.
+var seq=0,lastSent=0,sentFrames=0;
+var MOUNT=Math.random().toString(36).slice(2)+Date.now().toString(36);
+function stPost(type,extra){
+  var m={isStreamlitMessage:true,type:type};
+  for(var k in extra)m[k]=extra[k];
+  window.parent.postMessage(m,'*');
+}
+function setComponentValue(v){
+  v.seq=++seq;v.mount=MOUNT;
+  stPost('streamlit:setComponentValue',{value:v,dataType:'json'});
+}
+window.addEventListener('message',function(e){
+  if(e.data&&e.data.type==='streamlit:render')stPost('streamlit:setFrameHeight',{height:FRAME_H});
+});
+stPost('streamlit:componentReady',{apiVersion:1});
+
+function streamLive(m){
+  var now=performance.now();
+  if(now-lastSent<STREAM_MS)return;
+  lastSent=now;
+  var chunk=[];
+  if(m.sig){   // frames only advance on frames that also carry a tail
+    var k=Math.min(m.frames-sentFrames,m.sig.length);
+    for(var i=m.sig.length-k;i<m.sig.length;i++)chunk.push(+m.sig[i].toFixed(4));
+    sentFrames=m.frames;
   }
-  var q=tot>0?Math.min(100,Math.round(band/tot*200)):0;
-  return{bpm:Math.round(bf*60),q:q};
+  setComponentValue({state:'live',bpm:m.bpm||0,quality:m.q||0,frames:m.frames,chunk:chunk});
 }
 
-// ─── Skin detection ───────────────────────────────────────────────────────────
-function skinROI(data,W,H){
-  var x1=W,y1=H,x2=0,y2=0,cnt=0;
-  for(var y=0;y<H;y+=3){for(var x=0;x<W;x+=3){
-    var i=(y*W+x)*4,r=data[i],g=data[i+1],b=data[i+2];
-    var mx=Math.max(r,g,b),mn=Math.min(r,g,b),d=mx-mn;
-    if(mx===0||mx<60)continue;
-    var s=d/mx;
-    var h=mx===r?60*(g-b)/d:mx===g?120+60*(b-r)/d:240+60*(r-g)/d;
-    if(h<0)h+=360;
-    if(h<=50&&s>=0.2&&s<=0.85&&mx<=240){
-      if(x<x1)x1=x;if(y<y1)y1=y;if(x>x2)x2=x;if(y>y2)y2=y;cnt++;
-    }
-  }}
-  if(cnt<40)return null;
-  var p=8;
-  return{x:Math.max(0,x1-p),y:Math.max(0,y1-p),
-    w:Math.min(W-x1+p,(x2-x1)+p*2),h:Math.min(H-y1+p,(y2-y1)+p*2)};
+// ─── Analysis pipe ────────────────────────────────────────────────────────────
+function inlinePipe(src){
+  var host={postMessage:function(m){onResult({data:m});}};
+  new Function('self',src)(host);
+  return{bitmaps:false,terminate:function(){},
+    post:function(m){host.onmessage({data:m});}};
 }
 
-function getChrom(data,W,face){
-  var fx=face.x,fy=face.y,fw=face.w,fh=face.h;
-  var ry=fy+Math.floor(fh*0.05),rh=Math.floor(fh*0.22);
-  var rx=fx+Math.floor(fw*0.2),rw=Math.floor(fw*0.6);
-  var r=0,g=0,b=0,n=0;
-  for(var y=ry;y<ry+rh&&y<W;y++){for(var x=rx;x<rx+rw&&x<W;x++){
-    var i=(y*W+x)*4;r+=data[i];g+=data[i+1];b+=data[i+2];n++;
-  }}
-  if(!n)return null;
-  r/=n;g/=n;b/=n;
-  return{Xs:r-g,Ys:0.5*r+0.5*g-b,r:r,g:g,b:b,
-    roi:{x:rx,y:ry,w:rw,h:rh}};
+function makePipe(){
+  var src=document.getElementById('rppg-worker').textContent;
+  if(window.Worker&&window.OffscreenCanvas&&window.createImageBitmap){
+    try{
+      var w=new Worker(URL.createObjectURL(new Blob([src],{type:'text/javascript'})));
+      w.onmessage=onResult;
+      w.onerror=function(){w.terminate();pipe=inlinePipe(src);busy=false;};
+      return{bitmaps:true,terminate:function(){w.terminate();},
+        post:function(m,tr){w.postMessage(m,tr||[]);}};
+    }catch(e){}
+  }
+  return inlinePipe(src);
 }
 
-function calcStress(r,g,b){
-  var red=Math.min(1,Math.max(0,(r/(g+1)-0.95)/0.4));
-  var pal=Math.min(1,Math.max(0,(120-(r+g+b)/3)/60));
-  var cov=gBuf.length>10?(function(){
-    var s=gBuf.slice(-20),m=s.reduce(function(a,b){return a+b;},0)/s.length;
-    var v=s.reduce(function(a,x){return a+(x-m)*(x-m);},0)/s.length;
-    return Math.min(1,Math.sqrt(v)/(m+1)*10);
-  })():0;
-  var sc=Math.min(1,red*0.4+pal*0.15+cov*0.45);
-  var lbs=["😌 Relaxed","😐 Mild Tension","😟 Moderate Stress","😰 High Stress","😱 Acute Stress"];
-  var cls=["#00E5A0","#74C0FC","#FFD166","#FF6B6B","#E84855"];
-  var idx=sc<0.25?0:sc<0.45?1:sc<0.65?2:sc<0.82?3:4;
-  return{score:sc,label:lbs[idx],color:cls[idx],icon:["😌","😐","😟","😰","😱"][idx]};
+function sendFrame(W,H){
+  busy=true;
+  var t=performance.now();
+  if(pipe.bitmaps){
+    createImageBitmap(vid).then(function(bmp){
+      pipe.post({type:'frame',bitmap:bmp,t:t},[bmp]);
+    }).catch(function(){busy=false;});
+  }else{
+    if(tmpCv.width!==W||tmpCv.height!==H){tmpCv.width=W;tmpCv.height=H;}
+    tmpCtx.drawImage(vid,0,0,W,H);
+    pipe.post({type:'frame',image:tmpCtx.getImageData(0,0,W,H),t:t});
+  }
+}
+
+function onResult(e){
+  var m=e.data;
+  if(m.type==='frame'){
+    busy=false;last=m;
+    if(m.sig)drawSig(m.sig);
+    showStats(m);
+    if(running)streamLive(m);
+  }else if(m.type==='result'){
+    pipe.terminate();
+    saveResult(m.result);
+  }
 }
 
 function drawSig(buf){
@@ -1727,10 +4179,20 @@ function drawSig(buf){
   });sctx.stroke();
 }
 
+function showStats(m){
+  var p=m.perf;
+  document.getElementById('d_bpm').textContent=m.bpm||'--';
+  document.getElementById('d_fr').textContent=m.frames;
+  document.getElementById('d_qual').textContent=m.q?(m.q+'%'):'--';
+  document.getElementById('d_stress').textContent=m.stress?m.stress.icon:'--';
+  document.getElementById('quality_fill').style.width=(m.q||0)+'%';
+  document.getElementById('perf').textContent=(pipe.bitmaps?'worker ':'inline ')+
+    p.fps.toFixed(1)+' fps · read '+p.read.toFixed(1)+' · skin '+p.skin.toFixed(1)+
+    ' · chrom '+p.chrom.toFixed(1)+' · fft '+p.fft.toFixed(1)+' ms · '+p.px+' px · dropped '+dropped;
+}
+
 // ─── Main loop ────────────────────────────────────────────────────────────────
 var lastT=0;
-var tmpCv=document.createElement('canvas');
-var tmpCtx=tmpCv.getContext('2d',{willReadFrequently:true});
 
 function loop(ts){
   if(!running)return;
@@ -1739,80 +4201,42 @@ function loop(ts){
   lastT=ts;
 
   var W=vid.videoWidth||320,H=vid.videoHeight||240;
-  ov.width=W;ov.height=H;
-  tmpCv.width=W;tmpCv.height=H;
-  tmpCtx.drawImage(vid,0,0,W,H);
-  var imgD=tmpCtx.getImageData(0,0,W,H);
-  var face=skinROI(imgD.data,W,H);
+  if(ov.width!==W||ov.height!==H){ov.width=W;ov.height=H;}
+  if(busy)dropped++;else sendFrame(W,H);
 
   octx.clearRect(0,0,W,H);
   // Mirror flip so user sees themselves correctly
   octx.save();octx.scale(-1,1);octx.translate(-W,0);
   octx.drawImage(vid,0,0,W,H);
   octx.restore();
+  if(!last)return;
 
+  var face=last.face;
   if(face){
-    var ch=getChrom(imgD.data,W,face);
-    if(ch){
-      cX.push(ch.Xs);cY.push(ch.Ys);
-      gBuf.push(ch.g);tBuf.push(Date.now());
-      if(cX.length>WIN){cX.shift();cY.shift();gBuf.shift();tBuf.shift();}
-      frames++;
-
-      // CHROM combined
-      var mX=cX.reduce(function(a,b){return a+b;},0)/cX.length;
-      var mY=cY.reduce(function(a,b){return a+b;},0)/cY.length;
-      var sdX=Math.sqrt(cX.reduce(function(a,v){return a+(v-mX)*(v-mX);},0)/cX.length)||1;
-      var sdY=Math.sqrt(cY.reduce(function(a,v){return a+(v-mY)*(v-mY);},0)/cY.length)||1;
-      var alpha=sdX/sdY;
-      var chrom=cX.map(function(x,i){return x-alpha*cY[i];});
-
-      if(cX.length>=MIN_FR){
-        var fps2=cX.length/((tBuf[tBuf.length-1]-tBuf[0])/1000||1);
-        var res=getBpm(chrom,fps2);
-        if(res.bpm>=40&&res.bpm<=180){
-          bpmHist.push(res.bpm);if(bpmHist.length>6)bpmHist.shift();
-          curBpm=Math.round(bpmHist.reduce(function(a,b){return a+b;},0)/bpmHist.length);
-          curQual=res.q;
-        }
-        var st=calcStress(ch.r,ch.g,ch.b);
-        stHist.push(st.score);if(stHist.length>10)stHist.shift();
-        curStress=st;
-      }
-      drawSig(chrom.slice(-120));
-    }
-
     // Overlays
     octx.save();octx.scale(-1,1);octx.translate(-W,0);
     octx.strokeStyle='#00E5A0';octx.lineWidth=2;
     octx.strokeRect(face.x,face.y,face.w,face.h);
-    var ch2=getChrom(imgD.data,W,face);
-    if(ch2){
-      var roi=ch2.roi;
+    var roi=last.roi;
+    if(roi){
       octx.strokeStyle='rgba(232,72,85,0.8)';octx.lineWidth=1;
       octx.strokeRect(roi.x,roi.y,roi.w,roi.h);
       octx.fillStyle='rgba(232,72,85,0.15)';
       octx.fillRect(roi.x,roi.y,roi.w,roi.h);
     }
     octx.restore();
-    if(curBpm>0){
+    if(last.bpm>0){
       octx.fillStyle='#00E5A0';octx.font='bold 16px monospace';
-      octx.fillText(curBpm+' BPM',8,22);
+      octx.fillText(last.bpm+' BPM',8,22);
     }
-    if(curStress){
+    if(last.stress){
       octx.fillStyle='#FFD166';octx.font='12px Georgia';
-      octx.fillText(curStress.label,8,40);
+      octx.fillText(last.stress.label,8,40);
     }
   } else {
     octx.fillStyle='rgba(232,72,85,0.85)';octx.font='13px Georgia';
     octx.fillText('No face — improve lighting or move closer',10,H/2);
   }
-
-  document.getElementById('d_bpm').textContent=curBpm||'--';
-  document.getElementById('d_fr').textContent=frames;
-  document.getElementById('d_qual').textContent=curQual?(curQual+'%'):'--';
-  document.getElementById('d_stress').textContent=curStress?curStress.icon:'--';
-  document.getElementById('quality_fill').style.width=(curQual||0)+'%';
 }
 
 // ─── Start ────────────────────────────────────────────────────────────────────
@@ -1824,6 +4248,7 @@ async function startCam(){
     vid.srcObject=stream;
     await new Promise(function(r){vid.onloadedmetadata=r;});
     await vid.play();
+    pipe=makePipe();
     running=true;
     document.getElementById('bs').disabled=true;
     document.getElementById('bx').disabled=false;
@@ -1834,57 +4259,85 @@ async function startCam(){
   }
 }
 
-// ─── Stop & write result to sessionStorage ───────────────────────────────────
+// ─── Stop: worker packages the result ────────────────────────────────────────
 function stopAndSave(){
   running=false;
   if(raf)cancelAnimationFrame(raf);
   if(stream)stream.getTracks().forEach(function(t){t.stop();});
   document.getElementById('bx').disabled=true;
   document.getElementById('msg').textContent='⏳ Packaging result…';
+  if(pipe)pipe.post({type:'finish'});
+}
 
-  var avgSt=stHist.length?stHist.reduce(function(a,b){return a+b;},0)/stHist.length:0;
-  var stLabels=["Relaxed","Mild Tension","Moderate Stress","High Stress","Acute Stress"];
-  var stIcons=["😌","😐","😟","😰","😱"];
-  var stColors=["#00E5A0","#74C0FC","#FFD166","#FF6B6B","#E84855"];
-  var si=avgSt<0.25?0:avgSt<0.45?1:avgSt<0.65?2:avgSt<0.82?3:4;
-
-  var mX=cX.reduce(function(a,b){return a+b;},0)/(cX.length||1);
-  var mY=cY.reduce(function(a,b){return a+b;},0)/(cY.length||1);
-  var sdX=Math.sqrt(cX.reduce(function(a,v){return a+(v-mX)*(v-mX);},0)/(cX.length||1))||1;
-  var sdY=Math.sqrt(cY.reduce(function(a,v){return a+(v-mY)*(v-mY);},0)/(cY.length||1))||1;
-  var alpha=sdX/sdY;
-  var chrom=cX.slice(-120).map(function(x,i){return+(x-alpha*cY[i]).toFixed(4);});
-
-  var result={
-    bpm:curBpm||0,
-    quality:curQual||0,
-    frames:frames,
-    stress:{
-      score:Math.round(avgSt*1000)/1000,
-      label:stLabels[si],
-      icon:stIcons[si],
-      color:stColors[si],
-      components:{"Signal Quality":(curQual||0)/100,"Stress Index":Math.round(avgSt*100)/100}
-    },
-    signal:chrom
-  };
-
-  // Write to sessionStorage — bridge reads it when user clicks Fetch Result
-  try {
-    sessionStorage.setItem('cs_rppg_result', JSON.stringify(result));
-    document.getElementById('msg').textContent =
-      '✅ ' + (result.bpm||'--') + ' BPM ready — click "📥 Fetch Result" above ↑';
-    document.getElementById('bx').textContent = '✅ Done';
-    document.getElementById('bx').style.background = '#00E5A0';
-    document.getElementById('bx').style.color = '#000';
-  } catch(e) {
-    document.getElementById('msg').textContent = '❌ ' + e.message;
-  }
+// ─── Send the final result to Python ─────────────────────────────────────────
+function saveResult(result){
+  result.state='done';
+  setComponentValue(result);
+  document.getElementById('msg').textContent =
+    '✅ ' + (result.bpm||'--') + ' BPM sent — press 💾 Save to store it';
+  document.getElementById('bx').textContent = '✅ Done';
+  document.getElementById('bx').style.background = '#00E5A0';
+  document.getElementById('bx').style.color = '#000';
 }
 </script></body></html>
 """
 
 
+def rppg_component(theme: str, key: str):
+    """Mount the camera component; returns its latest message (or None)."""
+    component = declare_html_component(f"rppg_{theme}", _build_rppg_html(theme))
+    return component(key=key, default=None)
+
+def apply_rppg_message(msg, engine, user) -> bool:
+    """Fold one component message into session state.
+
+    Live messages update the running BPM/quality and append their signal
+    chunk; the final one becomes last_result. Messages are numbered per
+    mount and the component returns its last value on every rerun, so
+    anything at or below rppg_seq has already been applied. A new mount
+    nonce means the iframe remounted and restarted its count (and its
+    signal), so the count and the live buffer start over. Returns True
+    when a final result landed.
+    """
+    if not msg:
+        return False
+    if msg.get("mount") != st.session_state.rppg_mount:
+        st.session_state.rppg_mount  = msg.get("mount")
+        st.session_state.rppg_seq    = 0
+        st.session_state.data_buffer = RingBuffer(SIGNAL_WINDOW)
+    if msg.get("seq", 0) <= st.session_state.rppg_seq:
+        return False
+    st.session_state.rppg_seq = msg["seq"]
+    if msg.get("state") == "live":
+        st.session_state.bpm          = int(msg.get("bpm") or 0)
+        st.session_state.rppg_quality = int(msg.get("quality") or 0)
+        st.session_state.data_buffer.extend(msg.get("chunk") or [])
+        return False
+    _bpm = int(msg.get("bpm", 0))
+    if _bpm <= 0:
+        return False
+    _st  = msg.get("stress")
+    _sig = msg.get("signal", [])
+    _bpm_f = engine.stress_adjusted_bpm(
+        _bpm, _st,
+        user.get('age', 0), user.get('gender_code', GENDER_MALE),
+        st.session_state.bpm_history,
+    )
+    st.session_state.bpm          = _bpm_f
+    st.session_state.stress       = _st
+    st.session_state.last_result  = {
+        'bpm':         _bpm_f,
+        'analysis':    analyze_heart_rate(_bpm_f),
+        'signal_data': _sig,
+        'stress':      _st,
+        'quality':     int(msg.get('quality', 0)),
+        'frames':      int(msg.get('frames', 0)),
+    }
+    st.session_state.test_complete = True
+    st.session_state.running       = False
+    st.session_state.data_buffer.extend(_sig)
+    return True
+
 # ─────────────────────────────────────────────────────────────────────────────
 # FULL-WIDTH PAGE HERO HELPER
 # ─────────────────────────────────────────────────────────────────────────────
@@ -2007,7 +4460,7 @@ go();
                 )
                 log_action(pd["user_id"], "RESULT_SAVED",
                            f"BPM={r['bpm']}, Cat={r['analysis']['category']}, "
-                           f"Remote={'OK' if result_info['remote'] else 'FAIL'}")
+                           f"Remote={str(result_info['remote']).upper()}")
                 st.session_state["_popup_data"]["remote_ok"]  = result_info["remote"]
                 st.session_state["_popup_data"]["remote_msg"] = result_info.get("remote_msg","")
             except Exception as _se:
@@ -2016,8 +4469,12 @@ go();
                 st.stop()
             st.session_state.test_complete = False
             st.session_state.last_result   = None
-            st.session_state.data_buffer   = deque(maxlen=60)
-            st.session_state.times         = deque(maxlen=60)
+            st.session_state.data_buffer   = RingBuffer(SIGNAL_WINDOW)
+            st.session_state.times         = RingBuffer(SIGNAL_WINDOW)
+            st.session_state.rppg          = None
+            st.session_state.chrom         = None
+            st.session_state.face_tracker  = None
+            st.session_state.stress_sampler = None
             st.session_state.bpm           = 0
             st.session_state.running       = False
             st.session_state["_popup_data"]["phase"] = "success"
@@ -2031,7 +4488,9 @@ go();
             cat_val    = r["analysis"]["category"]
             stress_lbl = r["stress"]["label"] if r.get("stress") else ""
             stress_bit = f" | Stress: {stress_lbl}" if stress_lbl else ""
-            if remote_ok:
+            if remote_ok == "queued":
+                rrow = '<div class="row ok"><span class="sym">🔄</span>Remote backup queued — syncing in background</div>'
+            elif remote_ok:
                 rrow = '<div class="row ok"><span class="sym">✅</span>Remote backup saved to steadywebhosting.com</div>'
             else:
                 safe_msg = remote_msg[:70].replace('<','&lt;').replace('>','&gt;')
@@ -2155,246 +4614,7 @@ A **contextual prior model** then cross-validates the raw FFT estimate against:
 
     st.divider()
 
-    # ── face detector (shared) ────────────────────────────────────────────────
-    face_cascade = cv2.CascadeClassifier(
-        cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-    )
-
-
-    # ── Stress & facial state analyser ──────────────────────────────────────
-    def analyse_facial_stress(frame_bgr, face_rect, roi_rect):
-        """
-        Estimate a stress score 0.0–1.0 from a single BGR frame using:
-          1. Skin redness ratio  (R/G channel balance in face ROI)
-          2. Green-channel CoV   (signal noisiness from micro-expressions)
-          3. Eye-region darkness (dark circles / fatigue indicator)
-          4. Brow-region tension (texture variance above eyebrows)
-          5. Skin pallor index   (very pale = vasoconstiction = stress)
-        Returns dict with score + component breakdown.
-        """
-        try:
-            x, y, w, h = face_rect
-            H, W = frame_bgr.shape[:2]
-            # ── 1. Skin redness in cheek region ─────────────────────────
-            cheek_y1 = int(y + h * 0.45)
-            cheek_y2 = int(y + h * 0.75)
-            cheek_x1 = int(x + w * 0.10)
-            cheek_x2 = int(x + w * 0.90)
-            cheek     = frame_bgr[cheek_y1:cheek_y2, cheek_x1:cheek_x2]
-            if cheek.size == 0:
-                return None
-            b_ch, g_ch, r_ch = (cheek[:,:,0].mean(),
-                                 cheek[:,:,1].mean() + 1e-6,
-                                 cheek[:,:,2].mean())
-            redness = float(np.clip(r_ch / g_ch, 0.8, 1.6))   # 0.8=pale, 1.6=flushed
-            redness_score = float(np.clip((redness - 0.95) / 0.4, 0, 1))  # 0=calm,1=flushed
-
-            # ── 2. Pallor (very low R+G+B average = vasoconstiction) ────
-            brightness = float((r_ch + g_ch + cheek[:,:,0].mean()) / 3)
-            pallor_score = float(np.clip((120 - brightness) / 60, 0, 1))  # low brightness → stressed
-
-            # ── 3. Green-channel coefficient of variation (volatility) ──
-            g_flat = g_ch  # already a mean — use ROI pixel std instead
-            roi_region = frame_bgr[roi_rect[1]:roi_rect[1]+roi_rect[3],
-                                    roi_rect[0]:roi_rect[0]+roi_rect[2]]
-            if roi_region.size > 0:
-                g_pixels = roi_region[:,:,1].astype(float)
-                cov = float(g_pixels.std() / (g_pixels.mean() + 1e-6))
-                cov_score = float(np.clip(cov * 8, 0, 1))  # high texture variance = muscle tension
-            else:
-                cov_score = 0.0
-
-            # ── 4. Eye-region darkness (dark circles / fatigue) ─────────
-            eye_y1 = int(y + h * 0.20)
-            eye_y2 = int(y + h * 0.45)
-            eye_x1 = int(x + w * 0.10)
-            eye_x2 = int(x + w * 0.90)
-            eye_roi = frame_bgr[eye_y1:eye_y2, eye_x1:eye_x2]
-            if eye_roi.size > 0:
-                eye_brightness = float(cv2.cvtColor(eye_roi, cv2.COLOR_BGR2GRAY).mean())
-                # Dark under-eyes relative to cheek brightness
-                eye_dark_score = float(np.clip((brightness - eye_brightness) / 40, 0, 1))
-            else:
-                eye_dark_score = 0.0
-
-            # ── 5. Brow tension (texture energy above eyebrows) ─────────
-            brow_y1 = max(0, int(y + h * 0.05))
-            brow_y2 = int(y + h * 0.22)
-            brow_roi = frame_bgr[brow_y1:brow_y2, int(x+w*0.15):int(x+w*0.85)]
-            if brow_roi.size > 0:
-                brow_gray   = cv2.cvtColor(brow_roi, cv2.COLOR_BGR2GRAY).astype(float)
-                laplacian   = float(cv2.Laplacian(brow_roi, cv2.CV_64F).var())
-                brow_score  = float(np.clip(laplacian / 300, 0, 1))  # edge density = furrowing
-            else:
-                brow_score = 0.0
-
-            # ── Weighted composite score ─────────────────────────────────
-            stress_score = float(np.clip(
-                redness_score * 0.30 +
-                pallor_score  * 0.15 +
-                cov_score     * 0.25 +
-                eye_dark_score* 0.15 +
-                brow_score    * 0.15,
-                0.0, 1.0
-            ))
-
-            # Categorical label
-            if stress_score < 0.25:
-                label, color, icon = "Relaxed",           "#00E5A0", "😌"
-            elif stress_score < 0.45:
-                label, color, icon = "Mild Tension",      "#74C0FC", "😐"
-            elif stress_score < 0.65:
-                label, color, icon = "Moderate Stress",   "#FFD166", "😟"
-            elif stress_score < 0.82:
-                label, color, icon = "High Stress",       "#FF6B6B", "😰"
-            else:
-                label, color, icon = "Acute Stress",      "#E84855", "😱"
-
-            return {
-                "score":         round(stress_score, 3),
-                "label":         label,
-                "color":         color,
-                "icon":          icon,
-                "components": {
-                    "Skin Redness":   round(redness_score, 3),
-                    "Pallor":         round(pallor_score,  3),
-                    "Micro-tension":  round(cov_score,     3),
-                    "Eye Fatigue":    round(eye_dark_score,3),
-                    "Brow Tension":   round(brow_score,    3),
-                },
-            }
-        except Exception:
-            return None
-
-    def stress_adjusted_bpm(raw_bpm: int, stress: dict | None,
-                             age: int, gender: str, history: list) -> int:
-        """
-        Modulate BPM using stress score + age/gender prior for realistic variation.
-        Stress pushes BPM toward the higher end; calm toward the lower end.
-        Some results will naturally fall in warning/danger zones.
-        """
-        lo, mid, hi = _age_gender_prior(age, gender) if age else (60, 72, 100)
-
-        # Base: blend raw signal reading with physiological prior
-        if raw_bpm > 0:
-            base = int(raw_bpm * 0.65 + mid * 0.35)
-        else:
-            # Pure prior + small random walk when signal too weak
-            import random as _r
-            base = mid + _r.randint(-8, 8)
-
-        # Stress modulation: stress_score 0→calm, 1→acute
-        if stress:
-            sc = stress["score"]
-            # Map score to BPM delta: calm=-8 to +2, acute=+12 to +35
-            delta = int(sc * 40 - 5)
-            base  = base + delta
-
-        # History smoothing (outlier rejection)
-        if len(history) >= 3:
-            recent_mean = np.mean(history[-3:])
-            recent_std  = np.std(history[-3:]) or 5
-            if abs(base - recent_mean) > 2.5 * recent_std:
-                base = int(base * 0.35 + recent_mean * 0.65)
-
-        # Age-based max HR cap
-        if age:
-            base = min(base, int((220 - age) * 0.92))
-
-        # Soft floor — some users CAN be bradycardic (below 60)
-        # Don't hard-clamp — let the result fall in warning zone if warranted
-        return max(35, min(int(base), 185))
-
-    def process_frame_bytes(img_bytes: bytes):
-        """Decode bytes → cv2 → rPPG pipeline. Returns (rgb, bpm, signal, face, roi)."""
-        try:
-            frame = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
-            if frame is None:
-                return None, 0, [], None, None
-        except Exception:
-            return None, 0, [], None, None
-
-        gray  = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.1, 5, minSize=(80, 80))
-
-        if len(faces) == 0:
-            cv2.putText(frame, "No face — move closer", (10, 30),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.65, (232, 72, 85), 2)
-            return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), 0, [], None, None
-
-        face       = max(faces, key=lambda f: f[2] * f[3])
-        x, y, w, h = face
-        roi         = get_forehead_roi(face, frame.shape)
-        g, xs, ys   = extract_color_signal(frame, roi)
-
-        if g is not None:
-            st.session_state.data_buffer.append(g)
-            st.session_state.times.append(time.time())
-
-        # ── Stress detection on this frame ────────────────────────────────
-        stress_result = analyse_facial_stress(frame, (x, y, w, h), roi)
-        if stress_result:
-            # Accumulate stress scores across frames and keep latest
-            if "stress_scores" not in st.session_state:
-                st.session_state.stress_scores = []
-            st.session_state.stress_scores.append(stress_result["score"])
-            # Rolling average over last 8 frames for stability
-            avg_score = float(np.mean(st.session_state.stress_scores[-8:]))
-            # Update label from averaged score
-            if avg_score < 0.25:
-                stress_result.update({"label":"Relaxed",         "color":"#00E5A0","icon":"😌"})
-            elif avg_score < 0.45:
-                stress_result.update({"label":"Mild Tension",    "color":"#74C0FC","icon":"😐"})
-            elif avg_score < 0.65:
-                stress_result.update({"label":"Moderate Stress", "color":"#FFD166","icon":"😟"})
-            elif avg_score < 0.82:
-                stress_result.update({"label":"High Stress",     "color":"#FF6B6B","icon":"😰"})
-            else:
-                stress_result.update({"label":"Acute Stress",    "color":"#E84855","icon":"😱"})
-            stress_result["score"] = round(avg_score, 3)
-            st.session_state.stress = stress_result
-
-        bpm_raw, sig_filtered = calculate_heart_rate(
-            list(st.session_state.data_buffer),
-            list(st.session_state.times)
-        )
-        bpm = 0
-        if bpm_raw > 0:
-            st.session_state.bpm_history.append(bpm_raw)
-            bpm = stress_adjusted_bpm(bpm_raw,
-                                       st.session_state.get("stress"),
-                                       user.get("age", 0),
-                                       user.get("gender", ""),
-                                       st.session_state.bpm_history)
-
-        # Fallback — stress-adjusted prior when signal too weak
-        if bpm == 0 and len(st.session_state.data_buffer) >= 5:
-            bpm = stress_adjusted_bpm(0,
-                                       st.session_state.get("stress"),
-                                       user.get("age", 0),
-                                       user.get("gender", ""),
-                                       st.session_state.bpm_history)
-            sig_filtered = list(st.session_state.data_buffer)
-
-        # Draw overlays
-        cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 229, 160), 2)
-        rx, ry, rw, rh = roi
-        cv2.rectangle(frame, (rx, ry), (rx+rw, ry+rh), (232, 72, 85), 1)
-        cv2.putText(frame, "ROI", (rx, ry-4),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.35, (232, 72, 85), 1)
-        if bpm > 0:
-            cv2.putText(frame, f"{bpm} BPM", (x, y-8),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 229, 160), 2)
-        cv2.putText(frame, f"Samples: {len(st.session_state.data_buffer)}",
-                    (8, frame.shape[0]-10),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, (138, 151, 184), 1)
-        # Stress overlay on frame
-        if stress_result:
-            label_text = f"Stress: {stress_result['label']} ({int(stress_result['score']*100)}%)"
-            cv2.putText(frame, label_text, (8, 24),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.48, (255, 200, 50), 1)
-
-        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), bpm, sig_filtered,                (x, y, w, h), (rx, ry, rw, rh)
+    engine = get_hr_engine()   # cascade + frame pipeline, built once per process
 
     # ── Layout: full-width two-panel grid ─────────────────────────────────────
     col_cam, col_stats = st.columns([3, 2], gap="medium")
@@ -2417,169 +4637,35 @@ A **contextual prior model** then cross-validates the raw FFT estimate against:
             st.session_state.test_complete = False
             st.session_state.bpm           = 0
             st.session_state.last_result   = None
-            st.session_state.data_buffer   = deque(maxlen=60)
-            st.session_state.times         = deque(maxlen=60)
-            st.session_state.bpm_history   = []
+            st.session_state.data_buffer   = RingBuffer(SIGNAL_WINDOW)
+            st.session_state.times         = RingBuffer(SIGNAL_WINDOW)
+            st.session_state.rppg          = None
+            st.session_state.chrom         = None
+            st.session_state.face_tracker  = None
+            st.session_state.stress_sampler = None
+            st.session_state.bpm_history   = RingBuffer(BPM_HISTORY)
             st.session_state.stress        = None
-            st.session_state.stress_scores = []
+            st.session_state.stress_scores = RingBuffer(STRESS_WINDOW)
+            st.session_state.rppg_run     += 1
+            st.session_state.rppg_seq      = 0
+            st.session_state.rppg_mount    = None
+            st.session_state.rppg_quality  = 0
             log_action(user['id'], "TEST_START", "Heart rate test initiated")
 
         if stop_btn:
-            # JS component handles its own stop & sends result via query param
+            # JS component handles its own stop & streams the result back
             # This button is a fallback to reset state if needed
             st.session_state.running = False
 
-    # ── Camera: components.html (works on all Streamlit deployments) ─────────
+    # ── Camera: bidirectional rPPG component (streams results back) ─────────
     with col_cam:
         _theme = st.session_state.get('theme', 'dark')
 
         if st.session_state.running or st.session_state.test_complete:
-            components.html(_build_rppg_html(_theme), height=500, scrolling=False)
-            st.markdown('---')
-           
-           # ── Auto-fetch: polls sessionStorage every 500ms and auto-submits ──
-            _auto_fetch = components.html("""
-<!DOCTYPE html><html><head><meta charset="utf-8"></head>
-<body style="margin:0;padding:0;height:0;overflow:hidden;background:transparent">
-<script>
-(function(){
-  var POLL_MS = 500;
-  var MAX_WAIT = 120000; // 2 minutes
-  var elapsed = 0;
-  var done = false;
-
-  function tryFetch() {
-    if (done) return;
-    elapsed += POLL_MS;
-    if (elapsed > MAX_WAIT) return;
-
-    var v = sessionStorage.getItem('cs_rppg_result');
-    if (!v) { setTimeout(tryFetch, POLL_MS); return; }
-
-    done = true;
-    sessionStorage.removeItem('cs_rppg_result');
-
-    // Encode result into URL param and navigate parent to trigger Streamlit rerun
-    try {
-      var encoded = btoa(unescape(encodeURIComponent(v)));
-      var url = new URL(window.parent.location.href);
-      url.searchParams.set('rppg_result', encoded);
-      window.parent.location.href = url.toString();
-    } catch(e) {
-      // Fallback: fill textarea + dispatch input event
-      var p = window.parent.document;
-      var areas = p.querySelectorAll('textarea');
-      for (var i = 0; i < areas.length; i++) {
-        var t = areas[i];
-        var desc = Object.getOwnPropertyDescriptor(
-          window.HTMLTextAreaElement.prototype, 'value');
-        desc.set.call(t, v);
-        t.dispatchEvent(new Event('input', {bubbles: true}));
-        break;
-      }
-    }
-  }
-
-  // Start polling immediately when this component loads
-  setTimeout(tryFetch, POLL_MS);
-})();
-</script>
-</body></html>
-""", height=0, scrolling=False)
-
-            # Read result from query params (set by the JS above after scan completes)
-            _qp_result = st.query_params.get('rppg_result', '')
-            if _qp_result and not st.session_state.test_complete:
-                try:
-                    import base64
-                    _raw_json = base64.b64decode(_qp_result).decode('utf-8')
-                    _d    = json.loads(_raw_json)
-                    _bpm  = int(_d.get('bpm', 0))
-                    _qual = int(_d.get('quality', 0))
-                    _frm  = int(_d.get('frames', 0))
-                    _st   = _d.get('stress')
-                    _sig  = _d.get('signal', [])
-                    if _bpm > 0:
-                        _bpm_f = stress_adjusted_bpm(
-                            _bpm, _st,
-                            user.get('age', 0), user.get('gender', ''),
-                            st.session_state.bpm_history,
-                        )
-                        st.session_state.bpm          = _bpm_f
-                        st.session_state.stress       = _st
-                        st.session_state.last_result  = {
-                            'bpm':         _bpm_f,
-                            'analysis':    analyze_heart_rate(_bpm_f),
-                            'signal_data': _sig,
-                            'stress':      _st,
-                            'quality':     _qual,
-                            'frames':      _frm,
-                        }
-                        st.session_state.test_complete = True
-                        st.session_state.running       = False
-                        st.session_state.data_buffer.extend(_sig[-60:])
-                        # Clear the query param then rerun
-                        st.query_params.clear()
-                        st.rerun()
-                except Exception:
-                    pass
-
-            # Fallback manual button (in case auto-poll doesn't work in some browsers)
-            _fetch_btn = st.button(
-                '📥 Fetch Result',
-                key='fetch_result_btn',
-                use_container_width=True,
-                type='primary',
-                help='Normally auto-fetches — click only if result did not appear automatically',
-            )
-            _raw = st.text_area('rppg_raw', key='rppg_raw_ta',
-                                label_visibility='hidden', height=20)
-            if _fetch_btn:
-                _bridge_js = (
-                    "<script>(function(){"
-                    "var v=sessionStorage.getItem('cs_rppg_result');"
-                    "if(!v){alert('No result ready yet — wait for ✅ Done in the camera panel');return;}"
-                    "sessionStorage.removeItem('cs_rppg_result');"
-                    "var all=window.parent.document.querySelectorAll('textarea');"
-                    "for(var i=0;i<all.length;i++){"
-                    "var t=all[i];"
-                    "var sd=Object.getOwnPropertyDescriptor(window.HTMLTextAreaElement.prototype,'value');"
-                    "sd.set.call(t,v);"
-                    "t.dispatchEvent(new Event('input',{bubbles:true}));break;}"
-                    "})();</script>"
-                )
-                components.html(_bridge_js, height=0)
-            if _raw and len(_raw) > 10 and not st.session_state.test_complete:
-                try:
-                    _d    = json.loads(_raw)
-                    _bpm  = int(_d.get('bpm', 0))
-                    _qual = int(_d.get('quality', 0))
-                    _frm  = int(_d.get('frames', 0))
-                    _st   = _d.get('stress')
-                    _sig  = _d.get('signal', [])
-                    if _bpm > 0:
-                        _bpm_f = stress_adjusted_bpm(
-                            _bpm, _st,
-                            user.get('age', 0), user.get('gender', ''),
-                            st.session_state.bpm_history,
-                        )
-                        st.session_state.bpm          = _bpm_f
-                        st.session_state.stress       = _st
-                        st.session_state.last_result  = {
-                            'bpm':         _bpm_f,
-                            'analysis':    analyze_heart_rate(_bpm_f),
-                            'signal_data': _sig,
-                            'stress':      _st,
-                            'quality':     _qual,
-                            'frames':      _frm,
-                        }
-                        st.session_state.test_complete = True
-                        st.session_state.running       = False
-                        st.session_state.data_buffer.extend(_sig[-60:])
-                        st.rerun()
-                except Exception:
-                    pass
-
+            # New key per ▶ Start: a fresh mount, and no stale value from the last run
+            _msg = rppg_component(_theme, key=f"rppg_{st.session_state.rppg_run}")
+            if apply_rppg_message(_msg, engine, user):
+                st.rerun()   # script rerun only — enables 💾 Save above
 
     with col_stats:
         bpm_now   = st.session_state.bpm
@@ -2600,7 +4686,7 @@ A **contextual prior model** then cross-validates the raw FFT estimate against:
         if result and result.get("quality"):
             _qual_pct = int(result["quality"])
         elif st.session_state.running:
-            _qual_pct = 0
+            _qual_pct = st.session_state.rppg_quality
 
         _qual_color = ("#00E5A0" if _qual_pct >= 60
                        else "#FFD166" if _qual_pct >= 30
@@ -2699,7 +4785,7 @@ A **contextual prior model** then cross-validates the raw FFT estimate against:
             )
 
             # ── rPPG Signal chart ─────────────────────────────────────────────
-            buf = list(st.session_state.data_buffer)
+            buf = st.session_state.data_buffer.tolist()
             if len(buf) >= 3:
                 try:
                     is_light  = st.session_state.get("theme", "dark") == "light"
@@ -2774,7 +4860,7 @@ A **contextual prior model** then cross-validates the raw FFT estimate against:
             "phase":       "loading",
             "user_id":     user["id"],
             "result":      st.session_state.last_result,
-            "data_buffer": list(st.session_state.data_buffer),
+            "data_buffer": st.session_state.data_buffer.tolist(),
         }
         st.rerun()
 
@@ -2788,9 +4874,10 @@ elif st.session_state.page == "results":
     badge="Patient records")
     page_padding()
 
-    results = get_user_results(user['id'])
+    # Summary + trend come from the plaintext raw_* columns — no decryption
+    trend = get_user_trend(user['id'])
 
-    if not results:
+    if not trend:
         st.markdown("""
         <div style="text-align:center;padding:3rem;color:var(--text2)">
           <div style="font-size:3rem;margin-bottom:1rem">📭</div>
@@ -2799,16 +4886,18 @@ elif st.session_state.page == "results":
             Complete a heart rate test to see your history here.</div>
         </div>""", unsafe_allow_html=True)
     else:
-        bpms = [r['bpm'] for r in results]
-        normal_count = sum(1 for b in bpms if 60 <= b <= 100)
+        us = get_user_stats(user['id']) or {
+            "tests": len(trend), "avg_bpm": np.mean([t['bpm'] for t in trend]),
+            "min_bpm": min(t['bpm'] for t in trend), "max_bpm": max(t['bpm'] for t in trend),
+            "normal": sum(1 for t in trend if 60 <= t['bpm'] <= 100)}
 
         c1,c2,c3,c4,c5 = st.columns(5)
         metrics = [
-            (c1, "Total Tests",   len(results),                 "All time",   0),
-            (c2, "Average BPM",   f"{np.mean(bpms):.0f}",      "Mean reading", 100),
-            (c3, "Lowest",        f"{min(bpms)}",               "BPM",          200),
-            (c4, "Highest",       f"{max(bpms)}",               "BPM",          300),
-            (c5, "Normal Reads",  f"{normal_count}/{len(bpms)}","60-100 BPM",   400),
+            (c1, "Total Tests",   us['tests'],                        "All time",   0),
+            (c2, "Average BPM",   f"{us['avg_bpm']:.0f}",             "Mean reading", 100),
+            (c3, "Lowest",        f"{us['min_bpm']:.0f}",             "BPM",          200),
+            (c4, "Highest",       f"{us['max_bpm']:.0f}",             "BPM",          300),
+            (c5, "Normal Reads",  f"{us['normal']}/{us['tests']}",    "60-100 BPM",   400),
         ]
         for col, label, val, sub, delay in metrics:
             with col:
@@ -2822,7 +4911,7 @@ elif st.session_state.page == "results":
         st.divider()
 
         # Trend chart
-        df = pd.DataFrame(results)
+        df = pd.DataFrame(trend)
         df['test_date'] = pd.to_datetime(df['test_date'])
         df = df.sort_values('test_date')
         df['color'] = df['bpm'].apply(lambda b: '#00E5A0' if 60<=b<=100 else '#FFD166' if 40<=b<60 or 101<=b<=120 else '#E84855')
@@ -2851,6 +4940,16 @@ elif st.session_state.page == "results":
         st.divider()
         st.markdown("### 📋 Detailed Records")
 
+        # Decrypt one page at a time; "Load more" continues from the keyset
+        # cursor. A new save changes the total and restarts from page one.
+        view = st.session_state.results_view
+        if not view or view["user_id"] != user['id'] or view["total"] != len(trend):
+            recs, cursor = get_user_results_page(user['id'])
+            view = {"user_id": user['id'], "total": len(trend),
+                    "records": recs, "cursor": cursor}
+            st.session_state.results_view = view
+        results = view["records"]
+
         for i, r in enumerate(results):
             an = r['analysis']
             bcls = badge_class(an['status'])
@@ -2920,11 +5019,19 @@ elif st.session_state.page == "results":
                     except Exception:
                         pass
 
+        if view["cursor"]:
+            st.caption(f"Showing {len(results)} of {len(trend)} records")
+            if st.button("⬇ Load more", key="results_load_more", use_container_width=True):
+                recs, cursor = get_user_results_page(user['id'], after=view["cursor"])
+                view["records"].extend(recs)
+                view["cursor"] = cursor
+                st.rerun()
+
         st.divider()
-        export_df = pd.DataFrame({'Date':[r['test_date'] for r in results],
-                                   'BPM':[r['bpm'] for r in results],
-                                   'Category':[r['analysis']['category'] for r in results],
-                                   'Status':[r['analysis']['status'] for r in results]})
+        export_df = pd.DataFrame({'Date':[t['test_date'] for t in trend],
+                                   'BPM':[t['bpm'] for t in trend],
+                                   'Category':[t['category'] for t in trend],
+                                   'Status':[analyze_heart_rate(t['bpm'])['status'] for t in trend]})
         st.download_button("⬇ Export CSV", export_df.to_csv(index=False),
                            f"heart_data_{user['username']}.csv", "text/csv")
 
@@ -2938,17 +5045,15 @@ elif st.session_state.page == "admin_dashboard" and is_admin:
     badge="Administrator")
     page_padding()
 
-    all_results = get_all_results_admin()
-    all_users   = get_all_users()
-    non_admin   = [u for u in all_users if not u['is_admin']]
-    bpms_all    = [r['bpm'] for r in all_results] if all_results else []
+    # Aggregated in SQL from the plaintext raw_* columns — nothing decrypted
+    stats = get_dashboard_stats()
 
     c1,c2,c3,c4 = st.columns(4)
     metrics = [
-        (c1, "Registered Users", len(non_admin), "👥", "#00D4FF",   0),
-        (c2, "Total Tests",      len(all_results), "📊", "#00E5A0",  150),
-        (c3, "Avg Heart Rate",   f"{np.mean(bpms_all):.0f} bpm" if bpms_all else "–", "💓", "#E84855", 300),
-        (c4, "Abnormal Reads",   sum(1 for b in bpms_all if not (60<=b<=100)), "⚠️", "#FFD166", 450),
+        (c1, "Registered Users", stats["users"], "👥", "#00D4FF",   0),
+        (c2, "Total Tests",      stats["total"], "📊", "#00E5A0",  150),
+        (c3, "Avg Heart Rate",   f"{stats['avg_bpm']:.0f} bpm" if stats["total"] else "–", "💓", "#E84855", 300),
+        (c4, "Abnormal Reads",   stats["abnormal"], "⚠️", "#FFD166", 450),
     ]
     for col, label, val, icon, color, delay in metrics:
         with col:
@@ -2961,15 +5066,14 @@ elif st.session_state.page == "admin_dashboard" and is_admin:
 
     st.divider()
 
-    if all_results:
-        df_all = pd.DataFrame(all_results)
-        df_all['test_date'] = pd.to_datetime(df_all['test_date'])
-
+    if stats["total"]:
         c1, c2 = st.columns(2)
         with c1:
-            # BPM distribution
+            # BPM distribution (pre-binned in SQL)
             try:
-                fig_dist = pgo.Figure(pgo.Histogram(x=bpms_all, nbinsx=20,
+                bins, counts = zip(*stats["histogram"])
+                fig_dist = pgo.Figure(pgo.Bar(
+                    x=[b + HIST_BIN_BPM / 2 for b in bins], y=counts, width=HIST_BIN_BPM,
                     marker_color='#E84855', opacity=0.8,
                     marker_line=dict(color='#0A0E1A', width=1)))
                 fig_dist.add_vrect(x0=60,x1=100,fillcolor="rgba(0,229,160,0.1)",
@@ -2981,8 +5085,8 @@ elif st.session_state.page == "admin_dashboard" and is_admin:
             except Exception: pass
 
         with c2:
-            cats = df_all['analysis'].apply(lambda a: a['category']).value_counts()
-            fig_pie = pgo.Figure(pgo.Pie(labels=cats.index, values=cats.values,
+            cat_labels, cat_counts = zip(*stats["categories"])
+            fig_pie = pgo.Figure(pgo.Pie(labels=cat_labels, values=cat_counts,
                 hole=0.55, marker=dict(colors=['#00E5A0','#FFD166','#E84855','#00D4FF','#9B5DE5'],
                                        line=dict(color='#0A0E1A',width=2)),
                 textfont=dict(size=10)))
@@ -3011,6 +5115,20 @@ elif st.session_state.page == "admin_dashboard" and is_admin:
               <span style="color:var(--text3);margin-left:auto">{entry['logged_at'][:16]}</span>
             </div>""", unsafe_allow_html=True)
 
+    with st.expander("🛠 Maintenance", expanded=False):
+        st.caption("Recompute the user_stats / daily_stats rollups from every stored test.")
+        if st.button("Rebuild rollup tables", key="rebuild_rollups_btn", type="secondary"):
+            try:
+                rebuild_rollups()
+                log_action(user['id'], "ROLLUP_REBUILD", "user_stats + daily_stats")
+                st.success("✅ Rollups rebuilt")
+            except Exception as _rb_err:
+                st.error(f"Rollup rebuild failed: {_rb_err}")
+        _ob = get_outbox_status()
+        st.caption(f"Remote backup outbox: {_ob['pending']} pending"
+                   + (f" · oldest {_ob['oldest']} · up to {_ob['max_attempts']} retries"
+                      if _ob['pending'] else ""))
+
 # ─────────────────────────────────────────────────────────────────────────────
 # ADMIN: ALL USERS  (click → show history)
 # ─────────────────────────────────────────────────────────────────────────────
@@ -3023,6 +5141,7 @@ elif st.session_state.page == "admin_users" and is_admin:
 
     all_users = get_all_users()
     non_admin = [u for u in all_users if not u['is_admin']]
+    summaries = get_user_summaries()   # one query for every card below
 
     # Search
     search = st.text_input("🔍 Search users", placeholder="Name or username…")
@@ -3039,9 +5158,10 @@ elif st.session_state.page == "admin_users" and is_admin:
                 col_info, col_btn = st.columns([5, 1])
                 with col_info:
                     # Quick stats
-                    user_results = get_user_results_by_id(u['id'])
-                    avg_bpm = f"{np.mean([r['bpm'] for r in user_results]):.0f}" if user_results else "–"
-                    last_date = user_results[0]['test_date'][:10] if user_results else "No tests"
+                    summ      = summaries.get(u['id'])
+                    n_tests   = summ['tests'] if summ else 0
+                    avg_bpm   = f"{summ['avg_bpm']:.0f}" if summ and summ['avg_bpm'] is not None else "–"
+                    last_date = summ['last_test'][:10] if summ else "No tests"
 
                     st.markdown(f"""
                     <div class="cs-card" style="margin-bottom:0.5rem;cursor:default">
@@ -3058,7 +5178,7 @@ elif st.session_state.page == "admin_users" and is_admin:
                             @{u['username']} · Age {u.get('age','?')} · {u.get('gender','—')}</div>
                         </div>
                         <div style="text-align:center;padding:0 1rem">
-                          <div style="font-family:'DM Mono';font-size:1.1rem;color:#00E5A0">{len(user_results)}</div>
+                          <div style="font-family:'DM Mono';font-size:1.1rem;color:#00E5A0">{n_tests}</div>
                           <div style="font-size:0.7rem;color:var(--text3)">Tests</div>
                         </div>
                         <div style="text-align:center;padding:0 1rem">
@@ -3076,9 +5196,15 @@ elif st.session_state.page == "admin_users" and is_admin:
                     if st.button("View →", key=f"view_user_{u['id']}", use_container_width=True):
                         st.session_state.admin_selected_user = u['id']
 
-            # Inline history expansion
+            # Inline history expansion — decrypted once, then reused from
+            # session state until this user's test count changes
             if st.session_state.get('admin_selected_user') == u['id']:
-                user_results = get_user_results_by_id(u['id'])
+                n_tests = summaries.get(u['id'], {}).get('tests', 0)
+                cached  = st.session_state.admin_history_cache.get(u['id'])
+                if not cached or cached[0] != n_tests:
+                    cached = (n_tests, get_user_results_by_id(u['id']))
+                    st.session_state.admin_history_cache[u['id']] = cached
+                user_results = cached[1]
                 if not user_results:
                     st.info(f"No test results for {u['full_name']} yet.")
                 else:
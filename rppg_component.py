@@ -0,0 +1,35 @@
+"""
+CardioSecure — bidirectional HTML component declaration.
+
+Streamlit serves custom components from a directory, and registers them
+under the name of the declaring module. Keeping the declaration here (not
+in the app script, whose module is ``__main__``) gives the component a
+stable name and keeps the ``streamlit.components.v1`` import in one place.
+
+Every value the page posts back reruns the whole calling script, so pages
+should batch what they send (see RPPG_STREAM_MS in app.py).
+"""
+
+import hashlib
+import os
+import tempfile
+
+import streamlit as st
+from streamlit.components.v1 import declare_component
+
+
+@st.cache_resource(show_spinner=False)
+def declare_html_component(name: str, html: str):
+    """Declare a component whose frontend is the single page ``html``.
+
+    The page is written once per process under the temp dir, in a directory
+    named by content hash, so an edited page never serves a stale copy.
+    """
+    path = os.path.join(tempfile.gettempdir(),
+                        f"cs_{name}_{hashlib.sha256(html.encode()).hexdigest()[:12]}")
+    os.makedirs(path, exist_ok=True)
+    tmp = os.path.join(path, f"index.html.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(html)
+    os.replace(tmp, os.path.join(path, "index.html"))
+    return declare_component(name, path=path)
@@ -0,0 +1,58 @@
+"""The vectorised refiners must match the scalar ones row for row."""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+APP = Path(__file__).resolve().parents[1] / "app.py"
+
+
+@pytest.fixture(scope="module")
+def app():
+    """app.py's headless part — what `python app.py <command>` runs before
+    the DB init and UI."""
+    sys.path.insert(0, str(APP.parent))
+    src = APP.read_text(encoding="utf-8")
+    src = src[:src.index("# Stop here when run headless")]
+    ns = {"__name__": "cardiosecure_app", "__file__": str(APP)}
+    exec(compile(src, str(APP), "exec"), ns)
+    return ns
+
+
+def _readings(app, n, seed):
+    rng    = np.random.default_rng(seed)
+    raw    = np.where(rng.random(n) < 0.05, 0, rng.integers(25, 215, n))
+    age    = np.where(rng.random(n) < 0.1, 0, rng.integers(10, 95, n))
+    gcode  = rng.integers(0, 2, n)
+    stress = np.where(rng.random(n) < 0.2, np.nan, rng.random(n).round(3))
+    hist   = np.where(rng.random((n, 5)) < 0.15, np.nan, rng.integers(45, 150, (n, 5)))
+    hist   = app["history_matrix"]([row[~np.isnan(row)] for row in hist])
+    histories = [[int(v) for v in row if not np.isnan(v)] for row in hist]
+    return raw, age, gcode, stress, hist, histories
+
+
+@pytest.mark.parametrize("seed", [0, 7, 2024])
+def test_refine_readings_batch_matches_scalar(app, seed):
+    raw, age, gcode, _, hist, histories = _readings(app, 5000, seed)
+    ml_s  = [app["ml_refine_bpm"](int(r), int(a), int(g), h)
+             for r, a, g, h in zip(raw, age, gcode, histories)]
+    cat_s = [app["HR_CATEGORIES"].index(app["analyze_heart_rate"](b)["category"])
+             for b in ml_s]
+    ml_v, cat_v = app["refine_readings_batch"](raw, age, gcode, hist)
+    np.testing.assert_array_equal(ml_v, ml_s)
+    np.testing.assert_array_equal(cat_v, cat_s)
+
+
+@pytest.mark.parametrize("seed", [0, 7, 2024])
+def test_stress_adjusted_bpm_batch_matches_scalar(app, seed):
+    raw, age, gcode, stress, hist, histories = _readings(app, 5000, seed)
+    engine = app["HeartRateEngine"]()
+    rng = np.random.default_rng(seed + 1)
+    st_s = [engine.stress_adjusted_bpm(int(r), None if np.isnan(sc) else {"score": sc},
+                                       int(a), int(g), h, rng=rng)
+            for r, sc, a, g, h in zip(raw, stress, age, gcode, histories)]
+    st_v = app["stress_adjusted_bpm_batch"](raw, stress, age, gcode, hist,
+                                            rng=np.random.default_rng(seed + 1))
+    np.testing.assert_array_equal(st_v, st_s)